@@ -0,0 +1,181 @@
+import sys
+import os
+import mmap
+import struct
+import time
+import argparse
+from collections import Counter
+
+# bus capture 파일 형식 (ezville_wallpad.py 의 BusCapture 와 같음)
+#   file header: magic (8 Byte), 기준 wall clock 시각 (double), 같은 순간의 monotonic 시각 (double)
+#   record: 기준 시각부터 us (4 Byte), 방향/종류 (1 Byte), data 길이 (2 Byte), data
+#   모두 little endian, record는 파일 끝까지 반복 (기록 중 종료되어 잘린 마지막 record는 무시)
+CAPTURE_MAGIC = b"EZCAP001"
+CAPTURE_FILE_HEADER = struct.Struct("<8sdd")
+CAPTURE_RECORD = struct.Struct("<IBH")
+CAPTURE_RX = 0x00
+CAPTURE_TX = 0x80
+CAPTURE_RAW = 0x01
+CAPTURE_FRAME = 0x02
+CAPTURE_MARK = 0x04
+
+KIND_NAMES = {
+    CAPTURE_RX | CAPTURE_RAW: "raw",
+    CAPTURE_RX | CAPTURE_FRAME: "frame",
+    CAPTURE_TX | CAPTURE_FRAME: "tx",
+    CAPTURE_MARK: "mark",
+}
+KIND_CODES = {name: kind for kind, name in KIND_NAMES.items()}
+
+
+class CaptureFile:
+    # 파일 전체를 읽지 않고 mmap으로 필요한 record만 차례로 꺼냄
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # 빈 파일은 mmap 불가
+            self._file.close()
+            raise ValueError("{}: empty capture file".format(path))
+
+        if len(self._map) < CAPTURE_FILE_HEADER.size:
+            self.close()
+            raise ValueError("{}: truncated capture header".format(path))
+        magic, self.wall, self.monotonic = CAPTURE_FILE_HEADER.unpack_from(self._map, 0)
+        if magic != CAPTURE_MAGIC:
+            self.close()
+            raise ValueError("{}: not a capture file ({!r})".format(path, magic))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def records(self, kinds=None, start=None, end=None):
+        # (monotonic 시각, wall clock 시각, 종류, data) 를 순서대로, start/end 는 wall clock 기준
+        # 조건에 맞는 record의 data만 bytes로 꺼냄
+        buf = self._map
+        size = len(buf)
+        pos = CAPTURE_FILE_HEADER.size
+        unpack = CAPTURE_RECORD.unpack_from
+        header = CAPTURE_RECORD.size
+        while pos + header <= size:
+            us, kind, length = unpack(buf, pos)
+            data_end = pos + header + length
+            if data_end > size:
+                break
+            ts = self.monotonic + us / 1000000
+            wall = self.wall + us / 1000000
+            if end is not None and wall > end:
+                break
+            if (kinds is None or kind in kinds) and (start is None or wall >= start):
+                yield ts, wall, kind, buf[pos + header:data_end]
+            pos = data_end
+
+
+def capture_paths(paths):
+    # 폴더면 그 안의 capture 파일을 이름 (= 시작 시각) 순서로
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".ezcap"))
+        else:
+            result.append(path)
+    return result
+
+
+def read_captures(paths, kinds=None, start=None, end=None):
+    # 여러 파일을 이어서 읽음 (rotation된 파일들)
+    for path in capture_paths(paths):
+        try:
+            capture = CaptureFile(path)
+        except (OSError, ValueError) as e:
+            print("skip {}: {}".format(path, e), file=sys.stderr)
+            continue
+        with capture:
+            if end is not None and capture.wall > end:
+                break
+            for record in capture.records(kinds, start, end):
+                yield record
+
+
+def format_time(wall):
+    return "{}.{:03d}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(wall)), int(wall * 1000) % 1000)
+
+
+def parse_time(value):
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("time format: YYYY-mm-dd [HH:MM[:SS]]")
+
+
+def print_records(records):
+    for ts, wall, kind, data in records:
+        name = KIND_NAMES.get(kind, "{:02x}".format(kind))
+        if kind == CAPTURE_MARK:
+            text = data.decode(errors="replace")
+        else:
+            text = data.hex(" ").upper()
+        print("{} {:<5} {}".format(format_time(wall), name, text))
+
+
+def print_summary(records):
+    kinds = Counter()
+    sizes = Counter()
+    marks = Counter()
+    devices = Counter()
+    first = last = None
+    for ts, wall, kind, data in records:
+        kinds[kind] += 1
+        sizes[kind] += len(data)
+        if first is None:
+            first = wall
+        last = wall
+        if kind == CAPTURE_MARK:
+            marks[data.decode(errors="replace")] += 1
+        elif kind & CAPTURE_FRAME and len(data) >= 4:
+            devices["{} {:02X} {:02X}".format("tx" if kind & CAPTURE_TX else "rx", data[1], data[3])] += 1
+
+    if first is None:
+        print("no records")
+        return
+    print("from {} to {} ({:.1f} seconds)".format(format_time(first), format_time(last), last - first))
+    for kind, count in sorted(kinds.items()):
+        print("  {:<5} {:>10} records {:>12} bytes".format(KIND_NAMES.get(kind, "{:02x}".format(kind)), count, sizes[kind]))
+    for reason, count in marks.most_common():
+        print("  mark {}: {}".format(reason, count))
+    print("frames by direction / device id / command:")
+    for device, count in devices.most_common():
+        print("  {}: {}".format(device, count))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EzVille bus capture reader")
+    parser.add_argument("paths", nargs="+", help="capture files or folders")
+    parser.add_argument("--kind", action="append", choices=sorted(KIND_CODES), help="record kind (repeatable)")
+    parser.add_argument("--start", type=parse_time, help="from time (YYYY-mm-dd HH:MM:SS)")
+    parser.add_argument("--end", type=parse_time, help="to time (YYYY-mm-dd HH:MM:SS)")
+    parser.add_argument("--summary", action="store_true", help="print counts instead of records")
+    args = parser.parse_args()
+
+    kinds = None if args.kind is None else {KIND_CODES[name] for name in args.kind}
+    records = read_captures(args.paths, kinds, args.start, args.end)
+    try:
+        if args.summary:
+            print_summary(records)
+        else:
+            print_records(records)
+    except BrokenPipeError:
+        pass
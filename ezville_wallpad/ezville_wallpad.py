@@ -2,15 +2,30 @@
 
 import socket
 import serial
+import asyncio
 import paho.mqtt.client as paho_mqtt
 import json
 
 import sys
 import time
+import threading
+import heapq
+import itertools
+import statistics
+import hashlib
+import pickle
+import bisect
+import struct
+from collections import deque
+import queue
+import atexit
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import os.path
 import re
+from functools import reduce
+from operator import xor
 
 ####################
 #VIRTUAL_DEVICE = {
@@ -98,7 +113,7 @@ RS485_DEVICE = {
         "state":    { "id": 0x0E, "cmd": 0x81, },
         "last":     { },
 
-        "power":    { "id": 0x0E, "cmd": 0x41, "ack": 0xC1, },
+        "power":    { "id": 0x0E, "cmd": 0x41, "ack": 0xC1, "priority": 0, },
     },
     # 각방 난방 제어
     "thermostat": {
@@ -106,8 +121,8 @@ RS485_DEVICE = {
         "state":    { "id": 0x36, "cmd": 0x81, },
         "last":     { },
 
-        "away":    { "id": 0x36, "cmd": 0x45, "ack": 0x00, },
-        "target":   { "id": 0x36, "cmd": 0x44, "ack": 0xC4, },
+        "away":    { "id": 0x36, "cmd": 0x45, "ack": 0x00, "priority": 2, },
+        "target":   { "id": 0x36, "cmd": 0x44, "ack": 0xC4, "priority": 1, },
     },
         
 # KTDO: 기존 코드
@@ -185,6 +200,17 @@ RS485_DEVICE = {
 #    },
 }
 
+# KTDO: 전체/그룹 명령, ACK가 없으므로 3회 연속 전송하고 개별 장치 상태로 확인
+#       조명: F7 0E FF 42 03 FF 00 00 (일괄 소등만 가능), 난방: 그룹 ID 하위 4bit가 F면 그룹 전체 (외출 설정만 문서에 있음)
+RS485_BROADCAST = {
+    "light": {
+        "power":    { "id": 0x0E, "cmd": 0x42, "pos": 6, "values": (0,), "group": False, },
+    },
+    "thermostat": {
+        "away":     { "id": 0x36, "cmd": 0x45, "pos": 5, "values": (1,), "group": True, },
+    },
+}
+
 DISCOVERY_DEVICE = {
     "ids": ["ezville_wallpad",],
     "name": "ezville_wallpad",
@@ -261,6 +287,26 @@ DISCOVERY_DEVICE = {
 #    ],
 #}
 
+# KTDO: 전체 명령 버튼, 해당 종류의 장치가 처음 발견될 때 같이 등록
+DISCOVERY_BROADCAST = {
+    "light": [ {
+        "_intg": "button",
+        "~": "{prefix}/light/all/power",
+        "name": "{prefix}_light_all_off",
+        "cmd_t": "~/command",
+        "pl_prs": "OFF",
+        "icon": "mdi:lightbulb-group-off",
+    } ],
+    "thermostat": [ {
+        "_intg": "button",
+        "~": "{prefix}/thermostat/all/away",
+        "name": "{prefix}_thermostat_all_away",
+        "cmd_t": "~/command",
+        "pl_prs": "ON",
+        "icon": "mdi:home-export-outline",
+    } ],
+}
+
 DISCOVERY_PAYLOAD = {
     "light": [ {
         "_intg": "light",
@@ -347,6 +393,25 @@ DISCOVERY_PAYLOAD = {
 #    } ],
 }
 
+# KTDO: state_json 모드, 속성별 state topic 대신 방 단위 JSON 문서 하나와 template 사용
+DISCOVERY_STATE_JSON = {
+    "light": {
+        "stat_t": "{prefix}/light/{grp}_{rm}/state",
+        "stat_val_tpl": "{{{{ value_json['{id}'] }}}}",
+    },
+    "thermostat": {
+        "json_attr_t": "~/state",
+        "mode_stat_t": "~/state",
+        "mode_stat_tpl": "{{{{ value_json.power }}}}",
+        "temp_stat_t": "~/state",
+        "temp_stat_tpl": "{{{{ value_json.target }}}}",
+        "curr_temp_t": "~/state",
+        "curr_temp_tpl": "{{{{ value_json.current }}}}",
+        "away_stat_t": "~/state",
+        "away_mode_stat_tpl": "{{{{ value_json.away }}}}",
+    },
+}
+
 STATE_HEADER = {
     prop["state"]["id"]: (device, prop["state"]["cmd"])
     for device, prop in RS485_DEVICE.items()
@@ -370,9 +435,7 @@ ACK_MAP = {}
 for device, prop in RS485_DEVICE.items():
     for cmd, code in prop.items():
         if "ack" in code:
-            ACK_MAP[code["id"]] = {}
-            ACK_MAP[code["id"]][code["cmd"]] = {}
-            ACK_MAP[code["id"]][code["cmd"]] = code["ack"]
+            ACK_MAP.setdefault(code["id"], {})[code["cmd"]] = code["ack"]
 
 # KTDO: 아래 미사용으로 코멘트 처리
 #HEADER_0_STATE = 0xB0
@@ -395,20 +458,1257 @@ header_0_first_candidate = [ [[0x33, 0x01], [0x33, 0x0F]], [[0x36, 0x01], [0x36,
 #virtual_ack = {}
 #virtual_avail = []
 
-serial_queue = {}
+# KTDO: ack header -> (명령 key, 패킷), 명령 queue는 SerialScheduler 참고
 serial_ack = {}
 
+# KTDO: 재전송 간격, 첫 재전송은 ack timeout 만큼 기다리고 이후 두배씩 (최대 SERIAL_RETRY_MAX)
+SERIAL_ACK_TIMEOUT = 0.3
+SERIAL_RETRY_MAX = 2.0
+
+# KTDO: asyncio 모드용, 마지막으로 처리한 패킷은 재전송 timer에서 bus idle 확인에 사용
+serial_event_loop = None
+serial_command_queue = None
+serial_last_frame = None
+
+# KTDO: 이 패킷 (응답, 조회) 뒤에 명령 전송 시도
+SERIAL_SEND_AFTER = (0x81, 0x8F, 0x0F)
+
+# KTDO: serial_loop 상태
+loop_count = 0
+scan_count = 0
+send_aggressive = False
+loop_start_time = 0
+
 last_query = int(0).to_bytes(2, "big")
 last_topic_list = {}
+last_state_doc = {}
+# KTDO: 이번 실행에서 보낸 상태 topic (snapshot으로 불러온 값은 명령 확인용, HA에는 처음 받은 값을 한번 보냄)
+state_seen = set()
 
 mqtt = paho_mqtt.Client()
 mqtt_connected = False
 
 logger = logging.getLogger(__name__)
 
+# KTDO: 로그는 queue에 넣기만 하고, 메시지 formatting과 화면/파일 출력은 log_listener thread에서
+#       SD card 쓰기가 늦어져도 패킷 처리는 기다리지 않음, queue가 가득 차면 버리고 나중에 버린 개수를 남김
+LOG_QUEUE_SIZE = 10000
+
+class LogQueueHandler(QueueHandler):
+    def __init__(self):
+        super().__init__(queue.Queue(LOG_QUEUE_SIZE))
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 인자는 바뀌지 않는 값 (str, 숫자, bytes) 만 넘기므로 formatting은 출력 thread에서
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": record.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": "log queue full, %d messages dropped", "args": (self.dropped,)}))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# KTDO: 같은 종류 (format 문자열) 의 INFO 로그는 초당 rate개까지만 남김 (0이면 제한 없음)
+#       WARNING 이상은 항상 남기고, 버린 개수는 같은 종류의 다음 로그에 붙임
+class LogRateLimit(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        self.rate = 0
+        self._buckets = {}
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+
+        key = record.msg
+        tokens, last, suppressed = self._buckets.get(key, (self.rate, record.created, 0))
+        tokens = min(self.rate, tokens + (record.created - last) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, record.created, suppressed + 1)
+            return False
+
+        self._buckets[key] = (tokens - 1, record.created, 0)
+        if suppressed:
+            record.msg = key + " (%d similar messages suppressed)"
+            record.args = (record.args or ()) + (suppressed,)
+        return True
+
+
+# KTDO: 패킷은 로그가 실제로 출력될 때만 hex 문자열로 바꿈
+class LazyHex:
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return self.data.hex()
+
+
+log_handler = LogQueueHandler()
+log_rate_limit = LogRateLimit()
+log_handler.addFilter(log_rate_limit)
+log_listener = None
+
+# KTDO: 명령 재전송 scheduler
+#       명령 key (장치, id, 속성) 마다 하나의 명령만 유지하고, 우선순위가 높은 명령부터 같은 우선순위끼리는 돌아가며 전송
+#       전송한 명령은 heap에 다음 전송 시각으로 넣어두고, 그 사이에는 다른 명령에 기회를 줌
+class SerialScheduler:
+    def __init__(self):
+        # MQTT thread와 serial thread에서 같이 접근
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._ready = {}
+        self._timers = []
+        self._seq = itertools.count()
+        # 재전송 횟수, max_retry 초과로 버린 명령 수 (metrics)
+        self.retries = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def put(self, key, packet, priority=0, now=None, repeat=1, replace=True, merge=True):
+        # 같은 key의 명령이 있으면 새 명령으로 대체하고 재시도 시간도 새로 시작 (replace가 False면 기존 명령 유지)
+        # repeat: ACK 없는 명령을 연속으로 보낼 횟수, merge: broadcast로 합칠 수 있는 명령인지
+        now = now or time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {"packet": packet, "queued": now, "priority": priority, "attempts": 0, "due": None, "repeat": repeat, "sends": 0, "merge": merge}
+                self._entries[key] = entry
+                self._ready.setdefault(priority, deque()).append(key)
+            elif not replace:
+                return entry["queued"]
+            else:
+                entry.update(packet=packet, queued=now, attempts=0, repeat=repeat, sends=0, merge=merge)
+                if entry["due"] is not None:
+                    entry["due"] = None
+                    self._ready.setdefault(entry["priority"], deque()).append(key)
+            return now
+
+    def take(self, now=None, rank=None):
+        # 지금 보낼 명령 하나 (없으면 None) 와 max_retry 초과로 제거한 명령들의 (key, 패킷) 목록
+        # rank가 있으면 같은 우선순위 중 rank(packet)이 가장 작은 명령, 같으면 먼저 들어온 명령
+        now = now or time.time()
+        expired = []
+        with self._lock:
+            # 재전송 시각이 된 명령은 우선순위별 대기열 끝으로
+            while self._timers and self._timers[0][0] <= now:
+                due, _, key = heapq.heappop(self._timers)
+                entry = self._entries.get(key)
+                if entry is not None and entry["due"] == due:
+                    entry["due"] = None
+                    self._ready.setdefault(entry["priority"], deque()).append(key)
+
+            for priority in sorted(self._ready, reverse=True):
+                ready = self._ready[priority]
+                for key in list(ready):
+                    entry = self._entries.get(key)
+                    if entry is None or entry["due"] is not None:
+                        ready.remove(key)
+
+                    # retry time 초과했으면 제거
+                    elif now - entry["queued"] > Options["rs485"]["max_retry"]:
+                        del self._entries[key]
+                        self.expired += 1
+                        expired.append((key, entry["packet"]))
+                        ready.remove(key)
+
+                if not ready:
+                    continue
+                key = ready[0]
+                # 반복 전송중인 명령 (broadcast) 은 다 보낼 때까지 먼저
+                if rank is not None and len(ready) > 1 and not self._entries[key]["sends"]:
+                    key = min(ready, key=lambda k: rank(self._entries[k]["packet"]))
+                ready.remove(key)
+
+                entry = self._entries[key]
+                return (key, entry["packet"], entry["queued"]), expired
+            return None, expired
+
+    def retry_later(self, key, packet, now=None):
+        # ack 못 받으면 backoff 후 다시 전송, 재전송 시각 (대상이 아니면 None)
+        now = now or time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["packet"] != packet:
+                return None
+            entry["attempts"] += 1
+            if entry["attempts"] > 1:
+                self.retries += 1
+            entry["due"] = now + min(SERIAL_ACK_TIMEOUT * 2 ** (entry["attempts"] - 1), SERIAL_RETRY_MAX)
+            heapq.heappush(self._timers, (entry["due"], next(self._seq), key))
+            return entry["due"]
+
+    def sent(self, key, packet):
+        # ACK 없는 명령을 한번 보냄, 반복 횟수가 남았으면 대기열 맨 앞에 다시 넣음
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["packet"] != packet:
+                return
+            entry["sends"] += 1
+            if entry["sends"] < entry["repeat"]:
+                self._ready.setdefault(entry["priority"], deque()).appendleft(key)
+            else:
+                del self._entries[key]
+
+    def entries(self, match):
+        # broadcast로 합칠 수 있는 명령 중 match(key)가 True인 명령들의 (key, 패킷, 우선순위)
+        with self._lock:
+            return [(key, entry["packet"], entry["priority"]) for key, entry in self._entries.items() if entry["merge"] and match(key)]
+
+    def pop(self, key, packet):
+        # 남아있는 명령이 packet인 경우만 제거 (그 사이 새 명령으로 대체되었으면 유지)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["packet"] == packet:
+                del self._entries[key]
+                return entry
+            return None
+
+    def expire(self, key, queued):
+        # asyncio 모드에서 max_retry 초과시 timer로 호출됨, 그 사이 성공했거나 새로 들어온 명령이면 무시
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["queued"] != queued:
+                return None
+            del self._entries[key]
+            self.expired += 1
+            return entry["packet"]
+
+
+serial_queue = SerialScheduler()
+
+# KTDO: bus idle 학습, 패킷 종류별로 그 패킷이 끝난 뒤 다음 패킷이 시작될 때까지의 간격을 모아둠
+BUS_GAP_SAMPLES = 32
+BUS_GAP_MIN_SAMPLES = 8
+BUS_REPORT_INTERVAL = 300
+# KTDO: 명령 패킷 최대 길이 (light)
+SERIAL_MAX_COMMAND_LENGTH = 10
+
+class BusTiming:
+    def __init__(self):
+        self._gaps = {}
+        self._last = None
+        self._sent = None
+        self._byte_time = None
+        self._report_time = time.time()
+        self.stats = {"sent": 0, "deferred": 0, "echo": 0, "garbled": 0, "acked": 0, "first_ack": 0}
+
+    def byte_time(self):
+        # 1 Byte 전송 시간: start bit + data bits + parity + stop bits
+        if self._byte_time is None:
+            ser = Options["serial"]
+            bits = 1 + ser["bytesize"] + (ser["parity"] != "N") + ser["stopbits"]
+            self._byte_time = bits / ser["baudrate"]
+        return self._byte_time
+
+    def on_frame(self, packet, end_time, errors):
+        # 이전 패킷 끝 ~ 이번 패킷 시작 간격 기록, 같은 read로 받은 패킷이면 0 (bus가 쉬지 않은 것으로 봄)
+        start_time = end_time - len(packet) * self.byte_time()
+        if self._last is not None:
+            key, last_end = self._last
+            gaps = self._gaps.get(key)
+            if gaps is None:
+                gaps = self._gaps[key] = deque(maxlen=BUS_GAP_SAMPLES)
+            gaps.append(max(start_time - last_end, 0))
+        self._last = ((packet[1], packet[3]), end_time)
+
+        # 명령을 보낸 직후의 패킷으로 충돌 여부 판단
+        if self._sent is not None:
+            sent, sent_errors = self._sent
+            if packet == sent:
+                self.stats["echo"] += 1
+            elif errors > sent_errors:
+                self.stats["garbled"] += 1
+            self._sent = None
+
+    def idle_window(self, key):
+        # 이 패킷 뒤에 bus가 쉬는 시간, 보수적으로 하위 10% 값 사용, 학습 전이면 None
+        gaps = self._gaps.get(key)
+        if gaps is None or len(gaps) < BUS_GAP_MIN_SAMPLES:
+            return None
+        return sorted(gaps)[len(gaps) // 10]
+
+    def can_send(self, packet, end_time, now):
+        # 남은 idle 시간 안에 명령 패킷과 장치의 ack까지 다 오갈 수 있을 때만 전송
+        # early_response: 0~2, 작을수록 여유 Byte를 더 둠
+        window = self.idle_window((packet[1], packet[3]))
+        if window is None:
+            return True
+        margin = 2 - Options["rs485"]["early_response"]
+        need = (2 * SERIAL_MAX_COMMAND_LENGTH + margin) * self.byte_time()
+
+        # 충분히 긴 빈 시간이 없는 집이면 그 중 가장 긴 빈 시간이라도 사용
+        best = max(w for w in map(self.idle_window, self._gaps) if w is not None)
+        if window - (now - end_time) >= need or window >= best:
+            return True
+        self.stats["deferred"] += 1
+        return False
+
+    def on_send(self, packet, errors):
+        self.stats["sent"] += 1
+        self._sent = (packet, errors)
+        # 우리가 bus를 쓴 구간은 간격 학습에서 제외
+        self._last = None
+
+    def on_ack(self, attempts):
+        self.stats["acked"] += 1
+        if attempts == 1:
+            self.stats["first_ack"] += 1
+
+    def report(self, now):
+        if now - self._report_time < BUS_REPORT_INTERVAL:
+            return
+        self._report_time = now
+
+        stats = self.stats
+        if stats["sent"]:
+            logger.info("bus: sent %s, deferred %s, collision %.1f%%, echo %.1f%%, first-attempt ack %.1f%%",
+                stats["sent"], stats["deferred"], 100 * stats["garbled"] / stats["sent"],
+                100 * stats["echo"] / stats["sent"], 100 * stats["first_ack"] / max(stats["acked"], 1))
+        windows = {"{:02X}{:02X}".format(*key): self.idle_window(key) for key in self._gaps}
+        logger.info("bus idle after: %s", ", ".join("{} {:.1f}ms".format(k, v * 1000) for k, v in windows.items() if v is not None))
+
+
+bus_timing = BusTiming()
+
+# KTDO: 월패드 polling 주기 학습, 기준 패킷 (HEADER_0_FIRST) 부터 다음 기준 패킷까지를 한 주기로 봄
+POLL_QUERY_CMD = (0x01, 0x0F)
+POLL_SAMPLES = 16
+POLL_MIN_CYCLES = 3
+POLL_REPORT_INTERVAL = 60
+
+class PollSchedule:
+    # 월패드는 정해진 순서로 장치들을 조회함
+    # 주기, 조회 순서, 주기 시작부터 각 장치 (id, group) 조회까지의 시간 (offset) 과 그 흔들림 (jitter) 을 학습
+    def __init__(self):
+        self.reset()
+        self._report_time = 0
+
+    def reset(self):
+        # 기준 패킷이 바뀌면 처음부터 다시 학습
+        self._periods = deque(maxlen=POLL_SAMPLES)
+        self._offsets = {}
+        self._order = []
+        self._cycle = None
+        self._seen = {}
+        self.cycles = 0
+
+    def on_frame(self, packet, end_time, anchor):
+        start_time = end_time - len(packet) * bus_timing.byte_time()
+        if anchor:
+            self._end_cycle(start_time)
+
+        # 이번 주기에서 처음 조회된 시점만 기록
+        if self._cycle is not None and packet[3] in POLL_QUERY_CMD:
+            self._seen.setdefault((packet[1], packet[2]), start_time - self._cycle)
+
+    def _end_cycle(self, start_time):
+        if self._cycle is not None:
+            period = start_time - self._cycle
+            median = self.period()
+            # 기준 패킷을 놓쳐서 두 주기가 합쳐진 경우는 제외
+            if median is None or period < 1.5 * median:
+                self._periods.append(period)
+                for key, offset in self._seen.items():
+                    offsets = self._offsets.get(key)
+                    if offsets is None:
+                        offsets = self._offsets[key] = deque(maxlen=POLL_SAMPLES)
+                    offsets.append(offset)
+                self._order = sorted(self._seen, key=self._seen.get)
+                self.cycles += 1
+        self._cycle = start_time
+        self._seen = {}
+
+    def period(self):
+        # 학습 전이면 None
+        if len(self._periods) < POLL_MIN_CYCLES:
+            return None
+        return statistics.median(self._periods)
+
+    def time_to_poll(self, dev_id, grp, now, lead=0):
+        # 장치의 다음 조회까지 남은 시간, 명령과 ack가 오갈 시간 (lead) 만큼 앞당겨서 계산
+        # 그룹 단위로 조회하는 장치 (난방 1F 등) 는 같은 id의 조회 중 가장 빠른 것 사용
+        period = self.period()
+        if period is None:
+            return None
+        keys = [(dev_id, grp)] if (dev_id, grp) in self._offsets else [key for key in self._offsets if key[0] == dev_id]
+        waits = [(self._cycle + statistics.median(self._offsets[key]) - lead - now) % period for key in keys]
+        return min(waits) if waits else None
+
+    def report(self, now):
+        # 학습한 주기를 MQTT로 보냄 (diagnostics)
+        period = self.period()
+        if period is None or now - self._report_time < POLL_REPORT_INTERVAL:
+            return
+        self._report_time = now
+
+        order = []
+        for key in self._order:
+            offsets = self._offsets[key]
+            order.append({
+                "device": "{:02X}{:02X}".format(*key),
+                "name": QUERY_HEADER.get(key[0], ("unknown",))[0],
+                "offset": round(statistics.median(offsets) * 1000, 1),
+                "jitter": round(statistics.pstdev(offsets) * 1000, 1),
+            })
+        payload = {
+            "period": round(period * 1000, 1),
+            "period_jitter": round(statistics.pstdev(self._periods) * 1000, 1),
+            "cycles": self.cycles,
+            "order": order,
+        }
+        topic = "{}/diagnostics/poll_schedule".format(Options["mqtt"]["prefix"])
+        logger.info("poll schedule: period %.1fms, %s devices", payload["period"], len(order))
+        mqtt.publish(topic, json.dumps(payload), retain=True)
+
+
+poll_schedule = PollSchedule()
+
+# KTDO: 전체/그룹 명령 planner
+BROADCAST_REPEAT = 3
+BROADCAST_MIN_COMMANDS = 2
+BROADCAST_CONFIRM_TIME = 3
+
+class BroadcastPlanner:
+    # 대기중인 개별 명령들이 전체/그룹 명령과 결과가 같으면 broadcast 패킷 하나로 대체
+    # broadcast는 ACK가 없으므로 개별 장치의 상태로 확인하고, 확인 안되는 장치는 개별 명령으로 다시 보냄
+    def __init__(self):
+        # MQTT thread (discard) 와 serial thread에서 같이 접근
+        self._lock = threading.Lock()
+        self._confirm = {}
+
+    @staticmethod
+    def _topic(key):
+        return "{}/{}/{}/{}/state".format(Options["mqtt"]["prefix"], *key)
+
+    def plan(self, now):
+        for device, cmds in RS485_BROADCAST.items():
+            for cmd, code in cmds.items():
+                self._plan(device, cmd, code, now)
+
+    def _plan(self, device, cmd, code, now):
+        # 같은 장치/속성의 개별 명령을 그룹별로 (조명은 전체가 하나)
+        groups = {}
+        for key, packet, priority in serial_queue.entries(lambda key: len(key) == 3 and key[0] == device and key[2] == cmd and not key[1].endswith("all")):
+            grp = key[1].split("_")[0] if code["group"] else "all"
+            groups.setdefault(grp, []).append((key, packet, priority))
+
+        for grp, commands in groups.items():
+            values = {packet[code["pos"]] for key, packet, priority in commands}
+            if len(commands) < BROADCAST_MIN_COMMANDS or len(values) != 1:
+                continue
+            value = values.pop()
+            if value not in code["values"]:
+                continue
+
+            # 명령이 없는 장치는 이미 같은 상태여야 전체 명령과 결과가 같음
+            state = "ON" if value else "OFF"
+            targets = {self._topic(key): (key, packet, priority) for key, packet, priority in commands}
+            if any(topic not in targets and current != state and self._covers(topic, device, cmd, code, grp)
+                   for topic, current in list(last_topic_list.items())):
+                continue
+
+            bkey = (device, "all" if not code["group"] else "{}_all".format(grp), cmd)
+            packet = serial_make_broadcast(device, cmd, grp, value)
+            for key, cmd_packet, priority in commands:
+                if serial_queue.pop(key, cmd_packet) is None:
+                    targets.pop(self._topic(key))
+            serial_queue.put(bkey, packet, max(priority for key, cmd_packet, priority in commands), now, BROADCAST_REPEAT)
+
+            with self._lock:
+                # 아직 확인중인 같은 broadcast가 있으면 합침
+                confirm = self._confirm.get(bkey)
+                if confirm is not None and confirm["state"] == state:
+                    targets.update(confirm["targets"])
+                self._confirm[bkey] = {"state": state, "deadline": now + BROADCAST_CONFIRM_TIME, "targets": targets}
+            logger.info("broadcast:       %s commands -> %s", len(commands), LazyHex(packet))
+
+    @staticmethod
+    def _covers(topic, device, cmd, code, grp):
+        topics = topic.split("/")
+        return (len(topics) == 5 and topics[1] == device and topics[3] == cmd
+                and (not code["group"] or topics[2].split("_")[0] == grp))
+
+    def check(self, now):
+        # 목표 상태가 확인된 장치는 제외, 시간 내에 확인되지 않은 장치는 개별 명령으로
+        with self._lock:
+            for bkey, confirm in list(self._confirm.items()):
+                targets = confirm["targets"]
+                for topic in [topic for topic in targets if last_topic_list.get(topic) == confirm["state"]]:
+                    command_trace.finish(targets.pop(topic)[0], "acked")
+
+                if not targets:
+                    logger.info("broadcast done:  %s", "/".join(bkey))
+                    del self._confirm[bkey]
+
+                # 아직 다 보내지 못했으면 확인 시간을 미룸
+                elif bkey in serial_queue:
+                    confirm["deadline"] = now + BROADCAST_CONFIRM_TIME
+
+                # 개별 명령의 기록은 그대로 이어서 사용
+                elif now > confirm["deadline"]:
+                    logger.warning("broadcast not confirmed, send one by one: %s", ", ".join(targets))
+                    for key, packet, priority in targets.values():
+                        serial_queue.put(key, packet, priority, now, replace=False, merge=False)
+                    del self._confirm[bkey]
+
+    def sent(self, bkey):
+        # broadcast에는 기록이 없으므로 합친 개별 명령의 기록에 전송을 남김
+        with self._lock:
+            confirm = self._confirm.get(bkey)
+            keys = [key for key, packet, priority in confirm["targets"].values()] if confirm else []
+        for key in keys:
+            command_trace.sent(key)
+
+    def discard(self, key):
+        # 새 명령이 들어온 장치는 확인 대상에서 제외
+        if len(key) != 3:
+            return
+        topic = self._topic(key)
+        with self._lock:
+            for confirm in self._confirm.values():
+                confirm["targets"].pop(topic, None)
+
+
+broadcast_planner = BroadcastPlanner()
+
+# KTDO: 등록했던 장치 구성 (장치별 ID -> 데이터 길이) 과 discovery config의 hash를 파일로 저장
+#       재시작시 바뀐 config만 다시 등록하고, 알고 있는 장치는 첫 패킷부터 상태 전송
+class DiscoveryRegistry:
+    def __init__(self):
+        self.path = None
+        self.devices = {}
+        self.configs = {}
+        self._dirty = False
+
+    def load(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            self.devices = {device: {int(idn, 16): length for idn, length in ids.items()} for device, ids in data["devices"].items()}
+            self.configs = data["configs"]
+            logger.info("registry loaded: %s devices, %s configs", sum(len(ids) for ids in self.devices.values()), len(self.configs))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            logger.warning("ignore broken registry %s: %s", path, e)
+
+    def known(self, device, idn, length):
+        return self.devices.get(device, {}).get(idn) == length
+
+    def add(self, device, idn, length):
+        if not self.known(device, idn, length):
+            self.devices.setdefault(device, {})[idn] = length
+            self._dirty = True
+
+    def changed(self, topic, config):
+        # 이전에 같은 내용으로 등록했으면 False, 아니면 hash를 기록하고 True
+        digest = hashlib.sha1(config.encode()).hexdigest()
+        if self.configs.get(topic) == digest:
+            return False
+        self.configs[topic] = digest
+        self._dirty = True
+        return True
+
+    def save(self):
+        if not self._dirty or self.path is None:
+            return
+        data = {
+            "devices": {device: {"{:04x}".format(idn): length for idn, length in ids.items()} for device, ids in self.devices.items()},
+            "configs": self.configs,
+        }
+        try:
+            # 저장 중에 종료되어도 이전 파일은 남도록 임시 파일에 쓰고 교체
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(self.path + ".tmp", self.path)
+            self._dirty = False
+        except OSError as e:
+            logger.warning("registry save failed: %s", e)
+
+
+discovery_registry = DiscoveryRegistry()
+
+# KTDO: HA로 보낸 상태 값을 주기적으로 파일에 저장, 재시작시 불러와서 같은 값은 다시 보내지 않음
+#       pickle로 저장하고 임시 파일을 교체하므로 저장 중에 종료되어도 이전 파일은 남음
+#       파일 저장은 별도 thread에서 하므로 패킷 처리는 기다리지 않음
+class StateSnapshot:
+    def __init__(self):
+        self.path = None
+        self._last = None
+        self._lock = threading.Lock()
+
+    def load(self, path):
+        self.path = path
+        try:
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+            logger.info("state snapshot loaded: %s topics, %s docs", len(state["topics"]), len(state["docs"]))
+            return state
+        except FileNotFoundError:
+            pass
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError, KeyError) as e:
+            logger.warning("ignore broken state snapshot %s: %s", path, e)
+        return {"topics": {}, "docs": {}}
+
+    def save(self, state):
+        if self.path is None:
+            return
+        data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if data == self._last:
+                return
+            try:
+                with open(self.path + ".tmp", "wb") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(self.path + ".tmp", self.path)
+                self._last = data
+            except OSError as e:
+                logger.warning("state snapshot save failed: %s", e)
+
+    def start(self, interval, collect):
+        if self.path is None or interval <= 0:
+            return
+
+        def snapshot_loop():
+            while True:
+                time.sleep(interval)
+                self.save(collect())
+
+        threading.Thread(target=snapshot_loop, name="state-snapshot", daemon=True).start()
+
+
+state_snapshot = StateSnapshot()
+
+# KTDO: HA가 재시작되면 알고 있는 config와 마지막 상태를 정해진 속도로 다시 보냄
+#       장치마다 config 다음에 그 장치의 상태를 보내고, 조명 -> 난방 -> 나머지 -> 전체 명령 버튼 순서
+#       bus 쪽 중복 확인 상태는 건드리지 않으므로 discovery를 처음부터 다시 하지 않음
+#       이전 실행에서 같은 내용으로 등록한 config도 broker 연결마다 한번은 같은 속도로 다시 보냄
+#       (broker가 retain을 잃었거나 HA에서 장치를 지운 경우)
+REANNOUNCE_PRIORITY = ("light", "thermostat")
+REANNOUNCE_BURST = 5
+
+class Reannouncer:
+    def __init__(self):
+        # 등록한 config (topic -> json), 이전에 등록해서 다시 보내지 않은 config도 기억
+        self.configs = {}
+        # 이번 broker 연결에서 보낸 config topic
+        self.announced = set()
+        self._new_session = False
+        self._requested = False
+        self._session_requested = False
+        self._full = False
+        self._queue = deque()
+        self._tokens = 0
+        self._time = 0
+        self._start = 0
+        self._sent = {"config": 0, "state": 0}
+
+    def remember(self, topic, config):
+        self.configs[topic] = config
+
+    def request(self, once=False):
+        # MQTT thread에서 요청만 하고, 실제 전송은 serial thread에서
+        # once: 이번 연결에서 이미 요청했으면 무시
+        if once and self._session_requested:
+            return
+        self._session_requested = True
+        self._requested = True
+
+    def new_session(self):
+        # MQTT 연결시 (MQTT thread), 다음에 등록하는 config부터 다시 보냄
+        self._new_session = True
+        self._session_requested = False
+
+    def _check_session(self):
+        if self._new_session:
+            self._new_session = False
+            self.announced.clear()
+
+    def published(self, topic):
+        self._check_session()
+        self.announced.add(topic)
+
+    def announce(self, topic):
+        # 바로 보내지 않은 config (이전과 같은 내용) 를 이번 연결에서 처음 보는 경우 상태와 같이 보내도록 예약
+        self._check_session()
+        if topic not in self.announced:
+            self.announced.add(topic)
+            self._queue.append(("entity", topic))
+
+    def _states(self):
+        # state_json 모드는 문서만 보냄 (속성별 값은 중복 확인용으로만 갖고 있음)
+        # snapshot으로 불러온 값은 이번 실행에서 bus로 받기 전에는 보내지 않음
+        states = last_state_doc if Options["mqtt"]["state_json"] else last_topic_list
+        return [topic for topic in states if topic in state_seen]
+
+    @staticmethod
+    def _topics(config):
+        payload = json.loads(config)
+        base = payload.get("~", "")
+        return base, {value.replace("~", base) for key, value in payload.items() if key.endswith("_t") and isinstance(value, str)}
+
+    def _plan(self):
+        states = self._states()
+        entities = []
+        for topic, config in self.configs.items():
+            base, topics = self._topics(config)
+
+            device = base.split("/")[1] if base.count("/") else ""
+            if topic.split("/")[1] == "button":
+                order = len(REANNOUNCE_PRIORITY) + 1
+            elif device in REANNOUNCE_PRIORITY:
+                order = REANNOUNCE_PRIORITY.index(device)
+            else:
+                order = len(REANNOUNCE_PRIORITY)
+            entities.append((order, topic, topics))
+
+        # 같은 순위는 처음 등록한 순서대로
+        entities.sort(key=lambda entity: entity[0])
+
+        queue = deque()
+        done = set()
+        for order, topic, topics in entities:
+            queue.append(("config", topic))
+            for state in states:
+                if state in topics and state not in done:
+                    queue.append(("state", state))
+                    done.add(state)
+        queue.extend(("state", state) for state in states if state not in done)
+        return queue
+
+    def step(self, now):
+        self._check_session()
+        if self._requested:
+            self._requested = False
+            self._full = True
+            self._queue = self._plan()
+            self._tokens = REANNOUNCE_BURST
+            self._time = self._start = now
+            self._sent = {"config": 0, "state": 0}
+            logger.info("re-announce:     %s messages at %s/s", len(self._queue), Options["mqtt"]["reannounce_rate"])
+
+        if not self._queue and not self._full:
+            return
+
+        self._tokens = min(REANNOUNCE_BURST, self._tokens + (now - self._time) * Options["mqtt"]["reannounce_rate"])
+        self._time = now
+
+        while self._queue and self._tokens >= 1:
+            kind, topic = self._queue.popleft()
+
+            # 상태는 보내는 시점의 값으로 (그 사이 바뀐 값이 있으면 이미 보냈으므로 같은 값)
+            if kind == "entity":
+                # config 다음에 지금 알고 있는 그 장치의 상태
+                payload = self.configs.get(topic)
+                if payload is not None:
+                    topics = self._topics(payload)[1]
+                    self._queue.extendleft(reversed([("state", state) for state in self._states() if state in topics]))
+                kind = "config"
+            elif kind == "config":
+                self.announced.add(topic)
+                payload = self.configs.get(topic)
+            elif Options["mqtt"]["state_json"]:
+                payload = last_state_doc.get(topic)
+            else:
+                payload = last_topic_list.get(topic)
+            if payload is None:
+                continue
+
+            mqtt.publish(topic, payload, retain=kind == "config")
+            self._sent[kind] += 1
+            self._tokens -= 1
+
+        if not self._queue and self._full:
+            self._full = False
+            logger.info("re-announce done: %s configs, %s states in %.1f seconds", self._sent["config"], self._sent["state"], now - self._start)
+
+    def pending(self):
+        return len(self._queue)
+
+
+reannouncer = Reannouncer()
+
+# KTDO: HA 명령별 단계 시각 기록 (MQTT 수신 -> serial_queue -> 첫 전송 -> ack -> HA로 상태 전송), time.monotonic() 기준
+#       완료된 최근 TRACE_RING개로 장치 종류별 단계별 p50/p95/p99를 계산하고, 그 중 가장 느린 TRACE_SLOWEST개와 함께
+#       {prefix}/debug/trace/dump/command 요청시 {prefix}/debug/trace/state 로 보냄 (전체 명령은 기록하지 않음)
+TRACE_RING = 1000
+TRACE_SLOWEST = 20
+TRACE_STAGES = (("mqtt", "recv", "queued"), ("queue", "queued", "sent"), ("ack", "sent", "acked"), ("publish", "acked", "publish"))
+TRACE_PERCENTILES = (50, 95, 99)
+
+class CommandTrace:
+    def __init__(self):
+        # MQTT thread에서 시작하고 serial thread에서 단계 기록
+        self._lock = threading.Lock()
+        self._active = {}
+        self._done = deque(maxlen=TRACE_RING)
+
+    def start(self, key, payload, received):
+        # 같은 key의 이전 명령은 새 명령으로 대체되므로 기록도 버림
+        trace = {"key": "/".join(key), "device": key[0], "payload": payload, "time": time.time(), "sends": 0, "stages": {"recv": received}}
+        with self._lock:
+            self._active[key] = trace
+
+    def mark(self, key, stage):
+        trace = self._active.get(key)
+        if trace is not None:
+            trace["stages"].setdefault(stage, time.monotonic())
+
+    def sent(self, key):
+        trace = self._active.get(key)
+        if trace is not None:
+            trace["sends"] += 1
+            trace["stages"].setdefault("sent", time.monotonic())
+
+    def finish(self, key, result, stage="publish"):
+        now = time.monotonic()
+        with self._lock:
+            trace = self._active.pop(key, None)
+            if trace is None:
+                return
+            trace["stages"].setdefault(stage, now)
+            trace["result"] = result
+            trace["total"] = now - trace["stages"]["recv"]
+            self._done.append(trace)
+
+    def dump(self):
+        with self._lock:
+            done = list(self._done)
+
+        def percentiles(values):
+            values.sort()
+            result = {"count": len(values)}
+            for p in TRACE_PERCENTILES:
+                result["p{}".format(p)] = round(values[min(len(values) * p // 100, len(values) - 1)] * 1000, 1)
+            return result
+
+        # 장치 종류별 단계 시간 (ms)
+        samples = {}
+        for trace in done:
+            device = samples.setdefault(trace["device"], {})
+            stages = trace["stages"]
+            for name, begin, end in TRACE_STAGES:
+                if begin in stages and end in stages:
+                    device.setdefault(name, []).append(stages[end] - stages[begin])
+            device.setdefault("total", []).append(trace["total"])
+        stats = {device: {name: percentiles(values) for name, values in stages.items()} for device, stages in samples.items()}
+
+        slowest = []
+        for trace in sorted(done, key=lambda trace: trace["total"], reverse=True)[:TRACE_SLOWEST]:
+            recv = trace["stages"]["recv"]
+            slowest.append(dict(trace, total=round(trace["total"] * 1000, 1),
+                time=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(trace["time"])),
+                stages={stage: round((value - recv) * 1000, 1) for stage, value in trace["stages"].items()}))
+        return {"stats": stats, "slowest": slowest}
+
+
+command_trace = CommandTrace()
+
+# KTDO: bus capture, 받은 데이터 (raw), 분리한 패킷 (frame), 보낸 명령 (tx) 을 binary 파일로 계속 기록
+#       파일 형식은 capture_reader.py 참고: file header (magic, 기준 wall/monotonic 시각) 뒤에
+#       record header (기준부터 us, 방향/종류, 길이) + data 반복, mmap으로 앞에서부터 읽을 수 있음
+#       크기나 시간이 넘으면 새 파일로 바꾸고 (us가 32 bit를 넘지 않도록 최대 1시간), 오래된 파일은 keep_files개만 남김
+#       anomaly mode 에서는 최근 기록을 메모리 ring에만 두었다가, 이상 (checksum 오류, 명령 만료 등) 이 생기면
+#       ring 내용과 이후 ring 크기의 절반 만큼을 파일로 기록함
+#       serial thread에서만 기록하고, MQTT 요청은 다음 기록할 때 처리. 기록하지 않을 때는 active만 확인
+CAPTURE_MAGIC = b"EZCAP001"
+CAPTURE_FILE_HEADER = struct.Struct("<8sdd")
+CAPTURE_RECORD = struct.Struct("<IBH")
+CAPTURE_RX = 0x00
+CAPTURE_TX = 0x80
+CAPTURE_RAW = 0x01
+CAPTURE_FRAME = 0x02
+CAPTURE_MARK = 0x04
+CAPTURE_BUFFER = 65536
+CAPTURE_MAX_SPAN = 3600
+
+class BusCapture:
+    def __init__(self):
+        self.mode = "off"
+        self.active = False
+        self.path = None
+        self.records = 0
+        self.triggers = 0
+        self._file = None
+        self._size = 0
+        self._base = 0
+        self._ring = None
+        self._post = 0
+        self._until = 0
+        self._requested = None
+
+    def start(self, options):
+        self.mode = options["mode"]
+        self.path = options["path"]
+        self.max_size = options["max_size"] * 1024 * 1024
+        self.rotate_time = min(options["rotate_time"], CAPTURE_MAX_SPAN)
+        self.keep_files = options["keep_files"]
+        if self.mode == "anomaly":
+            self._ring = deque(maxlen=options["ring_records"])
+        self.active = self.mode != "off"
+        if self.active:
+            logger.info("bus capture (%s) to %s", self.mode, self.path)
+
+    def request(self, command, payload):
+        # MQTT thread에서 호출, flush 이면 ring을 파일로 기록, record 이면 payload 시간 (초) 동안 모두 기록
+        self._requested = (command, payload)
+        self.active = self.path is not None
+
+    def _take_request(self, now):
+        (command, payload), self._requested = self._requested, None
+        if command == "flush":
+            self.trigger("manual")
+            return
+        if command != "record":
+            logger.warning("unknown capture request: %s", command)
+            return
+        try:
+            seconds = float(payload)
+        except ValueError:
+            logger.warning("invalid capture time: %s", payload)
+            return
+        logger.warning("bus capture for %s seconds!", seconds)
+        self._until = now + seconds
+
+    def record(self, kind, data):
+        now = time.monotonic()
+        if self._requested is not None:
+            self._take_request(now)
+
+        if self.mode == "always" or now < self._until:
+            self._write(now, kind, data)
+        elif self._post:
+            self._post -= 1
+            self._write(now, kind, data)
+        elif self._ring is not None:
+            self._ring.append((now, kind, data))
+        elif self.mode == "off":
+            # 요청한 기록 시간이 끝남
+            self.active = False
+            self.flush()
+
+    def trigger(self, reason):
+        # 이상 발생 표시, anomaly mode 이면 그 전 기록도 같이 남김
+        now = time.monotonic()
+        if self.mode == "off" and now >= self._until:
+            return
+        self.triggers += 1
+        if self._ring is not None:
+            for now, kind, data in self._ring:
+                self._write(now, kind, data)
+            self._ring.clear()
+            self._post = self._ring.maxlen // 2
+        self._write(now, CAPTURE_MARK, reason.encode())
+
+    def _write(self, now, kind, data):
+        if self._file is None or self._size >= self.max_size or now - self._base >= self.rotate_time:
+            if not self._rotate(now):
+                return
+        self._file.write(CAPTURE_RECORD.pack(int((now - self._base) * 1000000), kind, len(data)))
+        self._file.write(data)
+        self._size += CAPTURE_RECORD.size + len(data)
+        self.records += 1
+
+    def _rotate(self, now):
+        # 지금 쓰는 record 시각을 파일의 기준 시각으로
+        self.close()
+        wall = time.time() - (time.monotonic() - now)
+        name = os.path.join(self.path, "ezville_{}_{:03d}.ezcap".format(time.strftime("%Y%m%d_%H%M%S", time.localtime(wall)), int(wall * 1000) % 1000))
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            self._file = open(name, "wb", buffering=CAPTURE_BUFFER)
+            self._file.write(CAPTURE_FILE_HEADER.pack(CAPTURE_MAGIC, wall, now))
+            self._size = CAPTURE_FILE_HEADER.size
+            self._base = now
+
+            files = sorted(f for f in os.listdir(self.path) if f.startswith("ezville_") and f.endswith(".ezcap"))
+            for f in files[:-self.keep_files]:
+                os.remove(os.path.join(self.path, f))
+            return True
+        except OSError as e:
+            # 디스크 문제면 기록 중단 (패킷 처리는 계속)
+            logger.error("bus capture stopped: %s", e)
+            self.close()
+            self.mode = "off"
+            self.active = False
+            self._ring = None
+            self._post = self._until = 0
+            return False
+
+    def flush(self):
+        if self._file is not None:
+            try:
+                self._file.flush()
+            except OSError as e:
+                logger.warning("bus capture flush failed: %s", e)
+
+    def close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+
+bus_capture = BusCapture()
+
+# KTDO: 동작 지표 (counter, gauge, histogram), Prometheus text format으로 HTTP 제공
+#       패킷마다 갱신하므로 lock 없이 값만 더하고, gauge와 다른 곳에서 세는 값은 scrape 할 때 읽음
+METRICS_ACK_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0)
+
+class MetricCounter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, count=1):
+        self.value += count
+
+
+class MetricHistogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        # 구간 상한은 포함 (le)
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._metrics = []
+
+    def counter(self, name, help, read=None):
+        # read가 있으면 다른 곳에서 세고 있는 값을 읽기만 함
+        counter = None
+        if read is None:
+            counter = MetricCounter()
+            read = lambda: counter.value
+        self._metrics.append((name, "counter", help, read))
+        return counter
+
+    def gauge(self, name, help, read):
+        self._metrics.append((name, "gauge", help, read))
+
+    def histogram(self, name, help, buckets):
+        histogram = MetricHistogram(buckets)
+        self._metrics.append((name, "histogram", help, histogram))
+        return histogram
+
+    def exposition(self):
+        lines = []
+        for name, kind, help, metric in self._metrics:
+            name = self.prefix + name
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            if kind == "histogram":
+                total = 0
+                for bound, count in zip(metric.buckets + ("+Inf",), metric.counts):
+                    total += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, total))
+                lines.append("{}_sum {}".format(name, metric.sum))
+                lines.append("{}_count {}".format(name, metric.count))
+            else:
+                value = metric()
+                lines.append("{} {}".format(name, "NaN" if value is None else value))
+        return "\n".join(lines) + "\n"
+
+    def values(self):
+        # MQTT diagnostics용, histogram은 개수와 평균만
+        values = {}
+        for name, kind, help, metric in self._metrics:
+            if kind == "histogram":
+                values[name + "_count"] = metric.count
+                values[name + "_avg"] = round(metric.sum / metric.count, 4) if metric.count else None
+            else:
+                values[name] = metric()
+        return values
+
+    def serve(self, port):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.exposition().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            server = ThreadingHTTPServer(("", port), MetricsHandler)
+        except OSError as e:
+            logger.warning("metrics server failed on port %s: %s", port, e)
+            return
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        logger.info("metrics:         http://0.0.0.0:%s/metrics", port)
+
+
+metrics = Metrics("ezville_wallpad_")
+metric_frames = metrics.counter("frames_total", "RS485 frames received")
+metric_checksum_errors = metrics.counter("checksum_errors_total", "RS485 frames dropped by checksum")
+metric_commands = metrics.counter("commands_total", "commands received from HA")
+metric_publishes = metrics.counter("mqtt_publishes_total", "MQTT messages published")
+metric_ack_latency = metrics.histogram("ack_latency_seconds", "time from command queued to device ack", METRICS_ACK_BUCKETS)
+metrics.counter("commands_sent_total", "command frames sent to the bus", lambda: bus_timing.stats["sent"])
+metrics.counter("command_retries_total", "command frames sent again without ack", lambda: serial_queue.retries)
+metrics.counter("commands_expired_total", "commands dropped after max_retry", lambda: serial_queue.expired)
+metrics.counter("commands_acked_total", "commands acked by device", lambda: bus_timing.stats["acked"])
+metrics.counter("commands_deferred_total", "sends deferred for a short bus idle window", lambda: bus_timing.stats["deferred"])
+metrics.counter("collisions_total", "sends followed by a checksum error", lambda: bus_timing.stats["garbled"])
+metrics.counter("capture_records_total", "records written to bus capture files", lambda: bus_capture.records)
+metrics.counter("capture_triggers_total", "anomalies marked in bus capture", lambda: bus_capture.triggers)
+metrics.counter("poll_cycles_total", "wallpad polling cycles", lambda: poll_schedule.cycles)
+metrics.gauge("serial_queue_depth", "commands waiting in serial_queue", lambda: len(serial_queue))
+metrics.gauge("ack_pending", "sent commands waiting for ack", lambda: len(serial_ack))
+metrics.gauge("poll_period_seconds", "learned wallpad polling period", lambda: poll_schedule.period())
+metrics.gauge("discovery_active", "1 while new devices are being discovered", lambda: int(Options["mqtt"]["_discovery"]))
+metrics.gauge("discovered_devices", "devices in the discovery registry", lambda: sum(len(ids) for ids in discovery_registry.devices.values()))
+metrics.gauge("discovery_configs", "discovery configs registered", lambda: len(discovery_registry.configs))
+metrics.gauge("reannounce_pending", "messages left to re-announce", lambda: reannouncer.pending())
+metrics.gauge("mqtt_connected", "1 while connected to the MQTT broker", lambda: int(mqtt_connected))
+
+# KTDO: Serial/Socket 공용 버퍼 기반 패킷 분리
+class EzVilleFrameReader:
+    # 받을 수 있는 만큼 한번에 받아서 버퍼에 쌓아두고, 버퍼 안에서 패킷 단위로 잘라서 넘겨준다
+    def __init__(self):
+        self._recv_buf = bytearray()
+        self._recv_pos = 0
+        self._pending_recv = 0
+
+        # KTDO: 마지막으로 데이터를 받은 시각 (버퍼에서 꺼낸 패킷의 끝 시각으로 사용), checksum 오류 수
+        self.recv_time = 0
+        self.checksum_errors = 0
+
+    def _recv_bulk(self):
+        raise NotImplementedError
+
+    def _in_waiting(self):
+        return 0
+
+    def feed(self, data):
+        # 이미 처리한 앞부분은 새 데이터가 들어올 때 한번에 정리
+        if self._recv_pos:
+            del self._recv_buf[:self._recv_pos]
+            self._recv_pos = 0
+        if data:
+            self._recv_buf += data
+            self.recv_time = time.time()
+            if bus_capture.active:
+                bus_capture.record(CAPTURE_RX | CAPTURE_RAW, data)
+
+    def _consume(self, pos):
+        self._pending_recv = max(self._pending_recv - (pos - self._recv_pos), 0)
+        self._recv_pos = pos
+
+    def next_frame(self):
+        # 버퍼에 완성된 패킷이 있으면 checksum 확인 후 반환, 없으면 None
+        buf = self._recv_buf
+        pos = self._recv_pos
+        while True:
+            # 시작 F7 찾기, 없으면 버퍼 전체 버림
+            start = buf.find(0xF7, pos)
+            if start < 0:
+                self._consume(len(buf))
+                return None
+
+            # 데이터 길이 Byte까지 아직 못 받았거나, 데이터 길이 + 2 (XOR + ADD) 만큼 못 받았으면 대기
+            if len(buf) - start < 5:
+                self._consume(start)
+                return None
+            end = start + 5 + buf[start + 4] + 2
+            if end > len(buf):
+                self._consume(start)
+                return None
+
+            # checksum 오류면 다음 F7 부터 다시 찾음 (중간에 corrupt된 패킷 무시)
+            frame = bytes(buf[start:end])
+            if not serial_verify_checksum(frame):
+                self.checksum_errors += 1
+                bus_capture.trigger("checksum")
+                pos = start + 1
+                continue
+
+            self._consume(end)
+            if bus_capture.active:
+                bus_capture.record(CAPTURE_RX | CAPTURE_FRAME, frame)
+            return frame
+
+    def get_frame(self):
+        # 완성된 패킷이 나올 때까지 대기
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            self.feed(self._recv_bulk())
+
+    def recv(self, count=1):
+        # 버퍼에 남은 데이터부터 돌려줌 (dump 용도)
+        if len(self._recv_buf) - self._recv_pos < count:
+            self.feed(self._recv_bulk())
+
+        end = min(self._recv_pos + count, len(self._recv_buf))
+        res = bytes(self._recv_buf[self._recv_pos:end])
+        self._consume(end)
+        return res
+
+    def recv_nowait(self):
+        # non-blocking 모드에서 지금 받을 수 있는 만큼만 받음
+        try:
+            return self._recv_bulk()
+        except BlockingIOError:
+            return b""
+
+    def buffered(self):
+        # 아직 처리하지 않은 데이터 크기 (OS 버퍼 포함)
+        return len(self._recv_buf) - self._recv_pos + self._in_waiting()
+
+    def set_pending_recv(self):
+        self._pending_recv = len(self._recv_buf) - self._recv_pos + self._in_waiting()
+
+    def check_pending_recv(self):
+        return self._pending_recv
+
 # KTDO: 수정 완료
-class EzVilleSerial:
+class EzVilleSerial(EzVilleFrameReader):
     def __init__(self):
+        super().__init__()
+
         self._ser = serial.Serial()
         self._ser.port = Options["serial"]["port"]
         self._ser.baudrate = Options["serial"]["baudrate"]
@@ -419,8 +1719,6 @@ class EzVilleSerial:
         self._ser.close()
         self._ser.open()
 
-        self._pending_recv = 0
-
         # 시리얼에 뭐가 떠다니는지 확인
         self.set_timeout(5.0)
         data = self._recv_raw(1)
@@ -431,38 +1729,39 @@ class EzVilleSerial:
     def _recv_raw(self, count=1):
         return self._ser.read(count)
 
-    def recv(self, count=1):
-        # serial은 pending count만 업데이트
-        self._pending_recv = max(self._pending_recv - count, 0)
-        return self._recv_raw(count)
+    def _recv_bulk(self):
+        # 쌓여있는 만큼 한번에 읽음, 없으면 1 Byte 올 때까지 대기
+        return self._ser.read(max(self._ser.in_waiting, 1))
+
+    def _in_waiting(self):
+        return self._ser.in_waiting
 
     def send(self, a):
         self._ser.write(a)
 
-    def set_pending_recv(self):
-        self._pending_recv = self._ser.in_waiting
-
-    def check_pending_recv(self):
-        return self._pending_recv
-
     def check_in_waiting(self):
         return self._ser.in_waiting
 
     def set_timeout(self, a):
         self._ser.timeout = a
 
+    def set_nonblocking(self):
+        self._ser.timeout = 0
+
+    def fileno(self):
+        return self._ser.fileno()
+
 # KTDO: 수정 완료
-class EzVilleSocket:
+class EzVilleSocket(EzVilleFrameReader):
     def __init__(self):
+        super().__init__()
+
         addr = Options["socket"]["address"]
         port = Options["socket"]["port"]
 
         self._soc = socket.socket()
         self._soc.connect((addr, port))
 
-        self._recv_buf = bytearray()
-        self._pending_recv = 0
-
         # 소켓에 뭐가 떠다니는지 확인
         self.set_timeout(5.0)
         data = self._recv_raw(1)
@@ -473,49 +1772,49 @@ class EzVilleSocket:
     def _recv_raw(self, count=1):
         return self._soc.recv(count)
 
-    def recv(self, count=1):
-        # socket은 버퍼와 in_waiting 직접 관리
-        if len(self._recv_buf) < count:
-            new_data = self._recv_raw(256)
-            self._recv_buf.extend(new_data)
-        if len(self._recv_buf) < count:
-            return None
-
-        self._pending_recv = max(self._pending_recv - count, 0)
-
-        res = self._recv_buf[0:count]
-        del self._recv_buf[0:count]
-        return res
+    def _recv_bulk(self):
+        data = self._soc.recv(4096)
+        # 연결이 끊긴 경우 재시도해봐야 소용 없음
+        if not data:
+            raise EOFError("socket closed by peer")
+        return data
 
     def send(self, a):
         self._soc.sendall(a)
 
-    def set_pending_recv(self):
-        self._pending_recv = len(self._recv_buf)
-
-    def check_pending_recv(self):
-        return self._pending_recv
-
     def check_in_waiting(self):
-        if len(self._recv_buf) == 0:
-            new_data = self._recv_raw(256)
-            self._recv_buf.extend(new_data)
-        return len(self._recv_buf)
+        if len(self._recv_buf) == self._recv_pos:
+            self.feed(self._recv_bulk())
+        return len(self._recv_buf) - self._recv_pos
 
     def set_timeout(self, a):
         self._soc.settimeout(a)
 
+    def set_nonblocking(self):
+        self._soc.setblocking(False)
+
+    def fileno(self):
+        return self._soc.fileno()
+
 # KTDO: 수정 완료
 def init_logger():
+    global log_listener
     logger.setLevel(logging.INFO)
 
     formatter = logging.Formatter(fmt="%(asctime)s %(levelname)-8s %(message)s", datefmt="%H:%M:%S")
     handler = logging.StreamHandler()
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+
+    # KTDO: 실제 출력은 log_listener thread에서, 종료시 남은 로그는 모두 출력
+    log_listener = QueueListener(log_handler.queue, handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    logger.addHandler(log_handler)
 
 # KTDO: 수정 완료
 def init_logger_file():
+    log_rate_limit.rate = Options["log"]["rate_limit"]
+
     if Options["log"]["to_file"]:
         filename = Options["log"]["filename"]
         os.makedirs(os.path.dirname(filename), exist_ok=True)
@@ -524,7 +1823,11 @@ def init_logger_file():
         handler = TimedRotatingFileHandler(os.path.abspath(Options["log"]["filename"]), when="midnight", backupCount=7)
         handler.setFormatter(formatter)
         handler.suffix = '%Y%m%d'
-        logger.addHandler(handler)
+
+        # KTDO: 파일도 log_listener thread에서 출력 (잠시 멈추고 handler 추가)
+        log_listener.stop()
+        log_listener.handlers += (handler,)
+        log_listener.start()
 
 # KTDO: 수정 완료
 def init_option(argv):
@@ -543,7 +1846,7 @@ def init_option(argv):
 
     with open(default_file) as f:
         config = json.load(f)
-        logger.info("addon version {}".format(config["version"]))
+        logger.info("addon version %s", config["version"])
         Options = config["options"]
     with open(option_file) as f:
         Options2 = json.load(f)
@@ -554,10 +1857,10 @@ def init_option(argv):
             Options[k].update(Options2[k])
             for k2 in Options[k].keys():
                 if k2 not in Options2[k].keys():
-                    logger.warning("no configuration value for '{}:{}'! try default value ({})...".format(k, k2, Options[k][k2]))
+                    logger.warning("no configuration value for '%s:%s'! try default value (%s)...", k, k2, Options[k][k2])
         else:
             if k not in Options2:
-                logger.warning("no configuration value for '{}'! try default value ({})...".format(k, Options[k]))
+                logger.warning("no configuration value for '%s'! try default value (%s)...", k, Options[k])
             else:
                 Options[k] = Options2[k]
 
@@ -569,6 +1872,15 @@ def init_option(argv):
     # internal options
     Options["mqtt"]["_discovery"] = Options["mqtt"]["discovery"]
 
+    # KTDO: 등록했던 장치 정보는 설정 파일과 같은 경로 (/data) 에 저장
+    discovery_registry.load(os.path.join(os.path.dirname(os.path.abspath(option_file)), "ezville_wallpad_registry.json"))
+
+    # KTDO: 이전 실행에서 보낸 상태 값을 불러와서 명령 확인 (broadcast 대상 등) 에 사용, HA에는 처음 받은 값을 한번 보냄
+    if Options["mqtt"]["snapshot_interval"] > 0:
+        state = state_snapshot.load(os.path.join(os.path.dirname(os.path.abspath(option_file)), "ezville_wallpad_state.pickle"))
+        last_topic_list.update(state["topics"])
+        last_state_doc.update(state["docs"])
+
 
 #def init_virtual_device():
 #    global virtual_watch
@@ -617,9 +1929,19 @@ def mqtt_discovery(payload):
     payload["uniq_id"] = payload["name"]
 
     # discovery에 등록
+    # KTDO: 이전에 같은 내용으로 등록했으면 생략, 재시작 후에도 HA가 config를 갖고 있도록 retain
     topic = "homeassistant/{}/ezville_wallpad/{}/config".format(intg, payload["name"])
-    logger.info("Add new device:  {}".format(topic))
-    mqtt.publish(topic, json.dumps(payload))
+    config = json.dumps(payload)
+    reannouncer.remember(topic, config)
+    if not discovery_registry.changed(topic, config):
+        # KTDO: 상태는 바로 보내고, config는 이번 broker 연결에서 한번 정해진 속도로 다시 보냄
+        reannouncer.announce(topic)
+        return False
+
+    logger.info("Add new device:  %s", topic)
+    mqtt.publish(topic, config, retain=True)
+    reannouncer.published(topic)
+    return True
 
 
 #def mqtt_add_virtual():
@@ -718,12 +2040,24 @@ def mqtt_debug(topics, payload):
             packet[-2], packet[-1] = serial_generate_checksum(packet)
             packet = bytes(packet)
 
-            logger.info("prepare packet:  {}".format(packet.hex()))
-            serial_queue[packet] = time.time()
+            logger.info("prepare packet:  %s", LazyHex(packet))
+            serial_enqueue(("packet", packet), packet)
+
+    # KTDO: 명령 단계별 시간 기록 요청
+    elif device == "trace":
+        if command == "dump":
+            trace = command_trace.dump()
+            topic = "{}/debug/trace/state".format(Options["mqtt"]["prefix"])
+            logger.info("command trace:   %s devices, %s slowest", len(trace["stats"]), len(trace["slowest"]))
+            mqtt.publish(topic, json.dumps(trace))
+
+    # KTDO: bus capture 요청, flush 이면 ring을 파일로 기록, record 이면 payload 시간 (초) 동안 모두 기록
+    elif device == "capture":
+        bus_capture.request(command, payload)
 
             
 # KTDO: 수정 완료
-def mqtt_device(topics, payload):
+def mqtt_device(topics, payload, received=None):
     device = topics[1]
     idn = topics[2]
     cmd = topics[3]
@@ -742,6 +2076,11 @@ def mqtt_device(topics, payload):
     elif payload == "heat": payload = "1"
     elif payload == "off": payload = "0"
 
+    # KTDO: 전체 명령
+    if idn == "all":
+        mqtt_broadcast(device, topics[3], payload)
+        return
+
     # 오류 체크 끝났으면 serial 메시지 생성
     cmd = RS485_DEVICE[device][cmd]
     
@@ -783,40 +2122,77 @@ def mqtt_device(topics, payload):
     #packet[-1] = serial_generate_checksum(packet)
     #packet = bytes(packet)
     
-    serial_queue[packet] = time.time()
+    # KTDO: 같은 장치/속성의 명령은 하나만 유지
+    key = (device, idn, topics[3])
+    command_trace.start(key, payload, received or time.monotonic())
+    serial_enqueue(key, packet, cmd.get("priority", 0))
 
 
-# KTDO: 수정 완료
-def mqtt_init_discovery():
-    # HA가 재시작됐을 때 모든 discovery를 다시 수행한다
-    Options["mqtt"]["_discovery"] = Options["mqtt"]["discovery"]
-# KTDO: Virtual Device는 Skip
-#    mqtt_add_virtual()
-    for device in RS485_DEVICE:
-        RS485_DEVICE[device]["last"] = {}
+# KTDO: 전체 명령, 상태를 알고 있는 장치 전체에 대한 개별 명령으로 넣으면 보내기 전에 broadcast로 합쳐짐
+def mqtt_broadcast(device, cmd, payload):
+    code = RS485_BROADCAST.get(device, {}).get(cmd)
+    if code is None or int(float(payload)) not in code["values"]:
+        logger.error("    unsupported broadcast!"); return
+
+    prefix = Options["mqtt"]["prefix"]
+    topics = [topic.split("/") for topic in list(last_topic_list)]
+    topics = [topic for topic in topics if len(topic) == 5 and topic[0] == prefix and topic[1] == device and topic[3] == cmd]
+
+    # 아직 상태를 받은 장치가 없으면 바로 broadcast (난방은 1번 그룹)
+    if not topics:
+        value = int(float(payload))
+        bkey = (device, "all" if not code["group"] else "1_all", cmd)
+        serial_enqueue(bkey, serial_make_broadcast(device, cmd, "1", value), RS485_DEVICE[device][cmd].get("priority", 0), BROADCAST_REPEAT)
+        return
+
+    for topic in topics:
+        mqtt_device([prefix, device, topic[2], cmd, "command"], payload)
+
+
+# KTDO: 명령을 serial queue에 넣음, asyncio 모드에서는 loop thread로 넘겨서 넣음
+#       같은 key의 명령이 이미 대기중이면 순서는 유지하고 새 명령으로 대체 (재시도 시간도 새로 시작)
+def serial_enqueue(key, packet, priority=0, repeat=1):
+    broadcast_planner.discard(key)
+    if serial_event_loop is not None:
+        serial_event_loop.call_soon_threadsafe(serial_command_queue.put_nowait, (key, packet, priority, repeat))
+    else:
+        serial_queue.put(key, packet, priority, repeat=repeat)
+        command_trace.mark(key, "queued")
+
+
+# KTDO: 저장된 상태 값 중 해당 장치 (조명은 방, 난방은 그룹) 의 값을 지워서 다음 상태를 다시 보내도록 함
+def serial_forget_state(device, packet):
+    base = "{}/{}/{}".format(Options["mqtt"]["prefix"], device, packet[2] >> 4)
+    if device == "light":
+        base += "_{}".format(packet[2] & 0x0F)
 
-    global last_topic_list
-    last_topic_list = {}
+    for cache in (last_topic_list, last_state_doc):
+        for topic in [topic for topic in cache if topic.startswith(base + "_") or topic.startswith(base + "/")]:
+            del cache[topic]
 
     
 # KTDO: 수정 완료
 def mqtt_on_message(mqtt, userdata, msg):
+    received = time.monotonic()
     topics = msg.topic.split("/")
     payload = msg.payload.decode()
 
-    logger.info("recv. from HA:   {} = {}".format(msg.topic, payload))
+    logger.info("recv. from HA:   %s = %s", msg.topic, payload)
 
     device = topics[1]
     if device == "status":
         if payload == "online":
-            mqtt_init_discovery()
+            # KTDO: HA가 재시작된 경우 (retain 아닌 birth message) config와 상태를 정해진 속도로 다시 보냄
+            #       retain된 birth message는 subscribe할 때마다 오므로 연결시 요청한 것과 합침
+            reannouncer.request(once=msg.retain)
 # KTDO: Virtual Device는 Skip
 #    elif device == "virtual":
 #        mqtt_virtual(topics, payload)
     elif device == "debug":
         mqtt_debug(topics, payload)
     else:
-        mqtt_device(topics, payload)
+        metric_commands.inc()
+        mqtt_device(topics, payload, received)
 
         
 # KTDO: 수정 완료
@@ -826,12 +2202,15 @@ def mqtt_on_connect(mqtt, userdata, flags, rc):
         global mqtt_connected
         mqtt_connected = True
     else:
-        logger.error("MQTT connection return with:  {}".format(paho_mqtt.connack_string(rc)))
+        logger.error("MQTT connection return with:  %s", paho_mqtt.connack_string(rc))
 
-    mqtt_init_discovery()
+    # KTDO: broker가 재시작되어 retain된 config를 잃었을 수 있으므로 이번 연결에서 다시 등록
+    #       bus 쪽 중복 확인 값 (장치별 last, 보낸 상태 값) 은 그대로 두고 정해진 속도로 다시 보냄
+    reannouncer.new_session()
+    reannouncer.request()
 
     topic = "homeassistant/status"
-    logger.info("subscribe {}".format(topic))
+    logger.info("subscribe %s", topic)
     mqtt.subscribe(topic, 0)
 
     prefix = Options["mqtt"]["prefix"]
@@ -842,16 +2221,20 @@ def mqtt_on_connect(mqtt, userdata, flags, rc):
 #        mqtt.subscribe(topic, 0)
     if Options["wallpad_mode"] != "off":
         topic = "{}/+/+/+/command".format(prefix)
-        logger.info("subscribe {}".format(topic))
+        logger.info("subscribe %s", topic)
         mqtt.subscribe(topic, 0)
 
         
 # KTDO: 수정 완료
 def mqtt_on_disconnect(mqtt, userdata, rc):
-    logger.warning("MQTT disconnected! ({})".format(rc))
+    logger.warning("MQTT disconnected! (%s)", rc)
     global mqtt_connected
     mqtt_connected = False
 
+# KTDO: 보낸 MQTT 메시지 수 (metrics)
+def mqtt_on_publish(mqtt, userdata, mid):
+    metric_publishes.inc()
+
 # KTDO: 수정 완료
 def start_mqtt_loop():
     logger.info("initialize mqtt...")
@@ -859,6 +2242,7 @@ def start_mqtt_loop():
     mqtt.on_message = mqtt_on_message
     mqtt.on_connect = mqtt_on_connect
     mqtt.on_disconnect = mqtt_on_disconnect
+    mqtt.on_publish = mqtt_on_publish
 
     if Options["mqtt"]["need_login"]:
         mqtt.username_pw_set(Options["mqtt"]["user"], Options["mqtt"]["passwd"])
@@ -866,7 +2250,7 @@ def start_mqtt_loop():
     try:
         mqtt.connect(Options["mqtt"]["server"], Options["mqtt"]["port"])
     except Exception as e:
-        logger.error("MQTT server address/port may be incorrect! ({})".format(str(e)))
+        logger.error("MQTT server address/port may be incorrect! (%s)", str(e))
         sys.exit(1)
 
     mqtt.loop_start()
@@ -993,9 +2377,7 @@ def start_mqtt_loop():
 def serial_verify_checksum(packet):
     # 모든 byte를 XOR
     # KTDO: 마지막 ADD 빼고 XOR
-    checksum = 0
-    for b in packet[:-1]:
-        checksum ^= b
+    checksum = reduce(xor, packet[:-1], 0)
         
     # KTDO: ADD 계산
     add = sum(packet[:-1]) & 0xFF
@@ -1007,7 +2389,8 @@ def serial_verify_checksum(packet):
     # checksum이 안맞으면 로그만 찍고 무시
     # KTDO: ADD 까지 맞아야함.
     if checksum or add != packet[-1]:
-        logger.warning("checksum fail! {}, {:02x}, {:02x}".format(packet.hex(), checksum, add))
+        metric_checksum_errors.inc()
+        logger.warning("checksum fail! %s, %02x, %02x", LazyHex(packet), checksum, add)
         return False
 
     # 정상
@@ -1032,6 +2415,17 @@ def serial_generate_checksum(packet):
 #    return checksumadd
     return checksum, add
 
+# KTDO: 전체/그룹 명령 패킷 생성
+def serial_make_broadcast(device, cmd, grp, value):
+    code = RS485_BROADCAST[device][cmd]
+    if device == "light":
+        packet = bytearray([0xF7, code["id"], 0xFF, code["cmd"], 0x03, 0xFF, value, 0x00, 0x00, 0x00])
+    elif device == "thermostat":
+        packet = bytearray([0xF7, code["id"], int(grp) << 4 | 0x0F, code["cmd"], 0x01, value, 0x00, 0x00])
+    packet[-2], packet[-1] = serial_generate_checksum(packet)
+    return bytes(packet)
+
+
 # KTDO: 코멘트 처리 
 #def serial_peek_value(device, packet):
 #    attr, pos, pattern = parse
@@ -1070,6 +2464,17 @@ def serial_generate_checksum(packet):
 # KTDO: 수정 완료
 def serial_new_device(device, packet):
     prefix = Options["mqtt"]["prefix"]
+    # KTDO: 새로 등록한 (바뀐) config가 있으면 True
+    new = False
+
+    # KTDO: 전체 명령 버튼은 이번 discovery에서 처음 발견된 장치와 같이 등록
+    if device in DISCOVERY_BROADCAST and not RS485_DEVICE[device]["last"]:
+        for payloads in DISCOVERY_BROADCAST[device]:
+            payload = payloads.copy()
+            payload["~"] = payload["~"].format(prefix=prefix)
+            payload["name"] = payload["name"].format(prefix=prefix)
+
+            new |= mqtt_discovery(payload)
 
     # 조명은 두 id를 조합해서 개수와 번호를 정해야 함
     if device == "light":
@@ -1086,8 +2491,9 @@ def serial_new_device(device, packet):
             payload = DISCOVERY_PAYLOAD[device][0].copy()
             payload["~"] = payload["~"].format(prefix=prefix, grp=grp_id, rm=rm_id, id=id)
             payload["name"] = payload["name"].format(prefix=prefix, grp=grp_id, rm=rm_id, id=id)
+            serial_state_json_discovery(device, payload, grp=grp_id, rm=rm_id, id=id)
 
-            mqtt_discovery(payload)
+            new |= mqtt_discovery(payload)
             
     elif device == "thermostat":
         # KTDO: EzVille에 맞게 수정
@@ -1098,8 +2504,9 @@ def serial_new_device(device, packet):
             payload = DISCOVERY_PAYLOAD[device][0].copy()
             payload["~"] = payload["~"].format(prefix=prefix, grp=grp_id, id=id)
             payload["name"] = payload["name"].format(prefix=prefix, grp=grp_id, id=id)
+            serial_state_json_discovery(device, payload, grp=grp_id, id=id)
 
-            mqtt_discovery(payload)
+            new |= mqtt_discovery(payload)
 
 #    elif device in DISCOVERY_PAYLOAD:
 #        for payloads in DISCOVERY_PAYLOAD[device]:
@@ -1116,6 +2523,46 @@ def serial_new_device(device, packet):
 #
 #            mqtt_discovery(payload)
 
+    return new
+
+# KTDO: state_json 모드면 개별 state topic을 JSON 문서와 template으로 바꿈
+def serial_state_json_discovery(device, payload, **ids):
+    if not Options["mqtt"]["state_json"]:
+        return
+
+    for key, value in DISCOVERY_STATE_JSON[device].items():
+        payload[key] = value.format(prefix=Options["mqtt"]["prefix"], **ids)
+
+
+# KTDO: state_json 모드, 문서 전체가 이전에 보낸 것과 같으면 생략
+def serial_publish_state_doc(topic, doc, packet):
+    payload = json.dumps(doc, sort_keys=True)
+    if last_state_doc.get(topic) == payload and topic in state_seen:
+        return
+
+    logger.info("publish to HA:   %s = %s (%s)", topic, payload, LazyHex(packet))
+    mqtt.publish(topic, payload)
+    last_state_doc[topic] = payload
+    state_seen.add(topic)
+
+
+# KTDO: 속성별 상태, 이전 값과 같으면 생략 (state_json 모드는 값만 기록)
+def serial_publish_state(topic, value, packet, state_json):
+    if last_topic_list.get(topic) == value and topic in state_seen:
+        return
+
+    if not state_json:
+        logger.info("publish to HA:   %s = %s (%s)", topic, value, LazyHex(packet))
+        mqtt.publish(topic, value)
+    last_topic_list[topic] = value
+    state_seen.add(topic)
+
+
+# KTDO: snapshot 저장용 상태 값 복사 (dict 복사는 한번에 일어나므로 thread에서 불러도 안전)
+def serial_snapshot_state():
+    return {"topics": dict(last_topic_list), "docs": dict(last_state_doc)}
+
+
 # KTDO: 수정 완료
 def serial_receive_state(device, packet):
     form = RS485_DEVICE[device]["state"]
@@ -1126,13 +2573,19 @@ def serial_receive_state(device, packet):
     #else:
     #    idn = 1
     idn = (packet[1] << 8) | packet[2]
+    # KTDO: 난방 ACK (C4) 는 방 번호 (예: 11) 로, 상태 응답은 그룹 전체 (1F) 로 오므로 그룹 기준으로 맞춤
+    if device == "thermostat":
+        idn |= 0x0F
 
     # 해당 ID의 이전 상태와 같은 경우 바로 무시
-    if last.get(idn) == packet:
+    # KTDO: 상태 응답 (81) 과 ACK (C1, C4) 는 명령 Byte만 다르므로 데이터만 비교
+    data = packet[4:-2]
+    if last.get(idn) == data:
         return
 
     # 처음 받은 상태인 경우, discovery 용도로 등록한다.
-    if Options["mqtt"]["_discovery"] and not last.get(idn):
+    # KTDO: 이전 실행에서 등록했던 장치 (같은 구성) 는 discovery 시간이 지나도 등록 (비트가 튄 장치가 아님)
+    if not last.get(idn) and (Options["mqtt"]["_discovery"] or discovery_registry.known(device, idn, packet[4])):
         # 전등 때문에 last query도 필요... 지금 패킷과 일치하는지 검증
         # gas valve는 일치하지 않는다
         # KTDO: EzVille은 표준 기반이라 Query와 비교 필요 없음.
@@ -1140,22 +2593,28 @@ def serial_receive_state(device, packet):
         #    serial_new_device(device, idn, packet)
         #    last[idn] = True
         
-        serial_new_device(device, packet)
-        last[idn] = True
+        discovery_registry.add(device, idn, packet[4])
 
         # 장치 등록 먼저 하고, 상태 등록은 그 다음 턴에 한다. (난방 상태 등록 무시되는 현상 방지)
-        return
+        # KTDO: 바뀐 config가 없으면 (이전에 등록한 그대로) 바로 상태 전송
+        #       새로 등록한 장치는 이전 실행에서 보낸 값과 같아도 상태를 다시 보냄
+        if serial_new_device(device, packet):
+            serial_forget_state(device, packet)
+            last[idn] = True
+            return
 
-    else:
-        last[idn] = packet
+    last[idn] = data
 
 # KTDO: 아래 코드로 값을 바로 판별
     prefix = Options["mqtt"]["prefix"]
+    # KTDO: state_json 모드에서는 개별 topic 대신 문서로 모아서 한번에 publish
+    state_json = Options["mqtt"]["state_json"]
     
     if device == "light":
         grp_id = int(packet[2] >> 4)
         rm_id = int(packet[2] & 0x0F)
         light_count = int(packet[4]) - 1
+        doc = {}
         
         for id in range(1, light_count + 1):
             topic = "{}/{}/{}_{}_{}/power/state".format(prefix, device, grp_id, rm_id, id)
@@ -1165,10 +2624,11 @@ def serial_receive_state(device, packet):
             else:
                 value = "OFF"
                 
-            if last_topic_list.get(topic) != value:
-                logger.info("publish to HA:   {} = {} ({})".format(topic, value, packet.hex()))
-                mqtt.publish(topic, value)
-                last_topic_list[topic] = value
+            doc[str(id)] = value
+            serial_publish_state(topic, value, packet, state_json)
+
+        if state_json:
+            serial_publish_state_doc("{}/{}/{}_{}/state".format(prefix, device, grp_id, rm_id), doc, packet)
             
     elif device == "thermostat":
         grp_id = int(packet[2] >> 4)
@@ -1180,33 +2640,26 @@ def serial_receive_state(device, packet):
             topic3 = "{}/{}/{}_{}/target/state".format(prefix, device, grp_id, id)
             topic4 = "{}/{}/{}_{}/current/state".format(prefix, device, grp_id, id)
             
-            if ((packet[6] & 0x1F) >> (room_count - id)) & 1:
+            # KTDO: 1번 방이 BIT 0 (simple_mqtt_ezville_control과 같은 순서)
+            if ((packet[6] & 0x1F) >> (id - 1)) & 1:
                 value1 = "ON"
             else:
                 value1 = "OFF"
-            if ((packet[7] & 0x1F) >> (room_count - id)) & 1:
+            if ((packet[7] & 0x1F) >> (id - 1)) & 1:
                 value2 = "ON"
             else:
                 value2 = "OFF"
             value3 = packet[8 + id * 2]
             value4 = packet[9 + id * 2]
             
-            if last_topic_list.get(topic1) != value1:
-                logger.info("publish to HA:   {} = {} ({})".format(topic1, value1, packet.hex()))
-                mqtt.publish(topic1, value1)
-                last_topic_list[topic1] = value1
-            if last_topic_list.get(topic2) != value2:
-                logger.info("publish to HA:   {} = {} ({})".format(topic2, value2, packet.hex()))
-                mqtt.publish(topic2, value2)
-                last_topic_list[topic2] = value2
-            if last_topic_list.get(topic3) != value3:
-                logger.info("publish to HA:   {} = {} ({})".format(topic3, value3, packet.hex()))
-                mqtt.publish(topic3, value3)
-                last_topic_list[topic3] = value3
-            if last_topic_list.get(topic4) != value4:
-                logger.info("publish to HA:   {} = {} ({})".format(topic4, value4, packet.hex()))
-                mqtt.publish(topic4, value4)
-                last_topic_list[topic4] = value4
+            serial_publish_state(topic1, value1, packet, state_json)
+            serial_publish_state(topic2, value2, packet, state_json)
+            serial_publish_state(topic3, value3, packet, state_json)
+            serial_publish_state(topic4, value4, packet, state_json)
+
+            if state_json:
+                doc = {"power": value1, "away": value2, "target": value3, "current": value4}
+                serial_publish_state_doc("{}/{}/{}_{}/state".format(prefix, device, grp_id, id), doc, packet)
                 
 # KTDO: 위의 코드로 대체                        
 #    # device 종류에 따라 전송할 데이터 정리
@@ -1226,200 +2679,322 @@ def serial_receive_state(device, packet):
 #        last_topic_list[topic] = value
 
         
-# KTDO: 수정 완료
-def serial_get_header():
+# KTDO: 버퍼에서 패킷 단위로 받아옴
+def serial_get_packet():
     try:
-        # 0x80보다 큰 byte가 나올 때까지 대기
-        # KTDO: 시작 F7 찾기
-        while 1:
-            header_0 = conn.recv(1)[0]
-            #if header_0 >= 0x80: break
-            if header_0 == 0xF7: break
-
-        # 중간에 corrupt되는 data가 있으므로 연속으로 0x80보다 큰 byte가 나오면 먼젓번은 무시한다
-        # KTDO: 연속 0xF7 무시                                           
-        while 1:
-            header_1 = conn.recv(1)[0]
-            #if header_1 < 0x80: break
-            if header_1 != 0xF7: break
-            header_0 = header_1
-        
-        header_2 = conn.recv(1)[0]
-        header_3 = conn.recv(1)[0]
-        
+        return conn.get_frame()
+
     except (OSError, serial.SerialException):
         logger.error("ignore exception!")
-        header_0 = header_1 = header_2 = header_3 = 0
-
-    # 헤더 반환
-    return header_0, header_1, header_2, header_3
+        bus_capture.trigger("exception")
+        return None
 
 
 # KTDO: 수정 완료
 def serial_ack_command(packet):
-    logger.info("ack from device: {} ({:x})".format(serial_ack[packet].hex(), packet))
+    key, cmd = serial_ack.pop(packet)
+    logger.info("ack from device: %s (%x)", LazyHex(cmd), packet)
 
     # 성공한 명령을 지움
-    serial_queue.pop(serial_ack[packet], None)
-    serial_ack.pop(packet)
+    # KTDO: 그 사이 새 명령으로 대체되었으면 None (새 명령의 기록은 그대로 둠)
+    entry = serial_queue.pop(key, cmd)
+    if entry is None:
+        return None
+    bus_timing.on_ack(entry["attempts"])
+    metric_ack_latency.observe(time.time() - entry["queued"])
+    command_trace.mark(key, "acked")
+    return key
+
+
+# KTDO: asyncio 모드에서 max_retry 초과시 timer로 호출됨
+def serial_expire_command(key, queued):
+    cmd = serial_queue.expire(key, queued)
+    if cmd is None:
+        return
+    serial_drop_expired(key, cmd)
+
+
+# KTDO: max_retry 초과로 scheduler에서 제거된 명령 정리 (blocking/asyncio 모드 공통), 늦게 온 ack는 무시
+def serial_drop_expired(key, cmd):
+    logger.error("send to device:  %s max retry time exceeded!", LazyHex(cmd))
+    command_trace.finish(key, "expired", "expired")
+    bus_capture.trigger("expired")
+    for ack in [ack for ack, (k, c) in serial_ack.items() if c == cmd]:
+        serial_ack.pop(ack)
 
     
-# KTDO: 수정 완료
+# KTDO: 수정 완료, 명령을 보냈으면 True
 def serial_send_command():
     # 한번에 여러개 보내면 응답이랑 꼬여서 망함
-    cmd = next(iter(serial_queue))
+    # KTDO: 우선순위/재전송 시각에 따라 scheduler가 고른 명령 하나만 보냄
+    # KTDO: 같은 우선순위면 대상 장치가 곧 조회될 명령부터, 상태 응답이 같은 주기에 돌아오도록
+    now = time.time()
+    # KTDO: 대기중인 명령들이 전체/그룹 명령과 같으면 broadcast로 대체
+    if len(serial_queue) >= BROADCAST_MIN_COMMANDS:
+        broadcast_planner.plan(now)
+    command, expired = serial_queue.take(now, serial_poll_rank(now))
+    for key, cmd in expired:
+        serial_drop_expired(key, cmd)
+    if command is None:
+        return False
+    key, cmd, queued = command
     conn.send(cmd)
+    if bus_capture.active:
+        bus_capture.record(CAPTURE_TX | CAPTURE_FRAME, cmd)
+    bus_timing.on_send(cmd, conn.checksum_errors)
+    command_trace.sent(key)
+    broadcast_planner.sent(key)
 
     #ack = bytearray(cmd[0:3])
-    # KTDO: Ezville은 4 Byte까지 확인 필요
+    # KTDO: Ezville은 4 Byte까지 확인 필요, 모르는 명령 (debug 패킷 등) 은 ack 생략
     ack = bytearray(cmd[0:4])
-    ack[3] = ACK_MAP[cmd[1]][cmd[3]]
+    ack[3] = ACK_MAP.get(cmd[1], {}).get(cmd[3], 0x00)
     waive_ack = False
     if ack[3] == 0x00:
         waive_ack = True
     ack = int.from_bytes(ack, "big")
 
-    # retry time 관리, 초과했으면 제거
-    elapsed = time.time() - serial_queue[cmd]
-    if elapsed > Options["rs485"]["max_retry"]:
-        logger.error("send to device:  {} max retry time exceeded!".format(cmd.hex()))
-        serial_queue.pop(cmd)
+    # retry time 관리, 초과한 명령은 scheduler에서 제거됨
+    elapsed = now - queued
+    if waive_ack:
+        logger.info("waive ack:  %s", LazyHex(cmd))
+        serial_queue.sent(key, cmd)
         serial_ack.pop(ack, None)
+        command_trace.finish(key, "waived", "sent")
+        return True
     elif elapsed > 3:
-        logger.warning("send to device:  {}, try another {:.01f} seconds...".format(cmd.hex(), Options["rs485"]["max_retry"] - elapsed))
-        serial_ack[ack] = cmd
-    elif waive_ack:
-        logger.info("waive ack:  {}".format(cmd.hex()))
-        serial_queue.pop(cmd)
-        serial_ack.pop(ack, None)
+        logger.warning("send to device:  %s, try another %.01f seconds...", LazyHex(cmd), Options["rs485"]["max_retry"] - elapsed)
     else:
-        logger.info("send to device:  {}".format(cmd.hex()))
-        serial_ack[ack] = cmd
+        logger.info("send to device:  %s", LazyHex(cmd))
+    serial_ack[ack] = (key, cmd)
+
+    # KTDO: ack 없으면 backoff 후 재전송, 그 사이에는 다른 명령 전송
+    #       asyncio 모드에서는 다음 패킷을 기다리지 않고 재전송 시각에 timer로 시도
+    due = serial_queue.retry_later(key, cmd, now)
+    if serial_event_loop is not None and due is not None:
+        serial_event_loop.call_later(due - now, serial_retry_due)
+    return True
 
-# KTDO: 수정 완료
-def serial_loop():
-    logger.info("start loop ...")
-    loop_count = 0
-    scan_count = 0
-    send_aggressive = False
 
-    start_time = time.time()
-    while True:
-        # 로그 출력
-        sys.stdout.flush()
+# KTDO: asyncio 모드에서 재전송 시각에 timer로 호출됨, 마지막 패킷 뒤 bus가 비어 있으면 바로 전송
+#       아니면 이전처럼 다음 응답/조회 패킷 뒤에 전송
+def serial_retry_due():
+    packet = serial_last_frame
+    if packet is not None and (packet[3] in SERIAL_SEND_AFTER or send_aggressive):
+        serial_try_send(packet)
+
+# KTDO: 명령 대상 장치의 다음 조회까지 남은 시간, 주기 학습 전이면 None (들어온 순서대로)
+def serial_poll_rank(now):
+    if poll_schedule.period() is None:
+        return None
+    lead = 2 * SERIAL_MAX_COMMAND_LENGTH * bus_timing.byte_time()
 
-        # 첫 Byte만 0x80보다 큰 두 Byte를 찾음
-        header_0, header_1, header_2, header_3 = serial_get_header()
-        # KTDO: 패킷단위로 분석할 것이라 합치지 않음.
-        # header = (header_0 << 8) | header_1
+    def rank(packet):
+        wait = poll_schedule.time_to_poll(packet[1], packet[2], now, lead)
+        return float("inf") if wait is None else wait
+    return rank
+
+# KTDO: 방금 받은 패킷 뒤 bus가 비어있을 때만 명령 전송
+def serial_try_send(packet):
+    if not serial_queue or conn.check_pending_recv():
+        return
+
+    # 이미 다음 패킷이 들어와 있으면 bus가 쉬고 있지 않음
+    now = time.time()
+    if conn.buffered() or not bus_timing.can_send(packet, conn.recv_time, now):
+        return
+
+    if serial_send_command():
+        conn.set_pending_recv()
+
+# KTDO: 패킷 하나를 처리 (blocking loop와 asyncio loop 공용)
+def serial_process_packet(packet):
+    global loop_count, scan_count, send_aggressive, loop_start_time, HEADER_0_FIRST
+
+    header_0, header_1, header_2, header_3 = packet[0:4]
+    metric_frames.inc()
+    # KTDO: 패킷단위로 분석할 것이라 합치지 않음.
+    # header = (header_0 << 8) | header_1
+
+    # KTDO: 패킷 간격, polling 주기 학습
+    bus_timing.on_frame(packet, conn.recv_time, conn.checksum_errors)
+    # KTDO: 2번째 Header가 장치 Header임, 가스 밸브 쿼리로 주기 시작 확인
+    loop_anchor = header_1 == HEADER_0_FIRST[0][0] and (header_3 == HEADER_0_FIRST[0][1] or header_3 == HEADER_0_FIRST[1][1])
+    poll_schedule.on_frame(packet, conn.recv_time, loop_anchor)
+    # KTDO: HA 재시작 후 다시 보낼 config/상태가 남아 있으면 조금씩 전송
+    reannouncer.step(time.time())
 
 # KTDO: Virtual Device는 Skip
-#        # 요청했던 동작의 ack 왔는지 확인
-#        if header in virtual_ack:
-#            virtual_clear(header)
+#    # 요청했던 동작의 ack 왔는지 확인
+#    if header in virtual_ack:
+#        virtual_clear(header)
 #
-#        # 인터폰 availability 관련 헤더인지 확인
-#        if header in virtual_avail:
-#            virtual_enable(header_0, header_1)
+#    # 인터폰 availability 관련 헤더인지 확인
+#    if header in virtual_avail:
+#        virtual_enable(header_0, header_1)
 #
-#        # 가상 장치로써 응답해야 할 header인지 확인
-#        if header_0 in header_0_virtual:
-#            virtual_query(header_0, header_1)
-
-        # KTDO: int('20', base=16)
-        # device로부터의 state 응답이면 확인해서 필요시 HA로 전송해야 함
-        if header_1 in STATE_HEADER and header_3 in STATE_HEADER[header_1]:
-            #packet = bytes([header_0, header_1])
-
-            # 몇 Byte짜리 패킷인지 확인
-            #device, remain = STATE_HEADER[header]
-            device = STATE_HEADER[header_1][0]
-            # KTDO: 데이터 길이는 다음 패킷에서 확인
-            header_4 = conn.recv(1)[0]
-            data_length = int(header_4)
-            
-            # KTDO: packet 생성 위치 변경
-            packet = bytes([header_0, header_1, header_2, header_3, header_4])
-            
-            # 해당 길이만큼 읽음
-            # KTDO: 데이터 길이 + 2 (XOR + ADD) 만큼 읽음
-            packet += conn.recv(data_length + 2)
-
-            # checksum 오류 없는지 확인
-            # KTDO: checksum 및 ADD 오류 없는지 확인 
-            if not serial_verify_checksum(packet):
-                continue
-
-            # 디바이스 응답 뒤에도 명령 보내봄
-            if serial_queue and not conn.check_pending_recv():
-                serial_send_command()
-                conn.set_pending_recv()
+#    # 가상 장치로써 응답해야 할 header인지 확인
+#    if header_0 in header_0_virtual:
+#        virtual_query(header_0, header_1)
+
+    # KTDO: int('20', base=16)
+    # device로부터의 state 응답이면 확인해서 필요시 HA로 전송해야 함
+    if header_1 in STATE_HEADER and header_3 in STATE_HEADER[header_1]:
+        #packet = bytes([header_0, header_1])
+
+        # 몇 Byte짜리 패킷인지 확인
+        #device, remain = STATE_HEADER[header]
+        device = STATE_HEADER[header_1][0]
+        # KTDO: 데이터 길이 및 checksum 확인은 serial_get_packet()에서 완료
+
+        # 디바이스 응답 뒤에도 명령 보내봄
+        serial_try_send(packet)
+
+        # 적절히 처리한다
+        serial_receive_state(device, packet)
+
+    # KTDO: 이전 명령의 ACK 경우
+    elif header_1 in ACK_HEADER and header_3 in ACK_HEADER[header_1]:
+        # 한 byte 더 뽑아서, 보냈던 명령의 ack인지 확인
+        #header_2 = conn.recv(1)[0]
+        #header = (header << 8) | header_2
+        header = header_0 << 24 | header_1 << 16 | header_2 << 8 | header_3
+
+        key = serial_ack_command(header) if header in serial_ack else None
+
+        # KTDO: 조명 (C1), 난방 (C4) ACK에는 장치 상태가 모두 들어있으므로 다음 조회를 기다리지 않고 바로 HA로 전송
+        serial_receive_state(ACK_HEADER[header_1][0], packet)
+        if key is not None:
+            command_trace.finish(key, "acked")
+    
+    # KTDO: 필요 없음.
+    # 마지막으로 받은 query를 저장해둔다 (조명 discovery에 필요)
+    #elif header in QUERY_HEADER:
+    #    # 나머지 더 뽑아서 저장
+    #    global last_query
+    #    packet = conn.recv(QUERY_HEADER[header][1])
+    #    packet = header.to_bytes(2, "big") + packet
+    #    last_query = packet
+
+    # 명령을 보낼 타이밍인지 확인: 0xXX5A 는 장치가 있는지 찾는 동작이므로,
+    # 아직도 이러고 있다는건 아무도 응답을 안할걸로 예상, 그 타이밍에 끼어든다.
+    # KTDO: EzVille은 표준에 따라 Ack 이후 다음 Request 까지의 시간 활용하여 command 전송
+    #       즉 State 확인 후에만 전달
+    # KTDO: 응답 (0x81, 0x8F) 이나 조회 (0x0F) 뒤, aggressive mode 에서는 아무 패킷 뒤에나 시도
+    #       실제 전송은 학습한 idle 시간이 충분한 경우만
+    else:
+    #if header_1 == HEADER_1_SCAN or send_aggressive:
+        scan_count += 1
+        if header_3 in SERIAL_SEND_AFTER or send_aggressive:
+            serial_try_send(packet)
+
+    # 전체 루프 수 카운트
+    # KTDO: 가스 밸브 쿼리로 확인
+    if loop_anchor:
+        loop_count += 1
+        bus_timing.report(time.time())
+        poll_schedule.report(time.time())
+        broadcast_planner.check(time.time())
+        discovery_registry.save()
+        bus_capture.flush()
+
+        # 돌만큼 돌았으면 상황 판단
+        if loop_count == 30:
+            # discovery: 가끔 비트가 튈때 이상한 장치가 등록되는걸 막기 위해, 시간제한을 둠
+            if Options["mqtt"]["_discovery"]:
+                logger.info("Add new device:  All done.")
+                Options["mqtt"]["_discovery"] = False
+            else:
+                logger.info("running stable...")
+
+            # 스캔이 없거나 적으면, 명령을 내릴 타이밍을 못잡는걸로 판단, 아무때나 닥치는대로 보내봐야한다.
+            if Options["serial_mode"] == "serial" and scan_count < 30:
+                logger.warning("initiate aggressive send mode! (%s)", scan_count)
+                send_aggressive = True
+
+        # HA 재시작한 경우
+        elif loop_count > 30 and Options["mqtt"]["_discovery"]:
+            loop_count = 1
+
+    # 루프 카운트 세는데 실패하면 다른 걸로 시도해봄
+    if loop_count == 0 and time.time() - loop_start_time > 6:
+        logger.warning("check loop count fail: there are no F7 %02X ** %02X or F7 %02X ** %02X! try F7 %02X ** %02X or F7 %02X ** %02X...",
+            HEADER_0_FIRST[0][0], HEADER_0_FIRST[0][1], HEADER_0_FIRST[1][0], HEADER_0_FIRST[1][1],
+            header_0_first_candidate[-1][0][0], header_0_first_candidate[-1][0][1], header_0_first_candidate[-1][1][0], header_0_first_candidate[-1][1][1])
+        HEADER_0_FIRST = header_0_first_candidate.pop()
+        poll_schedule.reset()
+        loop_start_time = time.time()
+        scan_count = 0
 
-            # 적절히 처리한다
-            serial_receive_state(device, packet)
+# KTDO: 수정 완료
+def serial_loop():
+    global loop_start_time
 
-        # KTDO: 이전 명령의 ACK 경우
-        elif header_1 in ACK_HEADER and header_3 in ACK_HEADER[header_1]:
-            # 한 byte 더 뽑아서, 보냈던 명령의 ack인지 확인
-            #header_2 = conn.recv(1)[0]
-            #header = (header << 8) | header_2
-            header = header_0 << 24 | header_1 << 16 | header_2 << 8 | header_3
+    logger.info("start loop ...")
+    loop_start_time = time.time()
+    while True:
+        # 로그 출력
+        sys.stdout.flush()
 
-            if header in serial_ack:
-                serial_ack_command(header)
-        
-        # KTDO: 필요 없음.
-        # 마지막으로 받은 query를 저장해둔다 (조명 discovery에 필요)
-        #elif header in QUERY_HEADER:
-        #    # 나머지 더 뽑아서 저장
-        #    global last_query
-        #    packet = conn.recv(QUERY_HEADER[header][1])
-        #    packet = header.to_bytes(2, "big") + packet
-        #    last_query = packet
-
-        # 명령을 보낼 타이밍인지 확인: 0xXX5A 는 장치가 있는지 찾는 동작이므로,
-        # 아직도 이러고 있다는건 아무도 응답을 안할걸로 예상, 그 타이밍에 끼어든다.
-        # KTDO: EzVille은 표준에 따라 Ack 이후 다음 Request 까지의 시간 활용하여 command 전송
-        #       즉 State 확인 후에만 전달
-        elif (header_3 == 0x81 or 0x8F or 0x0F) or send_aggressive:
-        
-        #if header_1 == HEADER_1_SCAN or send_aggressive:
-            scan_count += 1
-            if serial_queue and not conn.check_pending_recv():
-                serial_send_command()
-                conn.set_pending_recv()
-
-        # 전체 루프 수 카운트
-        # KTDO: 가스 밸브 쿼리로 확인
-        global HEADER_0_FIRST
-        # KTDO: 2번째 Header가 장치 Header임
-        if header_1 == HEADER_0_FIRST[0][0] and (header_3 == HEADER_0_FIRST[0][1] or header_3 == HEADER_0_FIRST[1][1]):
-            loop_count += 1
-
-            # 돌만큼 돌았으면 상황 판단
-            if loop_count == 30:
-                # discovery: 가끔 비트가 튈때 이상한 장치가 등록되는걸 막기 위해, 시간제한을 둠
-                if Options["mqtt"]["_discovery"]:
-                    logger.info("Add new device:  All done.")
-                    Options["mqtt"]["_discovery"] = False
-                else:
-                    logger.info("running stable...")
-
-                # 스캔이 없거나 적으면, 명령을 내릴 타이밍을 못잡는걸로 판단, 아무때나 닥치는대로 보내봐야한다.
-                if Options["serial_mode"] == "serial" and scan_count < 30:
-                    logger.warning("initiate aggressive send mode!", scan_count)
-                    send_aggressive = True
-
-            # HA 재시작한 경우
-            elif loop_count > 30 and Options["mqtt"]["_discovery"]:
-                loop_count = 1
-
-        # 루프 카운트 세는데 실패하면 다른 걸로 시도해봄
-        if loop_count == 0 and time.time() - start_time > 6:
-            print("check loop count fail: there are no F7 {:02X} ** {:02X} or F7 {:02X} ** {:02X}! try F7 {:02X} ** {:02X} or F7 {:02X} ** {:02X}...".format(HEADER_0_FIRST[0][0],HEADER_0_FIRST[0][1],HEADER_0_FIRST[1][0],HEADER_0_FIRST[1][1],header_0_first_candidate[-1][0][0],header_0_first_candidate[-1][0][1],header_0_first_candidate[-1][1][0],header_0_first_candidate[-1][1][1]))
-            HEADER_0_FIRST = header_0_first_candidate.pop()
-            start_time = time.time()
-            scan_count = 0
+        # KTDO: checksum까지 확인된 완성된 패킷 단위로 받음
+        packet = serial_get_packet()
+        if packet is None:
+            continue
+
+        serial_process_packet(packet)
+
+# KTDO: asyncio 기반 loop, 버스 수신/명령 수신/타이머를 한 loop에서 기다림
+async def serial_loop_async():
+    global loop_start_time, serial_event_loop, serial_command_queue, serial_last_frame
+
+    logger.info("start asyncio loop ...")
+    loop = asyncio.get_running_loop()
+    closed = loop.create_future()
+
+    serial_command_queue = asyncio.Queue()
+    serial_event_loop = loop
+
+    def serial_on_readable():
+        global serial_last_frame
+        try:
+            conn.feed(conn.recv_nowait())
+        except EOFError as e:
+            if not closed.done():
+                closed.set_exception(e)
+            return
+        except (OSError, serial.SerialException):
+            logger.error("ignore exception!")
+            bus_capture.trigger("exception")
+            return
+
+        # 받은 데이터에 완성된 패킷이 여러개일 수 있음
+        while True:
+            packet = conn.next_frame()
+            if packet is None:
+                break
+            serial_process_packet(packet)
+            serial_last_frame = packet
+
+    async def serial_command_loop():
+        # HA 명령은 MQTT thread에서 asyncio.Queue로 전달되므로 serial_queue는 이 loop에서만 변경됨
+        while True:
+            key, packet, priority, repeat = await serial_command_queue.get()
+            queued = serial_queue.put(key, packet, priority, repeat=repeat)
+            command_trace.mark(key, "queued")
+
+            # max_retry 초과시 timer로 제거, 이후 같은 명령이 다시 들어온 경우는 건드리지 않음
+            loop.call_later(Options["rs485"]["max_retry"], serial_expire_command, key, queued)
+
+    loop_start_time = time.time()
+    loop.add_reader(conn.fileno(), serial_on_readable)
+    command_task = loop.create_task(serial_command_loop())
+    try:
+        await closed
+    finally:
+        loop.remove_reader(conn.fileno())
+        command_task.cancel()
+        serial_event_loop = None
+        serial_last_frame = None
 
 # KTDO: 수정 완료
 def dump_loop():
@@ -1431,7 +3006,7 @@ def dump_loop():
             dump_time = 10
 
         start_time = time.time()
-        logger.warning("packet dump for {} seconds!".format(dump_time))
+        logger.warning("packet dump for %s seconds!", dump_time)
 
         conn.set_timeout(2)
         logs = []
@@ -1451,6 +3026,60 @@ def dump_loop():
         logger.warning("dump done.")
         conn.set_timeout(None)
 
+# KTDO: 동작 지표를 HTTP (Prometheus) 로 제공하고, 설정한 주기마다 {prefix}/diagnostics/state 로도 보냄
+#       MQTT는 HA 진단 sensor로 등록하고, counter는 지난 주기 동안의 초당 값 (_rate) 도 같이 보냄
+def start_metrics():
+    if Options["metrics"]["port"] > 0:
+        metrics.serve(Options["metrics"]["port"])
+
+    interval = Options["metrics"]["diagnostics_interval"]
+    if interval <= 0:
+        return
+
+    prefix = Options["mqtt"]["prefix"]
+    topic = "{}/diagnostics/state".format(prefix)
+
+    def diagnostics(last, elapsed):
+        values = metrics.values()
+        doc = dict(values)
+        for name, value in values.items():
+            if name.endswith("_total"):
+                doc[name[:-len("_total")] + "_rate"] = round((value - last.get(name, 0)) / elapsed, 2)
+        return values, doc
+
+    # sensor 등록은 serial loop 시작 전에 (discovery registry는 serial thread에서만 변경)
+    # 누적 값은 sensor로 만들지 않음 (JSON과 /metrics에는 있음)
+    if Options["mqtt"]["discovery"]:
+        for key in diagnostics({}, 1)[1]:
+            if key.endswith(("_total", "_count")):
+                continue
+            payload = {
+                "_intg": "sensor",
+                "~": "{}/diagnostics".format(prefix),
+                "name": "{}_diagnostics_{}".format(prefix, key),
+                "stat_t": "~/state",
+                "val_tpl": "{{{{ value_json.{} }}}}".format(key),
+                "ent_cat": "diagnostic",
+                "stat_cla": "measurement",
+            }
+            if key.endswith("_rate"):
+                payload["unit_of_meas"] = "/s"
+            elif key.endswith(("_seconds", "_seconds_avg")):
+                payload["unit_of_meas"] = "s"
+            mqtt_discovery(payload)
+
+    def diagnostics_loop():
+        last, last_time = {}, time.time()
+        while True:
+            time.sleep(interval)
+            now = time.time()
+            last, doc = diagnostics(last, now - last_time)
+            last_time = now
+            mqtt.publish(topic, json.dumps(doc), retain=True)
+
+    threading.Thread(target=diagnostics_loop, name="diagnostics", daemon=True).start()
+
+
 
 if __name__ == "__main__":
     global conn
@@ -1472,10 +3101,25 @@ if __name__ == "__main__":
 
     dump_loop()
 
+    # KTDO: bus capture는 dump 이후부터 (dump는 시작시에만 log로 출력)
+    bus_capture.start(Options["capture"])
+
     start_mqtt_loop()
 
+    # KTDO: 동작 지표 (HTTP, MQTT diagnostics)
+    start_metrics()
+
+    # KTDO: 보낸 상태 값을 주기적으로 저장
+    state_snapshot.start(Options["mqtt"]["snapshot_interval"], serial_snapshot_state)
+
     try:
         # 무한 루프
-        serial_loop()
+        if Options["async_mode"] == "on":
+            conn.set_nonblocking()
+            asyncio.run(serial_loop_async())
+        else:
+            serial_loop()
     except:
         logger.exception("addon finished!")
+        state_snapshot.save(serial_snapshot_state())
+        bus_capture.close()
@@ -6,9 +6,22 @@ import threading
 import telnetlib
 import socket
 import random
+import hashlib
+import bisect
+import os
+import pickle
+import sys
+import queue
+import atexit
+import logging
+
+from functools import reduce
+from collections import deque
+from operator import xor
 
 from threading import Thread
-from queue import Queue
+from logging.handlers import QueueHandler, QueueListener
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # DEVICE 별 패킷 정보
 RS485_DEVICE = {
@@ -41,6 +54,16 @@ RS485_DEVICE = {
     }
 }
 
+# 전체/그룹 Command (ACK가 없으므로 3회 연속 전송 후 개별 장치 State로 확인)
+# 조명은 일괄 소등만 가능, Thermostat은 그룹 ID 하위 4 BIT가 F면 그룹 전체 (외출 모드는 off로 매핑)
+BROADCAST_COMMAND = {
+    'light': { 'state': 'power', 'value': 'OFF', 'sendcmd': 'F70EFF4203FF00000000' },
+    'thermostat': { 'state': 'power', 'value': 'off', 'sendcmd': 'F7361F4501010000' }
+}
+BROADCAST_REPEAT = 3
+BROADCAST_MIN_COMMANDS = 2
+BROADCAST_CONFIRM_TIME = 3
+
 # MQTT Discovery를 위한 Preset 정보
 DISCOVERY_DEVICE = {
     'ids': ['ezville_wallpad',],
@@ -134,26 +157,493 @@ DISCOVERY_PAYLOAD = {
     } ]
 }
 
-# STATE 확인용 Dictionary
+# 전체 Command 버튼 (해당 종류의 장치가 처음 발견될 때 등록)
+DISCOVERY_BROADCAST = {
+    'light': {
+        '_intg': 'button',
+        '~': 'ezville/light_all',
+        'name': 'ezville_light_all_off',
+        'cmd_t': '~/power/command',
+        'pl_prs': 'OFF',
+        'icon': 'mdi:lightbulb-group-off'
+    },
+    'thermostat': {
+        '_intg': 'button',
+        '~': 'ezville/thermostat_all',
+        'name': 'ezville_thermostat_all_away',
+        'cmd_t': '~/power/command',
+        'pl_prs': 'off',
+        'icon': 'mdi:home-export-outline'
+    }
+}
+
+# state_json 모드에서 Discovery의 State Topic을 JSON 문서 Topic으로 바꿀 때 같이 넣는 Template Key
+STATE_JSON_TEMPLATE = {
+    'light': { 'stat_t': 'stat_val_tpl' },
+    'climate': { 'mode_stat_t': 'mode_stat_tpl', 'temp_stat_t': 'temp_stat_tpl', 'curr_temp_t': 'curr_temp_tpl' },
+    'switch': { 'stat_t': 'val_tpl' },
+    'binary_sensor': { 'stat_t': 'val_tpl' },
+    'sensor': { 'stat_t': 'val_tpl' }
+}
+
+# STATE 확인용 Dictionary (수신 패킷은 bytes로 처리하므로 정수 key/value 사용)
 STATE_HEADER = {
-    prop['state']['id']: (device, prop['state']['cmd'])
+    int(prop['state']['id'], 16): (device, int(prop['state']['cmd'], 16))
     for device, prop in RS485_DEVICE.items()
     if 'state' in prop
 }
 
 # ACK 확인용 Dictionary
 ACK_HEADER = {
-    prop[cmd]['id']: (device, prop[cmd]['ack'])
+    int(prop[cmd]['id'], 16): (device, int(prop[cmd]['ack'], 16))
     for device, prop in RS485_DEVICE.items()
         for cmd, code in prop.items()
             if 'ack' in code
 }
 
-# LOG 메시지
-def log(string):
-    date = time.strftime('%Y-%m-%d %p %I:%M:%S', time.localtime(time.time()))
-    print('[{}] {}'.format(date, string))
-    return
+# Thermostat ACK 패킷을 State 패킷처럼 캐쉬할 때 사용하는 Header
+THERMOSTAT_STATE_HEADER = bytes.fromhex('F7361F810F')
+
+# 장치/속성 Key 별로 하나의 Command만 유지하는 Queue
+# 같은 Key의 새 Command는 대기 중인 Command를 순서 그대로 대체하고, 전송 중인 Command는 재시도를 중단시킴
+class CoalescingQueue:
+    def __init__(self):
+        self._pending = {}
+        self._inflight = {}
+        self._event = asyncio.Event()
+
+    def put(self, key, item):
+        self._supersede(key)
+        self._pending[key] = item
+        self._event.set()
+
+    def discard(self, key):
+        self._supersede(key)
+        self._pending.pop(key, None)
+
+    def _supersede(self, key):
+        if key in self._inflight:
+            self._inflight[key]['superseded'] = True
+
+    # ready가 주어지면 ready(item)이 True인 Command 중 가장 먼저 들어온 것을 꺼냄
+    async def get(self, ready=None):
+        while True:
+            for key, item in self._pending.items():
+                if ready is None or ready(item):
+                    del self._pending[key]
+                    self._inflight[key] = item
+                    return key, item
+
+            self._event.clear()
+            await self._event.wait()
+
+    # 대기 중 (pending) 혹은 전송 중 (inflight) 인 Command 중 match(key, item)이 True인 것
+    def pending(self, match):
+        return [(key, item) for key, item in self._pending.items() if match(key, item)]
+
+    def inflight(self, match):
+        return [(key, item) for key, item in self._inflight.items() if match(key, item)]
+
+    def __contains__(self, key):
+        return key in self._pending or key in self._inflight
+
+    def task_done(self, key):
+        self._inflight.pop(key, None)
+        # 완료된 Command 때문에 대기하던 Command가 있을 수 있으므로 깨움
+        self._event.set()
+
+    def empty(self):
+        return not self._pending
+
+
+# state_json 모드의 JSON 문서 단위 (문서 ID, 문서 내 Key): 조명은 방 단위, 나머지는 장치 단위
+def state_doc(deviceID, state):
+    device, id1, id2 = deviceID.rsplit('_', 2)
+    if device == 'light':
+        return '{}_{}'.format(device, id1), id2
+    return deviceID, state
+
+
+# 등록했던 Discovery Config의 Hash를 파일로 저장
+# 재시작시 바뀐 Config만 바로 등록하고, 이전과 같은 장치는 첫 패킷부터 State Publish
+# 같은 Config도 Broker 연결마다 한번은 정해진 속도로 다시 등록 (Broker가 Retain을 잃었거나 HA에서 장치를 지운 경우)
+class DiscoveryRegistry:
+    def __init__(self, path):
+        self.path = path
+        self.configs = {}
+        # 이번 실행에서 만든 Config (장치 -> {topic: config}), 이번 Broker 연결에서 보낸 topic
+        self.remembered = {}
+        self.announced = set()
+        self._dirty = False
+        
+        try:
+            with open(path) as file:
+                data = json.load(file)
+            self.configs = data['configs']
+            log('[INFO] 등록 정보 로드: Config %s개', len(self.configs))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log('[WARNING] 등록 정보 파일 무시: %s', e)
+
+    def remember(self, discovery_name, topic, config):
+        self.remembered.setdefault(discovery_name, {})[topic] = config
+
+    def new_session(self):
+        self.announced.clear()
+
+    @staticmethod
+    def _digest(config):
+        return hashlib.sha1(config.encode()).hexdigest()
+
+    # 이전에 같은 내용으로 등록하지 않은 Config인지
+    def changed(self, topic, config):
+        return self.configs.get(topic) != self._digest(config)
+
+    def published(self, topic, config):
+        self.configs[topic] = self._digest(config)
+        self.announced.add(topic)
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        
+        try:
+            # 저장 중에 종료되어도 이전 파일은 남도록 임시 파일에 쓰고 교체
+            with open(self.path + '.tmp', 'w') as file:
+                json.dump({'configs': self.configs}, file)
+            os.replace(self.path + '.tmp', self.path)
+            self._dirty = False
+        except OSError as e:
+            log('[WARNING] 등록 정보 저장 실패: %s', e)
+
+
+# HA로 보낸 State 저장소를 주기적으로 파일에 저장 (pickle), 재시작시 불러와서 HA 명령의 중복 확인에 사용
+# 임시 파일에 쓰고 교체하므로 저장 중에 종료되어도 이전 파일은 남음
+class StateSnapshot:
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        self._last = None
+        self._lock = threading.Lock()
+        
+        if path is None:
+            return
+        
+        try:
+            with open(path, 'rb') as file:
+                self.state = pickle.load(file)
+            log('[INFO] State 스냅샷 로드: State %s개', len(self.state.get('device', {})))
+        except FileNotFoundError:
+            pass
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError) as e:
+            log('[WARNING] State 스냅샷 파일 무시: %s', e)
+
+    # 저장된 State 복사본 (문서는 내부 dict까지 복사)
+    def get(self, name):
+        return {key: value.copy() if isinstance(value, dict) else value for key, value in self.state.get(name, {}).items()}
+
+    # 저장할 내용, 이전에 저장한 것과 같으면 None
+    def dumps(self, state):
+        self.state = state
+        data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        return None if self.path is None or data == self._last else data
+        
+    def write(self, data):
+        with self._lock:
+            try:
+                with open(self.path + '.tmp', 'wb') as file:
+                    file.write(data)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(self.path + '.tmp', self.path)
+                self._last = data
+            except OSError as e:
+                log('[WARNING] State 스냅샷 저장 실패: %s', e)
+
+    def save(self, state):
+        data = self.dumps(state)
+        if data is not None:
+            self.write(data)
+
+
+# Command가 속한 장치 그룹 (장치 ID + 그룹 BYTE), 그룹별로 하나의 Command만 동시에 진행
+def command_group(send_data):
+    return send_data['sendcmd'][2:6]
+
+
+# MQTT Discovery를 연속으로 등록할 수 있는 최대 갯수 (이후는 discovery_delay 간격)
+DISCOVERY_BURST = 5
+
+# 강제 업데이트를 나눠서 보내는 시간 단위 (초)
+FORCE_SLICE = 1.0
+
+
+# RS485 1 BYTE 전송 시간 (9600bps, 8E1 기준 11 bit)
+RS485_BYTE_TIME = 11 / 9600
+
+
+# 동작 지표, ezville_wallpad와 같은 구현 (Prometheus text format)
+# 다른 점: counter()는 직접 세는 값만, ACK 지연 구간에 wallpad의 ack timeout (0.3초) 없음
+METRICS_ACK_BUCKETS = (0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0)
+
+
+class MetricCounter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, count=1):
+        self.value += count
+
+
+class MetricHistogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._metrics = []
+
+    def counter(self, name, help):
+        counter = MetricCounter()
+        self._metrics.append((name, 'counter', help, lambda: counter.value))
+        return counter
+
+    def gauge(self, name, help, read):
+        self._metrics.append((name, 'gauge', help, read))
+
+    def histogram(self, name, help, buckets):
+        histogram = MetricHistogram(buckets)
+        self._metrics.append((name, 'histogram', help, histogram))
+        return histogram
+
+    def exposition(self):
+        lines = []
+        for name, kind, help, metric in self._metrics:
+            name = self.prefix + name
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            if kind == 'histogram':
+                total = 0
+                for bound, count in zip(metric.buckets + ('+Inf',), metric.counts):
+                    total += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, total))
+                lines.append('{}_sum {}'.format(name, metric.sum))
+                lines.append('{}_count {}'.format(name, metric.count))
+            else:
+                value = metric()
+                lines.append('{} {}'.format(name, 'NaN' if value is None else value))
+        return '\n'.join(lines) + '\n'
+
+    # MQTT diagnostics용, Histogram은 개수와 평균만
+    def values(self):
+        values = {}
+        for name, kind, help, metric in self._metrics:
+            if kind == 'histogram':
+                values[name + '_count'] = metric.count
+                values[name + '_avg'] = round(metric.sum / metric.count, 4) if metric.count else None
+            else:
+                values[name] = metric()
+        return values
+
+    # /metrics 요청은 별도 thread에서 처리 (asyncio loop는 기다리지 않음)
+    def serve(self, port):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            server = ThreadingHTTPServer(('', port), MetricsHandler)
+        except OSError as e:
+            log('[WARNING] metrics 서버 시작 실패 (port %s): %s', port, e)
+            return
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        log('[INFO] metrics 제공: http://0.0.0.0:%s/metrics', port)
+
+
+# HA Command별 단계 시각 기록, 단계와 dump() 형식은 ezville_wallpad와 같음
+# 다른 점: asyncio loop에서만 접근하므로 lock 없음, ACK를 받은 Command는 같은 패킷의 State Publish 뒤에 완료
+TRACE_RING = 1000
+TRACE_SLOWEST = 20
+TRACE_STAGES = (('mqtt', 'recv', 'queued'), ('queue', 'queued', 'sent'), ('ack', 'sent', 'acked'), ('publish', 'acked', 'publish'))
+TRACE_PERCENTILES = (50, 95, 99)
+
+
+class CommandTrace:
+    def __init__(self):
+        self._active = {}
+        self._acked = []
+        self._done = deque(maxlen=TRACE_RING)
+
+    # MQTT 수신과 CMD_QUEUE에 넣는 시각을 같이 기록
+    def start(self, key, device, value, received):
+        now = time.monotonic()
+        self._active[key] = {'key': key, 'device': device, 'value': value, 'time': time.time(), 'sends': 0,
+                             'stages': {'recv': received or now, 'queued': now}}
+
+    def sent(self, key):
+        trace = self._active.get(key)
+        if trace is not None:
+            trace['sends'] += 1
+            trace['stages'].setdefault('sent', time.monotonic())
+
+    # ACK (혹은 목표 State) 수신
+    def ack(self, key):
+        trace = self._active.get(key)
+        if trace is not None and 'acked' not in trace['stages']:
+            trace['stages']['acked'] = time.monotonic()
+            self._acked.append(key)
+
+    def publish(self):
+        for key in self._acked:
+            self.finish(key, 'acked')
+        self._acked.clear()
+
+    def finish(self, key, result, stage='publish'):
+        trace = self._active.pop(key, None)
+        if trace is None:
+            return
+        now = time.monotonic()
+        trace['stages'].setdefault(stage, now)
+        trace['result'] = result
+        trace['total'] = now - trace['stages']['recv']
+        self._done.append(trace)
+
+    def dump(self):
+        def percentiles(values):
+            values.sort()
+            result = {'count': len(values)}
+            for p in TRACE_PERCENTILES:
+                result['p{}'.format(p)] = round(values[min(len(values) * p // 100, len(values) - 1)] * 1000, 1)
+            return result
+
+        # 장치 종류별 단계 시간 (ms)
+        samples = {}
+        for trace in self._done:
+            device = samples.setdefault(trace['device'], {})
+            stages = trace['stages']
+            for name, begin, end in TRACE_STAGES:
+                if begin in stages and end in stages:
+                    device.setdefault(name, []).append(stages[end] - stages[begin])
+            device.setdefault('total', []).append(trace['total'])
+        stats = {device: {name: percentiles(values) for name, values in stages.items()} for device, stages in samples.items()}
+
+        slowest = []
+        for trace in sorted(self._done, key=lambda trace: trace['total'], reverse=True)[:TRACE_SLOWEST]:
+            recv = trace['stages']['recv']
+            slowest.append(dict(trace, total=round(trace['total'] * 1000, 1),
+                                time=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(trace['time'])),
+                                stages={stage: round((value - recv) * 1000, 1) for stage, value in trace['stages'].items()}))
+        return {'stats': stats, 'slowest': slowest}
+
+
+# LOG 메시지, Queue와 출력 thread를 쓰는 방식은 ezville_wallpad와 같음
+# 다른 점: 로그 level은 '[WARNING]' 같은 메시지 앞부분으로 정함, Queue가 가득 차면 개수만 셈
+LOG_QUEUE_SIZE = 10000
+LOG_LEVELS = {'[WARNING]': logging.WARNING, '[ERROR]': logging.ERROR}
+LOGGER = logging.getLogger('ezville')
+
+
+class LogQueueHandler(QueueHandler):
+    def __init__(self):
+        super().__init__(queue.Queue(LOG_QUEUE_SIZE))
+        self.dropped = 0
+        
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# log_rate_limit, ezville_wallpad의 LogRateLimit과 같음 (생략 표시만 한글)
+class LogRateLimit(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        self.rate = 0
+        self._buckets = {}
+        
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+        
+        key = record.msg
+        tokens, last, suppressed = self._buckets.get(key, (self.rate, record.created, 0))
+        tokens = min(self.rate, tokens + (record.created - last) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, record.created, suppressed + 1)
+            return False
+        
+        self._buckets[key] = (tokens - 1, record.created, 0)
+        if suppressed:
+            record.msg = key + ' (같은 로그 %d개 생략)'
+            record.args = (record.args or ()) + (suppressed,)
+        return True
+
+
+LOG_HANDLER = LogQueueHandler()
+LOG_RATE_LIMIT = LogRateLimit()
+LOG_HANDLER.addFilter(LOG_RATE_LIMIT)
+
+
+def init_logger(rate):
+    LOG_RATE_LIMIT.rate = rate
+    
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', datefmt='%Y-%m-%d %p %I:%M:%S'))
+    
+    # 종료시 남은 로그는 모두 출력
+    listener = QueueListener(LOG_HANDLER.queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    LOGGER.addHandler(LOG_HANDLER)
+    LOGGER.setLevel(logging.INFO)
+    LOGGER.propagate = False
+
+
+# 인자는 출력할 때만 format ('%s' 형식)
+def log(string, *args):
+    LOGGER.log(LOG_LEVELS.get(string[:string.find(']') + 1], logging.INFO), string, *args)
+
+# 수신 패킷 (bytes, bytearray 혹은 memoryview)의 CHECKSUM 및 ADD 확인
+def verify_checksum(packet):
+    body = packet[:-2]
+    checksum = reduce(xor, body, 0)
+
+    add = (sum(body) + checksum) & 0xFF
+
+    return packet[-2] == checksum and packet[-1] == add
+
 
 # CHECKSUM 및 ADD를 마지막 4 BYTE에 추가
 def checksum(input_hex):
@@ -181,6 +671,10 @@ config_dir = '/data'
 
 HA_TOPIC = 'ezville'
 STATE_TOPIC = HA_TOPIC + '/{}/{}/state'
+STATE_DOC_TOPIC = HA_TOPIC + '/{}/state'
+DIAGNOSTICS_TOPIC = HA_TOPIC + '/diagnostics'
+# HA에서 오는 명령 Topic만 구독 (자신이 publish한 state가 되돌아오지 않도록)
+COMMAND_TOPIC = HA_TOPIC + '/+/+/command'
 EW11_TOPIC = 'ew11'
 EW11_SEND_TOPIC = EW11_TOPIC + '/send'
 
@@ -200,30 +694,62 @@ def ezville_loop(config):
     SOC_ADDRESS = config['ew11_server']
     SOC_PORT = config['ew11_port']
     
-    # EW11 혹은 HA 전달 메시지 저장소
-    MSG_QUEUE = Queue()
+    # EW11 혹은 HA 전달 메시지 저장소 (MQTT thread에서 loop.call_soon_threadsafe로 전달)
+    MSG_QUEUE = asyncio.Queue()
+    
+    # EW11에 보낼 Command 및 예상 Acknowledge 패킷 (같은 장치/속성의 Command는 대기 중인 Command를 대체)
+    CMD_QUEUE = CoalescingQueue()
+    
+    # ACK 대기중인 Command 저장소 (예상 ACK Header bytes -> [Future, statcmd])
+    ACK_WAITERS = {}
     
-    # EW11에 보낼 Command 및 예상 Acknowledge 패킷 
-    CMD_QUEUE = asyncio.Queue()
+    # 여러 그룹의 Command를 동시에 진행해도 EW11 전송은 한번에 하나씩
+    EW11_WRITE_LOCK = asyncio.Lock()
+    
+    # 이전 실행에서 저장한 State (HA 명령의 중복 확인에 사용)
+    SNAPSHOT_INTERVAL = config['snapshot_interval']
+    SNAPSHOT = StateSnapshot(config_dir + '/ezville_state.pickle' if SNAPSHOT_INTERVAL > 0 else None)
     
     # State 저장용 공간
-    DEVICE_STATE = {}
+    DEVICE_STATE = SNAPSHOT.get('device')
+    
+    # 이번 실행에서 Publish한 State Key (State Topic은 Retain이 아니므로 저장한 State와 같아도 처음 받은 값은 한번 Publish)
+    SEEN_STATES = set()
     
     # 이전에 전달된 패킷인지 판단을 위한 캐쉬
     MSG_CACHE = {}
     
-    # MQTT Discovery Que
+    # state_json 모드: 장치 State를 JSON 문서로 모아서 Publish (문서 내용, 마지막으로 보낸 문서, 바뀐 문서 ID)
+    STATE_JSON = config['state_json']
+    STATE_DOCS = {}
+    LAST_DOCS = {}
+    DIRTY_DOCS = set()
+    
+    # 강제 업데이트용 State Key -> Topic (속성별 Publish 모드), State Key 혹은 문서 ID -> 장치 ID
+    # 이번 실행에서 Publish한 State만 (저장한 State는 Bus로 확인하기 전에는 다시 보내지 않음)
+    STATE_TOPICS = {}
+    STATE_DEVICES = {}
+    
+    # MQTT Discovery Que (등록 요청한 장치, 등록이 끝난 장치, 등록 전까지 보관하는 State)
+    # 장치 등록은 discovery_loop에서 평균 DISCOVERY_DELAY초 간격으로 진행하고, 등록 DISCOVERY_DELAY초 후에 State Publish
     DISCOVERY_DELAY = config['discovery_delay']
-    DISCOVERY_LIST = []
+    DISCOVERY_QUEUE = asyncio.Queue()
+    DISCOVERY_LIST = set()
+    DISCOVERY_READY = set()
+    HELD_STATES = {}
+    
+    # 이전 실행에서 등록했던 장치 및 Config 정보
+    REGISTRY = DiscoveryRegistry(config_dir + '/ezville_registry.json')
     
     # EW11 전달 패킷 중 처리 후 남은 짜투리 패킷 저장
-    RESIDUE = ''
+    RESIDUE = bytearray()
     
-    # 강제 주기적 업데이트 설정 - 매 force_update_period 마다 force_update_duration초간 HA 업데이트 실시
-    FORCE_UPDATE = False
+    # 강제 주기적 업데이트 설정 - 저장된 State를 force_update_period 동안 고르게 나눠서 다시 Publish
+    # (초당 force_update_rate개를 넘지 않도록, 넘으면 주기가 그만큼 길어짐)
+    # 주기가 0 이하면 강제 업데이트를 하지 않고, 초당 개수가 0 이하면 제한하지 않음
     FORCE_MODE = config['force_update_mode']
     FORCE_PERIOD = config['force_update_period']
-    FORCE_DURATION = config['force_update_duration']
+    FORCE_RATE = config['force_update_rate']
     
     # Command를 EW11로 보내는 방식 설정 (동시 명령 횟수, 명령 간격 및 재시도 횟수)
     CMD_INTERVAL = config['command_interval']
@@ -231,10 +757,7 @@ def ezville_loop(config):
     FIRST_WAITTIME = config['first_waittime']
     RANDOM_BACKOFF = config['random_backoff']
     
-    # State 업데이트 루프 / Command 실행 루프 / Socket 통신으로 패킷 받아오는 루프 / Restart 필요한지 체크하는 루프의 Delay Time 설정
-    STATE_LOOP_DELAY = config['state_loop_delay']
-    COMMAND_LOOP_DELAY = config['command_loop_delay']
-    SERIAL_RECV_DELAY = config['serial_recv_delay']
+    # Restart 필요한지 체크하는 루프의 Delay Time 설정 (State/Command/Socket 루프는 Queue 및 Socket 수신 대기)
     RESTART_CHECK_DELAY = config['restart_check_delay']
     
     # EW11에 설정된 BUFFER SIZE
@@ -259,21 +782,46 @@ def ezville_loop(config):
 
     # 시작 시 인위적인 Delay 필요시 사용
     startup_delay = 0
+    
+    # 동작 지표 (metrics_port로 HTTP 제공, diagnostics_interval초마다 MQTT diagnostics Topic으로 Publish)
+    # Gauge는 읽을 때의 변수를 보므로 재시작으로 Queue 등을 새로 만들어도 그대로 사용
+    METRICS_PORT = config['metrics_port']
+    DIAGNOSTICS_INTERVAL = config['diagnostics_interval']
+    METRICS = Metrics('ezville_')
+    FRAMES = METRICS.counter('frames_total', 'RS485 packets received')
+    CHECKSUM_ERRORS = METRICS.counter('checksum_errors_total', 'RS485 packets dropped by checksum')
+    COMMANDS = METRICS.counter('commands_total', 'commands received from HA')
+    COMMAND_SENDS = METRICS.counter('command_sends_total', 'command packets written to EW11')
+    COMMAND_RETRIES = METRICS.counter('command_retries_total', 'command packets sent again without ack')
+    COMMAND_FAILURES = METRICS.counter('command_failures_total', 'commands given up after command_retry_count')
+    PUBLISHES = METRICS.counter('mqtt_publishes_total', 'MQTT messages published')
+    ACK_LATENCY = METRICS.histogram('ack_latency_seconds', 'time from first send to ack or target state', METRICS_ACK_BUCKETS)
+    METRICS.gauge('cmd_queue_depth', 'commands waiting in CMD_QUEUE', lambda: len(CMD_QUEUE.pending(lambda key, item: True)))
+    METRICS.gauge('commands_inflight', 'commands being sent', lambda: len(CMD_QUEUE.inflight(lambda key, item: True)))
+    METRICS.gauge('msg_queue_depth', 'messages waiting in MSG_QUEUE', lambda: MSG_QUEUE.qsize())
+    METRICS.gauge('discovery_queue_depth', 'devices waiting for discovery', lambda: DISCOVERY_QUEUE.qsize())
+    METRICS.gauge('discovered_devices', 'devices found on the bus', lambda: len(DISCOVERY_LIST))
+    METRICS.gauge('ready_devices', 'devices registered and publishing state', lambda: len(DISCOVERY_READY))
+    METRICS.gauge('discovery_configs', 'discovery configs registered', lambda: len(REGISTRY.configs))
+    METRICS.gauge('mqtt_online', '1 while the MQTT integration is online', lambda: int(MQTT_ONLINE))
+    
+    # HA Command별 단계 시각 기록 (ezville/debug/trace/command 로 dump 요청하면 ezville/debug/trace/state 로 Publish)
+    TRACES = CommandTrace()
   
 
     # MQTT 통신 연결 Callback
     def on_connect(client, userdata, flags, rc):
         if rc == 0:
             log('[INFO] MQTT Broker 연결 성공')
-            # Socket인 경우 MQTT 장치의 명령 관련과 MQTT Status (Birth/Last Will Testament) Topic만 구독
+            # Socket인 경우 MQTT 장치의 명령 Topic과 MQTT Status (Birth/Last Will Testament) Topic만 구독
             if comm_mode == 'socket':
-                client.subscribe([(HA_TOPIC + '/#', 0), ('homeassistant/status', 0)])
-            # Mixed인 경우 MQTT 장치 및 EW11의 명령/수신 관련 Topic 과 MQTT Status (Birth/Last Will Testament) Topic 만 구독
-            elif comm_mode == 'mixed':
-                client.subscribe([(HA_TOPIC + '/#', 0), (EW11_TOPIC + '/recv', 0), ('homeassistant/status', 0)])
-            # MQTT 인 경우 모든 Topic 구독
+                client.subscribe([(COMMAND_TOPIC, 0), ('homeassistant/status', 0)])
+            # Mixed/MQTT인 경우 EW11의 수신 Topic도 구독
+            # (ew11/send는 자신이 publish한 명령이 되돌아오기만 하므로 구독하지 않음)
             else:
-                client.subscribe([(HA_TOPIC + '/#', 0), (EW11_TOPIC + '/recv', 0), (EW11_TOPIC + '/send', 1), ('homeassistant/status', 0)])
+                client.subscribe([(COMMAND_TOPIC, 0), (EW11_TOPIC + '/recv', 0), ('homeassistant/status', 0)])
+            # Broker가 재시작되어 Retain된 Config를 잃었을 수 있으므로 이번 연결에서 다시 등록
+            loop.call_soon_threadsafe(reannounce)
         else:
             errcode = {1: 'Connection refused - incorrect protocol version',
                        2: 'Connection refused - invalid client identifier',
@@ -290,6 +838,10 @@ def ezville_loop(config):
         nonlocal startup_delay
         
         if msg.topic == 'homeassistant/status':
+            # HA가 재시작된 경우 (Retain 아닌 Birth Message) 등록했던 Config와 State를 정해진 속도로 다시 보냄
+            if msg.payload == b'online' and not msg.retain:
+                loop.call_soon_threadsafe(reannounce)
+            
             # Reboot Control 사용 시 MQTT Integration의 Birth/Last Will Testament Topic은 바로 처리
             if REBOOT_CONTROL:
                 status = msg.payload.decode('utf-8')
@@ -303,303 +855,407 @@ def ezville_loop(config):
                 elif status == 'offline':
                     log('[INFO] MQTT Integration 오프라인')
                     MQTT_ONLINE = False
-        # 나머지 topic은 모두 Queue에 보관
+        # 나머지 topic은 모두 Queue에 보관 (asyncio loop에서 처리되도록 전달)
         else:
-            MSG_QUEUE.put(msg)
+            loop.call_soon_threadsafe(MSG_QUEUE.put_nowait, (msg, time.monotonic()))
  
 
     # MQTT 통신 연결 해제 Callback
     def on_disconnect(client, userdata, rc):
         log('INFO: MQTT 연결 해제')
         pass
+    
+    
+    # MQTT Publish Callback (보낸 메시지 수)
+    def on_publish(client, userdata, mid):
+        PUBLISHES.inc()
 
 
     # MQTT message를 분류하여 처리
-    async def process_message():
-        # MSG_QUEUE의 message를 하나씩 pop
-        nonlocal MSG_QUEUE
+    async def process_message(msg, received):
         nonlocal last_received_time
         
-        stop = False
-        while not stop:
-            if MSG_QUEUE.empty():
-                stop = True
-            else:
-                msg = MSG_QUEUE.get()
-                topics = msg.topic.split('/')
+        topics = msg.topic.split('/')
 
-                if topics[0] == HA_TOPIC and topics[-1] == 'command':
-                    await HA_process(topics, msg.payload.decode('utf-8'))
-                elif topics[0] == EW11_TOPIC and topics[-1] == 'recv':
-                    # Que에서 확인된 시간 기준으로 EW11 Health Check함.
-                    last_received_time = time.time()
+        if topics[0] == HA_TOPIC and topics[-1] == 'command':
+            if topics[1] == 'debug':
+                debug_process(topics, msg.payload.decode('utf-8'))
+                return
+            COMMANDS.inc()
+            await HA_process(topics, msg.payload.decode('utf-8'), received)
+        elif topics[0] == EW11_TOPIC and topics[-1] == 'recv':
+            # Que에서 확인된 시간 기준으로 EW11 Health Check함.
+            last_received_time = time.time()
 
-                    await EW11_process(msg.payload.hex().upper())
+            await EW11_process(msg.payload)
                    
     
     # EW11 전달된 메시지 처리
     async def EW11_process(raw_data):
-        nonlocal DISCOVERY_LIST
         nonlocal RESIDUE
         nonlocal MSG_CACHE
         nonlocal DEVICE_STATE       
         
-        raw_data = RESIDUE + raw_data
+        # 이전 짜투리 패킷이 있는 경우에만 합쳐서 복사, 아니면 받은 데이터를 그대로 사용
+        if RESIDUE:
+            RESIDUE += raw_data
+            raw_data = bytes(RESIDUE)
         
         if ew11_log:
-            log('[SIGNAL] receved: {}'.format(raw_data))
-        
-        k = 0
-        cors = []
-        msg_length = len(raw_data)
-        while k < msg_length:
-            # F7로 시작하는 패턴을 패킷으로 분리
-            if raw_data[k:k + 2] == 'F7':
-                # 남은 데이터가 최소 패킷 길이를 만족하지 못하면 RESIDUE에 저장 후 종료
-                if k + 10 > msg_length:
-                    RESIDUE = raw_data[k:]
-                    break
-                else:
-                    data_length = int(raw_data[k + 8:k + 10], 16)
-                    packet_length = 10 + data_length * 2 + 4 
-                    
-                    # 남은 데이터가 예상되는 패킷 길이보다 짧으면 RESIDUE에 저장 후 종료
-                    if k + packet_length > msg_length:
-                        RESIDUE = raw_data[k:]
-                        break
-                    else:
-                        packet = raw_data[k:k + packet_length]
+            log('[SIGNAL] receved: %s', raw_data.hex().upper())
+        
+        # 패킷 분리는 복사 없이 memoryview로 진행
+        data = memoryview(raw_data)
+        msg_length = len(data)
+        
+        # F7로 시작하는 패턴을 패킷으로 분리
+        k = raw_data.find(0xF7)
+        while k >= 0:
+            # 남은 데이터가 최소 패킷 길이를 만족하지 못하면 RESIDUE에 저장 후 종료
+            if k + 5 > msg_length:
+                break
+                
+            packet_length = 5 + data[k + 4] + 2
+            
+            # 남은 데이터가 예상되는 패킷 길이보다 짧으면 RESIDUE에 저장 후 종료
+            if k + packet_length > msg_length:
+                break
+                
+            packet = data[k:k + packet_length]
+            header = bytes(packet[0:5])
+            
+            # 이전에 검증 후 캐쉬된 패킷과 완전히 같으면 Checksum 확인도 생략
+            cached = MSG_CACHE.get(header) == packet[5:]
                         
-                # 분리된 패킷이 Valid한 패킷인지 Checksum 확인                
-                if packet != checksum(packet):
-                    k+=1
-                    continue
-                else:
-                    STATE_PACKET = False
-                    ACK_PACKET = False
-                    
-                    # STATE 패킷인지 확인
-                    if packet[2:4] in STATE_HEADER and packet[6:8] in STATE_HEADER[packet[2:4]][1]:
-                        STATE_PACKET = True
-                    # ACK 패킷인지 확인
-                    elif packet[2:4] in ACK_HEADER and packet[6:8] in ACK_HEADER[packet[2:4]][1]:
-                        ACK_PACKET = True
-                    
-                    if STATE_PACKET or ACK_PACKET:
-                        # MSG_CACHE에 없는 새로운 패킷이거나 FORCE_UPDATE 실행된 경우만 실행
-                        if MSG_CACHE.get(packet[0:10]) != packet[10:] or FORCE_UPDATE:
-                            name = STATE_HEADER[packet[2:4]][0]                            
-                            if name == 'light':
-                                # ROOM ID
-                                rid = int(packet[5], 16)
-                                # ROOM의 light 갯수 + 1
-                                slc = int(packet[8:10], 16) 
-                                
-                                for id in range(1, slc):
-                                    discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, id)
-                                    
-                                    if discovery_name not in DISCOVERY_LIST:
-                                        DISCOVERY_LIST.append(discovery_name)
-                                    
-                                        payload = DISCOVERY_PAYLOAD[name][0].copy()
-                                        payload['~'] = payload['~'].format(rid, id)
-                                        payload['name'] = payload['name'].format(rid, id)
-                                   
-                                        # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                        await mqtt_discovery(payload)
-                                        await asyncio.sleep(DISCOVERY_DELAY)
-                                    
-                                    # State 업데이트까지 진행
-                                    onoff = 'ON' if int(packet[10 + 2 * id: 12 + 2 * id], 16) > 0 else 'OFF'
-                                        
-                                    await update_state(name, 'power', rid, id, onoff)
-                                    
-                                    # 직전 처리 State 패킷은 저장
-                                    if STATE_PACKET:
-                                        MSG_CACHE[packet[0:10]] = packet[10:]
-                                                                                    
-                            elif name == 'thermostat':
-                                # room 갯수
-                                rc = int((int(packet[8:10], 16) - 5) / 2)
-                                # room의 조절기 수 (현재 하나 뿐임)
-                                src = 1
-                                
-                                onoff_state = bin(int(packet[12:14], 16))[2:].zfill(8)
-                                away_state = bin(int(packet[14:16], 16))[2:].zfill(8)
-                                
-                                for rid in range(1, rc + 1):
-                                    discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, src)
-                                    
-                                    if discovery_name not in DISCOVERY_LIST:
-                                        DISCOVERY_LIST.append(discovery_name)
-                                    
-                                        payload = DISCOVERY_PAYLOAD[name][0].copy()
-                                        payload['~'] = payload['~'].format(rid, src)
-                                        payload['name'] = payload['name'].format(rid, src)
-                                   
-                                        # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                        await mqtt_discovery(payload)
-                                        await asyncio.sleep(DISCOVERY_DELAY)
-                                    
-                                    setT = str(int(packet[16 + 4 * rid:18 + 4 * rid], 16))
-                                    curT = str(int(packet[18 + 4 * rid:20 + 4 * rid], 16))
-                                    
-                                    if onoff_state[8 - rid ] == '1':
-                                        onoff = 'heat'
-                                    # 외출 모드는 off로 
-                                    elif onoff_state[8 - rid] == '0' and away_state[8 - rid] == '1':
-                                        onoff = 'off'
-#                                    elif onoff_state[8 - rid] == '0' and away_state[8 - rid] == '0':
-#                                        onoff = 'off'
-#                                    else:
-#                                        onoff = 'off'
-
-                                    await update_state(name, 'power', rid, src, onoff)
-                                    await update_state(name, 'curTemp', rid, src, curT)
-                                    await update_state(name, 'setTemp', rid, src, setT)
-                                    
-                                # 직전 처리 State 패킷은 저장
-                                if STATE_PACKET:
-                                    MSG_CACHE[packet[0:10]] = packet[10:]
-                                else:
-                                    # Ack 패킷도 State로 저장
-                                    MSG_CACHE['F7361F810F'] = packet[10:]
-                                        
-                            # plug는 ACK PACKET에 상태 정보가 없으므로 STATE_PACKET만 처리
-                            elif name == 'plug' and STATE_PACKET:
-                                if STATE_PACKET:
-                                    # ROOM ID
-                                    rid = int(packet[5], 16)
-                                    # ROOM의 plug 갯수
-                                    spc = int(packet[10:12], 16) 
+            # 분리된 패킷이 Valid한 패킷인지 Checksum 확인                
+            if not cached and not verify_checksum(packet):
+                CHECKSUM_ERRORS.inc()
+                k = raw_data.find(0xF7, k + 1)
+                continue
+            FRAMES.inc()
+            
+            # ACK를 기다리는 Command가 있으면 바로 완료 처리
+            if ACK_WAITERS:
+                resolve_ack(bytes(packet[0:4]))
+                
+            STATE_PACKET = False
+            ACK_PACKET = False
+            
+            # STATE 패킷인지 확인
+            if packet[1] in STATE_HEADER and packet[3] == STATE_HEADER[packet[1]][1]:
+                STATE_PACKET = True
+            # ACK 패킷인지 확인
+            elif packet[1] in ACK_HEADER and packet[3] == ACK_HEADER[packet[1]][1]:
+                ACK_PACKET = True
+            
+            if STATE_PACKET or ACK_PACKET:
+                # MSG_CACHE에 없는 새로운 패킷인 경우만 실행
+                if not cached:
+                    name = STATE_HEADER[packet[1]][0]                            
+                    if name == 'light':
+                        # ROOM ID
+                        rid = packet[2] & 0x0F
+                        # ROOM의 light 갯수 + 1
+                        slc = packet[4]
+                        
+                        for id in range(1, slc):
+                            discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, id)
+                            
+                            if discovery_name not in DISCOVERY_LIST:
+                                payload = DISCOVERY_PAYLOAD[name][0].copy()
+                                payload['~'] = payload['~'].format(rid, id)
+                                payload['name'] = payload['name'].format(rid, id)
+                           
+                                # 장치 등록은 discovery_loop에서, State는 등록이 끝난 후 Publish
+                                queue_discovery(discovery_name, [payload])
+                                discovery_broadcast(name)
+                            
+                            # State 업데이트까지 진행
+                            onoff = 'ON' if packet[5 + id] > 0 else 'OFF'
                                 
-                                    for id in range(1, spc + 1):
-                                        discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, id)
+                            await update_state(name, 'power', rid, id, onoff)
+                            
+                            # 직전 처리 State 패킷은 저장
+                            if STATE_PACKET:
+                                MSG_CACHE[header] = bytes(packet[5:])
+                                                                            
+                    elif name == 'thermostat':
+                        # room 갯수
+                        rc = int((packet[4] - 5) / 2)
+                        # room의 조절기 수 (현재 하나 뿐임)
+                        src = 1
+                        
+                        onoff_state = packet[6]
+                        away_state = packet[7]
+                        
+                        for rid in range(1, rc + 1):
+                            discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, src)
+                            
+                            if discovery_name not in DISCOVERY_LIST:
+                                payload = DISCOVERY_PAYLOAD[name][0].copy()
+                                payload['~'] = payload['~'].format(rid, src)
+                                payload['name'] = payload['name'].format(rid, src)
+                           
+                                # 장치 등록은 discovery_loop에서, State는 등록이 끝난 후 Publish
+                                queue_discovery(discovery_name, [payload])
+                                discovery_broadcast(name)
+                            
+                            setT = str(packet[8 + 2 * rid])
+                            curT = str(packet[9 + 2 * rid])
+                            
+                            # rid번 BIT가 해당 room의 상태
+                            if (onoff_state >> (rid - 1)) & 1:
+                                onoff = 'heat'
+                            # 외출 모드는 off로 
+                            elif (away_state >> (rid - 1)) & 1:
+                                onoff = 'off'
+#                            elif onoff_state[8 - rid] == '0' and away_state[8 - rid] == '0':
+#                                onoff = 'off'
+#                            else:
+#                                onoff = 'off'
 
-                                        if discovery_name not in DISCOVERY_LIST:
-                                            DISCOVERY_LIST.append(discovery_name)
-                                    
-                                            for payload_template in DISCOVERY_PAYLOAD[name]:
-                                                payload = payload_template.copy()
-                                                payload['~'] = payload['~'].format(rid, id)
-                                                payload['name'] = payload['name'].format(rid, id)
-                                   
-                                                # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                                await mqtt_discovery(payload)
-                                                await asyncio.sleep(DISCOVERY_DELAY)  
-                                    
-                                        # BIT0: 대기전력 On/Off, BIT1: 자동모드 On/Off
-                                        # 위와 같지만 일단 on-off 여부만 판단
-                                        onoff = 'ON' if int(packet[7 + 6 * id], 16) > 0 else 'OFF'
-                                        autoonoff = 'ON' if int(packet[6 + 6 * id], 16) > 0 else 'OFF'
-                                        power_num = '{:.2f}'.format(int(packet[8 + 6 * id: 12 + 6 * id], 16) / 100)
-                                        
-                                        await update_state(name, 'power', rid, id, onoff)
-                                        await update_state(name, 'auto', rid, id, onoff)
-                                        await update_state(name, 'current', rid, id, power_num)
-                                    
-                                        # 직전 처리 State 패킷은 저장
-                                        MSG_CACHE[packet[0:10]] = packet[10:]
-                                else:
-                                    # ROOM ID
-                                    rid = int(packet[5], 16)
-                                    # ROOM의 plug 갯수
-                                    sid = int(packet[10:12], 16) 
-                                
-                                    onoff = 'ON' if int(packet[13], 16) > 0 else 'OFF'
-                                    
-                                    await update_state(name, 'power', rid, id, onoff)
-                                        
-                            elif name == 'gasvalve':
-                                # Gas Value는 하나라서 강제 설정
-                                rid = 1
-                                # Gas Value는 하나라서 강제 설정
-                                spc = 1 
+                            await update_state(name, 'power', rid, src, onoff)
+                            await update_state(name, 'curTemp', rid, src, curT)
+                            await update_state(name, 'setTemp', rid, src, setT)
+                            
+                        # 직전 처리 State 패킷은 저장
+                        if STATE_PACKET:
+                            MSG_CACHE[header] = bytes(packet[5:])
+                        else:
+                            # Ack 패킷도 State로 저장
+                            MSG_CACHE[THERMOSTAT_STATE_HEADER] = bytes(packet[5:])
                                 
-                                discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, spc)
-                                    
+                    # plug는 ACK PACKET에 상태 정보가 없으므로 STATE_PACKET만 처리
+                    elif name == 'plug' and STATE_PACKET:
+                        if STATE_PACKET:
+                            # ROOM ID
+                            rid = packet[2] & 0x0F
+                            # ROOM의 plug 갯수
+                            spc = packet[5]
+                        
+                            for id in range(1, spc + 1):
+                                discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, id)
+
                                 if discovery_name not in DISCOVERY_LIST:
-                                    DISCOVERY_LIST.append(discovery_name)
-                                    
-                                    payload = DISCOVERY_PAYLOAD[name][0].copy()
-                                    payload['~'] = payload['~'].format(rid, spc)
-                                    payload['name'] = payload['name'].format(rid, spc)
-                                   
-                                    # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                    await mqtt_discovery(payload)
-                                    await asyncio.sleep(DISCOVERY_DELAY)                                
-
-                                onoff = 'ON' if int(packet[12:14], 16) == 1 else 'OFF'
-                                        
-                                await update_state(name, 'power', rid, spc, onoff)
+                                    payloads = []
+                                    for payload_template in DISCOVERY_PAYLOAD[name]:
+                                        payload = payload_template.copy()
+                                        payload['~'] = payload['~'].format(rid, id)
+                                        payload['name'] = payload['name'].format(rid, id)
+                                        payloads.append(payload)
+                           
+                                    # 장치 등록은 discovery_loop에서, State는 등록이 끝난 후 Publish
+                                    queue_discovery(discovery_name, payloads)
+                            
+                                # BIT0: 대기전력 On/Off, BIT1: 자동모드 On/Off
+                                # 위와 같지만 일단 on-off 여부만 판단
+                                # plug 하나당 3 BYTE: [상위 4 BIT 자동모드, 하위 4 BIT 전원][전력량 2 BYTE]
+                                onoff = 'ON' if packet[3 + 3 * id] & 0x0F > 0 else 'OFF'
+                                autoonoff = 'ON' if packet[3 + 3 * id] >> 4 > 0 else 'OFF'
+                                power_num = '{:.2f}'.format(((packet[4 + 3 * id] << 8) | packet[5 + 3 * id]) / 100)
                                 
+                                await update_state(name, 'power', rid, id, onoff)
+                                await update_state(name, 'auto', rid, id, onoff)
+                                await update_state(name, 'current', rid, id, power_num)
+                            
                                 # 직전 처리 State 패킷은 저장
-                                if STATE_PACKET:
-                                    MSG_CACHE[packet[0:10]] = packet[10:]
+                                MSG_CACHE[header] = bytes(packet[5:])
+                        else:
+                            # ROOM ID
+                            rid = packet[2] & 0x0F
+                            # ROOM의 plug 갯수
+                            sid = packet[5]
+                        
+                            onoff = 'ON' if packet[6] & 0x0F > 0 else 'OFF'
                             
-                            # 일괄차단기 ACK PACKET은 상태 업데이트에 반영하지 않음
-                            elif name == 'batch' and STATE_PACKET:
-                                # 일괄차단기는 하나라서 강제 설정
-                                rid = 1
-                                # 일괄차단기는 하나라서 강제 설정
-                                sbc = 1
-                                
-                                discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, sbc)
+                            await update_state(name, 'power', rid, id, onoff)
                                 
-                                if discovery_name not in DISCOVERY_LIST:
-                                    DISCOVERY_LIST.append(discovery_name)
-                                    
-                                    for payload_template in DISCOVERY_PAYLOAD[name]:
-                                        payload = payload_template.copy()
-                                        payload['~'] = payload['~'].format(rid, sbc)
-                                        payload['name'] = payload['name'].format(rid, sbc)
-                                   
-                                        # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                        await mqtt_discovery(payload)
-                                        await asyncio.sleep(DISCOVERY_DELAY)           
-
-                                # 일괄 차단기는 버튼 상태 변수 업데이트
-                                states = bin(int(packet[12:14], 16))[2:].zfill(8)
-                                        
-                                ELEVDOWN = states[2]                                        
-                                ELEVUP = states[3]
-                                GROUPON = states[5]
-                                OUTING = states[6]
-                                                                    
-                                grouponoff = 'ON' if GROUPON == '1' else 'OFF'
-                                outingonoff = 'ON' if OUTING == '1' else 'OFF'
+                    elif name == 'gasvalve':
+                        # Gas Value는 하나라서 강제 설정
+                        rid = 1
+                        # Gas Value는 하나라서 강제 설정
+                        spc = 1 
+                        
+                        discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, spc)
+                            
+                        if discovery_name not in DISCOVERY_LIST:
+                            payload = DISCOVERY_PAYLOAD[name][0].copy()
+                            payload['~'] = payload['~'].format(rid, spc)
+                            payload['name'] = payload['name'].format(rid, spc)
+                           
+                            # 장치 등록은 discovery_loop에서, State는 등록이 끝난 후 Publish
+                            queue_discovery(discovery_name, [payload])
+
+                        onoff = 'ON' if packet[6] == 1 else 'OFF'
                                 
-                                #ELEVDOWN과 ELEVUP은 직접 DEVICE_STATE에 저장
-                                elevdownonoff = 'ON' if ELEVDOWN == '1' else 'OFF'
-                                elevuponoff = 'ON' if ELEVUP == '1' else 'OFF'
-                                DEVICE_STATE['batch_01_01elevator-up'] = elevuponoff
-                                DEVICE_STATE['batch_01_01elevator-down'] = elevdownonoff
-                                    
-                                # 일괄 조명 및 외출 모드는 상태 업데이트
-                                await update_state(name, 'group', rid, sbc, grouponoff)
-                                await update_state(name, 'outing', rid, sbc, outingonoff)
+                        await update_state(name, 'power', rid, spc, onoff)
+                        
+                        # 직전 처리 State 패킷은 저장
+                        if STATE_PACKET:
+                            MSG_CACHE[header] = bytes(packet[5:])
+                    
+                    # 일괄차단기 ACK PACKET은 상태 업데이트에 반영하지 않음
+                    elif name == 'batch' and STATE_PACKET:
+                        # 일괄차단기는 하나라서 강제 설정
+                        rid = 1
+                        # 일괄차단기는 하나라서 강제 설정
+                        sbc = 1
+                        
+                        discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, sbc)
+                        
+                        if discovery_name not in DISCOVERY_LIST:
+                            payloads = []
+                            for payload_template in DISCOVERY_PAYLOAD[name]:
+                                payload = payload_template.copy()
+                                payload['~'] = payload['~'].format(rid, sbc)
+                                payload['name'] = payload['name'].format(rid, sbc)
+                                payloads.append(payload)
+                           
+                            # 장치 등록은 discovery_loop에서, State는 등록이 끝난 후 Publish
+                            queue_discovery(discovery_name, payloads)
+
+                        # 일괄 차단기는 버튼 상태 변수 업데이트
+                        states = packet[6]
                                 
-                                MSG_CACHE[packet[0:10]] = packet[10:]
-                                                                                    
-                RESIDUE = ''
-                k = k + packet_length
-                
-            else:
-                k+=1
+                        ELEVDOWN = (states >> 5) & 1                                        
+                        ELEVUP = (states >> 4) & 1
+                        GROUPON = (states >> 2) & 1
+                        OUTING = (states >> 1) & 1
+                                                            
+                        grouponoff = 'ON' if GROUPON else 'OFF'
+                        outingonoff = 'ON' if OUTING else 'OFF'
+                        
+                        #ELEVDOWN과 ELEVUP은 직접 DEVICE_STATE에 저장
+                        elevdownonoff = 'ON' if ELEVDOWN else 'OFF'
+                        elevuponoff = 'ON' if ELEVUP else 'OFF'
+                        DEVICE_STATE['batch_01_01elevator-up'] = elevuponoff
+                        DEVICE_STATE['batch_01_01elevator-down'] = elevdownonoff
+                            
+                        # 일괄 조명 및 외출 모드는 상태 업데이트
+                        await update_state(name, 'group', rid, sbc, grouponoff)
+                        await update_state(name, 'outing', rid, sbc, outingonoff)
+                        
+                        MSG_CACHE[header] = bytes(packet[5:])
+                                                                            
+            k = raw_data.find(0xF7, k + packet_length)
+        
+        # 처리 후 남은 짜투리 패킷은 RESIDUE에 보관 (RESIDUE bytearray는 재사용)
+        if k >= 0:
+            RESIDUE[:] = data[k:]
+        else:
+            RESIDUE.clear()
+        
+        # 받은 패킷들에서 바뀐 JSON 문서는 한번에 Publish
+        if DIRTY_DOCS:
+            publish_state_docs()
+        
+        # ACK를 받은 Command는 State Publish까지 끝났으므로 기록 완료
+        TRACES.publish()
                 
     
-    # MQTT Discovery로 장치 자동 등록
-    async def mqtt_discovery(payload):
+    # MQTT Discovery Topic 및 Config 생성
+    def discovery_config(payload):
         intg = payload.pop('_intg')
 
         # MQTT 통합구성요소에 등록되기 위한 추가 내용
         payload['device'] = DISCOVERY_DEVICE
         payload['uniq_id'] = payload['name']
+        
+        # state_json 모드면 State Topic을 JSON 문서 Topic과 값을 읽는 Template으로 바꿈
+        if STATE_JSON:
+            for key, template in STATE_JSON_TEMPLATE.get(intg, {}).items():
+                if key in payload:
+                    deviceID = payload['~'].split('/')[1]
+                    doc_id, field = state_doc(deviceID, payload[key].split('/')[1])
+                    payload[key] = STATE_DOC_TOPIC.format(doc_id)
+                    payload[template] = "{{{{ value_json['{}'] }}}}".format(field)
+                    
+                    # 장치 단위 문서는 나머지 속성도 Attribute로 보이도록
+                    if doc_id == deviceID:
+                        payload['json_attr_t'] = payload[key]
 
-        # Discovery에 등록
         topic = 'homeassistant/{}/ezville_wallpad/{}/config'.format(intg, payload['name'])
-        log('[INFO] 장치 등록:  {}'.format(topic))
-        mqtt_client.publish(topic, json.dumps(payload))
+        return topic, json.dumps(payload)
+
+    
+    # MQTT Discovery로 장치 자동 등록 (재시작 후에도 HA가 Config를 갖고 있도록 retain)
+    async def mqtt_discovery(topic, config):
+        log('[INFO] 장치 등록:  %s', topic)
+        mqtt_client.publish(topic, config, retain=True)
+        REGISTRY.published(topic, config)
+
+    
+    # 전체 Command 버튼은 해당 종류의 장치가 처음 발견될 때 같이 등록
+    def discovery_broadcast(name):
+        discovery_name = '{}_all'.format(name)
+        
+        if discovery_name not in DISCOVERY_LIST:
+            queue_discovery(discovery_name, [DISCOVERY_BROADCAST[name].copy()])
+
+    
+    # 장치 등록 요청, 등록이 끝날 때까지 해당 장치의 State는 보관
+    def queue_discovery(discovery_name, payloads):
+        DISCOVERY_LIST.add(discovery_name)
+        
+        configs = [discovery_config(payload) for payload in payloads]
+        for topic, config in configs:
+            REGISTRY.remember(discovery_name, topic, config)
+        
+        # 이전에 같은 Config로 등록한 장치는 바로 State Publish
+        # 이번 Broker 연결에서 아직 보내지 않은 Config는 State 뒤에 정해진 속도로 다시 등록
+        changed = [(topic, config) for topic, config in configs if REGISTRY.changed(topic, config)]
+        if not changed:
+            DISCOVERY_READY.add(discovery_name)
+            configs = [(topic, config) for topic, config in configs if topic not in REGISTRY.announced]
+            if configs:
+                DISCOVERY_QUEUE.put_nowait((discovery_name, configs, True))
+            return
+        configs = changed
+        
+        # 새로 등록하는 장치는 이전 실행에서 보낸 State와 같아도 등록 후 다시 Publish
+        held = HELD_STATES.setdefault(discovery_name, {})
+        for key, value in DEVICE_STATE.items():
+            if key.startswith(discovery_name) and key in SEEN_STATES:
+                state = key[len(discovery_name):]
+                held.setdefault(state, value)
+                LAST_DOCS.pop(state_doc(discovery_name, state)[0], None)
+        
+        DISCOVERY_QUEUE.put_nowait((discovery_name, configs, False))
+
+    
+    # HA 재시작 (Retain 아닌 Birth Message) 혹은 Broker 재연결: 등록했던 Config를 정해진 속도로 다시 보내고 State도 다시 Publish
+    def reannounce():
+        REGISTRY.new_session()
+        count = 0
+        for discovery_name, configs in REGISTRY.remembered.items():
+            DISCOVERY_QUEUE.put_nowait((discovery_name, list(configs.items()), True))
+            count += len(configs)
+        if count:
+            log('[INFO] 장치 다시 등록: Config %s개', count)
+
+    
+    # 다시 등록한 장치의 State Publish (HA가 장치를 잃었던 경우)
+    def refresh_device(discovery_name):
+        if STATE_JSON:
+            keys = [doc_id for doc_id in STATE_DOCS if doc_id == discovery_name or discovery_name.startswith(doc_id + '_')]
+        else:
+            keys = [key for key in STATE_TOPICS if key.startswith(discovery_name)]
+        for key in keys:
+            refresh_state(key)
+
+    
+    # 등록이 끝난 장치의 보관된 State Publish
+    def discovery_ready(discovery_name, ready):
+        # 재시작 전에 예약된 경우 무시
+        if ready is not DISCOVERY_READY:
+            return
+        
+        ready.add(discovery_name)
+        for state, value in HELD_STATES.pop(discovery_name, {}).items():
+            publish_state(discovery_name, state, value)
+            
+        if DIRTY_DOCS:
+            publish_state_docs()
 
     
     # 장치 State를 MQTT로 Publish
@@ -609,38 +1265,111 @@ def ezville_loop(config):
         deviceID = '{}_{:0>2d}_{:0>2d}'.format(device, id1, id2)
         key = deviceID + state
         
-        if value != DEVICE_STATE.get(key) or FORCE_UPDATE:
+        if value != DEVICE_STATE.get(key) or key not in SEEN_STATES:
+            SEEN_STATES.add(key)
             DEVICE_STATE[key] = value
             
-            topic = STATE_TOPIC.format(deviceID, state)
-            mqtt_client.publish(topic, value.encode())
-                    
-            if mqtt_log:
-                log('[LOG] ->> HA : {} >> {}'.format(topic, value))
+            # 목표 State에 도달한 Command가 있으면 ACK를 못 받았어도 완료 처리
+            if ACK_WAITERS:
+                resolve_state(key, value)
+            
+            # 아직 등록이 끝나지 않은 장치는 State를 보관했다가 등록 후 Publish
+            if deviceID not in DISCOVERY_READY:
+                HELD_STATES.setdefault(deviceID, {})[state] = value
+                return
+            
+            publish_state(deviceID, state, value)
 
         return
 
     
+    def publish_state(deviceID, state, value):
+        # state_json 모드는 문서만 갱신하고 EW11_process 끝에서 한번에 Publish
+        if STATE_JSON:
+            doc_id, field = state_doc(deviceID, state)
+            STATE_DOCS.setdefault(doc_id, {})[field] = value
+            STATE_DEVICES.setdefault(doc_id, set()).add(deviceID)
+            DIRTY_DOCS.add(doc_id)
+            return
+        
+        topic = STATE_TOPIC.format(deviceID, state)
+        mqtt_client.publish(topic, value.encode())
+        STATE_TOPICS[deviceID + state] = topic
+        STATE_DEVICES.setdefault(deviceID + state, set()).add(deviceID)
+                
+        if mqtt_log:
+            log('[LOG] ->> HA : %s >> %s', topic, value)
+
+    
+    # 바뀐 JSON 문서 Publish, 문서 전체가 이전에 보낸 것과 같으면 생략
+    def publish_state_docs():
+        for doc_id in DIRTY_DOCS:
+            payload = json.dumps(STATE_DOCS[doc_id], sort_keys=True)
+            
+            if payload != LAST_DOCS.get(doc_id):
+                LAST_DOCS[doc_id] = payload
+                
+                topic = STATE_DOC_TOPIC.format(doc_id)
+                mqtt_client.publish(topic, payload.encode())
+                
+                if mqtt_log:
+                    log('[LOG] ->> HA : %s >> %s', topic, payload)
+                    
+        DIRTY_DOCS.clear()
+
+    
+    # ACK Header가 일치하는 Command 완료 처리
+    def resolve_ack(ack):
+        waiter = ACK_WAITERS.get(ack)
+        if waiter and not waiter[0].done():
+            waiter[0].set_result(True)
+            TRACES.ack(waiter[1][0])
+
+
+    # 목표 State에 도달한 Command 완료 처리
+    def resolve_state(key, value):
+        for ack_future, statcmd in ACK_WAITERS.values():
+            if statcmd[0] == key and statcmd[1] == value and not ack_future.done():
+                ack_future.set_result(True)
+                TRACES.ack(key)
+    
+    
+    # 디버그 Command 처리: ezville/debug/trace/command (dump) -> Command 단계별 시간 기록 Publish
+    def debug_process(topics, value):
+        if topics[2] == 'trace' and value == 'dump':
+            trace = TRACES.dump()
+            log('[INFO] Command 기록: 장치 종류 %s개, 느린 Command %s개', len(trace['stats']), len(trace['slowest']))
+            mqtt_client.publish(HA_TOPIC + '/debug/trace/state', json.dumps(trace))
+        else:
+            log('[WARNING] 지원하지 않는 디버그 Command: %s -> %s', '/'.join(topics), value)
+    
+    
     # HA에서 전달된 메시지 처리        
-    async def HA_process(topics, value):
+    async def HA_process(topics, value, received=None):
         nonlocal CMD_QUEUE
 
         device_info = topics[1].split('_')
         device = device_info[0]
         
         if mqtt_log:
-            log('[LOG] HA ->> : {} -> {}'.format('/'.join(topics), value))
+            log('[LOG] HA ->> : %s -> %s', '/'.join(topics), value)
 
-        if device in RS485_DEVICE:
+        # 전체 Command 버튼은 State를 알고 있는 장치들의 개별 Command로 풀어서 처리 (Broadcast로 합쳐짐)
+        if device_info[1:] == ['all']:
+            await HA_broadcast(device, topics, value, received)
+            
+        elif device in RS485_DEVICE:
             key = topics[1] + topics[2]
             idx = int(device_info[1])
             sid = int(device_info[2])
             cur_state = DEVICE_STATE.get(key)
             
+            # 이미 원하는 상태면 대기 중이거나 재시도 중인 이전 Command는 더 이상 필요 없음
             if value == cur_state:
-                pass
+                CMD_QUEUE.discard(key)
             
             else:
+                TRACES.start(key, device, value, received)
                 if device == 'thermostat':                        
                     if topics[2] == 'power':
                         if value == 'heat':
@@ -649,7 +1378,7 @@ def ezville_loop(config):
                             recvcmd = 'F7' + RS485_DEVICE[device]['power']['id'] + '1' + str(idx) + RS485_DEVICE[device]['power']['ack']
                             statcmd = [key, value]
                            
-                            await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                            CMD_QUEUE.put(key, {'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
                         
                         # Thermostat는 외출 모드를 Off 모드로 연결
                         elif value == 'off':
@@ -658,7 +1387,7 @@ def ezville_loop(config):
                             recvcmd = 'F7' + RS485_DEVICE[device]['away']['id'] + '1' + str(idx) + RS485_DEVICE[device]['away']['ack']
                             statcmd = [key, value]
                            
-                            await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                            CMD_QUEUE.put(key, {'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
                         
 #                        elif value == 'off':
 #                        
@@ -669,7 +1398,7 @@ def ezville_loop(config):
 #                            await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})                    
                                                
                         if debug:
-                            log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
+                            log('[DEBUG] Queued ::: sendcmd: %s, recvcmd: %s, statcmd: %s', sendcmd, recvcmd, statcmd)
                                     
                     elif topics[2] == 'setTemp':                            
                         value = int(float(value))
@@ -678,10 +1407,10 @@ def ezville_loop(config):
                         recvcmd = 'F7' + RS485_DEVICE[device]['target']['id'] + '1' + str(idx) + RS485_DEVICE[device]['target']['ack']
                         statcmd = [key, str(value)]
 
-                        await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                        CMD_QUEUE.put(key, {'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
                                
                         if debug:
-                            log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
+                            log('[DEBUG] Queued ::: sendcmd: %s, recvcmd: %s, statcmd: %s', sendcmd, recvcmd, statcmd)
 
 #                    elif device == 'Fan':
 #                        if topics[2] == 'power':
@@ -708,10 +1437,10 @@ def ezville_loop(config):
                     recvcmd = 'F7' + RS485_DEVICE[device]['power']['id'] + '1' + str(idx) + RS485_DEVICE[device]['power']['ack']
                     statcmd = [key, value]
                     
-                    await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                    CMD_QUEUE.put(key, {'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
                                
                     if debug:
-                        log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
+                        log('[DEBUG] Queued ::: sendcmd: %s, recvcmd: %s, statcmd: %s', sendcmd, recvcmd, statcmd)
                                 
                 elif device == 'plug':                         
                     pwr = '01' if value == 'ON' else '00'
@@ -720,22 +1449,22 @@ def ezville_loop(config):
                     recvcmd = 'F7' + RS485_DEVICE[device]['power']['id'] + '1' + str(idx) + RS485_DEVICE[device]['power']['ack']
                     statcmd = [key, value]
                         
-                    await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                    CMD_QUEUE.put(key, {'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
                                
                     if debug:
-                        log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
+                        log('[DEBUG] Queued ::: sendcmd: %s, recvcmd: %s, statcmd: %s', sendcmd, recvcmd, statcmd)
                                 
                 elif device == 'gasvalve':
                     # 가스 밸브는 ON 제어를 받지 않음
                     if value == 'OFF':
                         sendcmd = checksum('F7' + RS485_DEVICE[device]['power']['id'] + '0' + str(idx) + RS485_DEVICE[device]['power']['cmd'] + '0100' + '0000')
-                        recvcmd = ['F7' + RS485_DEVICE[device]['power']['id'] + '1' + str(idx) + RS485_DEVICE[device]['power']['ack']]
+                        recvcmd = 'F7' + RS485_DEVICE[device]['power']['id'] + '0' + str(idx) + RS485_DEVICE[device]['power']['ack']
                         statcmd = [key, value]
 
-                        await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                        CMD_QUEUE.put(key, {'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
                                
                         if debug:
-                            log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
+                            log('[DEBUG] Queued ::: sendcmd: %s, recvcmd: %s, statcmd: %s', sendcmd, recvcmd, statcmd)
                                 
                 elif device == 'batch':
                     # Batch는 Elevator 및 외출/그룹 조명 버튼 상태 고려 
@@ -765,52 +1494,198 @@ def ezville_loop(config):
                     recvcmd = 'NULL'
                     statcmd = [key, 'NULL']
                     
-                    await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                    CMD_QUEUE.put(key, {'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
                     
                     if debug:
-                        log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
+                        log('[DEBUG] Queued ::: sendcmd: %s, recvcmd: %s, statcmd: %s', sendcmd, recvcmd, statcmd)
+            
+            # 대기 중인 Command가 전체/그룹 Command와 같아졌는지 확인
+            if device in BROADCAST_COMMAND and topics[2] == BROADCAST_COMMAND[device]['state']:
+                plan_broadcast(device)
+  
+    
+    # 전체 Command 버튼 처리
+    async def HA_broadcast(device, topics, value, received):
+        broadcast = BROADCAST_COMMAND.get(device)
+        if broadcast is None or topics[2] != broadcast['state'] or value != broadcast['value']:
+            log('[WARNING] 지원하지 않는 전체 Command: %s -> %s', '/'.join(topics), value)
+            return
+        
+        state = broadcast['state']
+        keys = [key for key in DEVICE_STATE if key.startswith(device + '_') and key.endswith(state)]
+        
+        # 아직 State를 받은 장치가 없으면 바로 Broadcast
+        if not keys:
+            key = device + '_all' + state
+            CMD_QUEUE.put(key, {'sendcmd': checksum(broadcast['sendcmd']), 'recvcmd': 'NULL', 'statcmd': [key, 'NULL'], 'targets': {}})
+            return
+        
+        for key in keys:
+            await HA_process([topics[0], key[:-len(state)], state, 'command'], value, received)
+
+    
+    # 대기 중인 개별 Command들이 전체/그룹 Command와 결과가 같으면 Broadcast Command 하나로 대체
+    def plan_broadcast(device):
+        broadcast = BROADCAST_COMMAND[device]
+        state = broadcast['state']
+        value = broadcast['value']
+        bkey = device + '_all' + state
+        
+        def match(key, item):
+            return key.startswith(device + '_') and key.endswith(state)
+        
+        # 대기 중인 Command (이미 대기 중인 Broadcast가 있으면 그 대상도 포함)
+        targets = {}
+        for key, item in CMD_QUEUE.pending(match):
+            if 'targets' in item:
+                targets.update(item['targets'])
+            # Broadcast 실패 후 개별 재시도 중인 Command가 있으면 다시 합치지 않음
+            elif item.get('fallback'):
+                return
+            elif item['statcmd'][1] == value:
+                targets[key] = (value, item)
+            else:
+                return
+        
+        # 전송 중인 Command도 같은 목표여야 함
+        running = set()
+        for key, item in CMD_QUEUE.inflight(match):
+            if 'targets' not in item and item['statcmd'][1] != value and not item.get('superseded'):
+                return
+            running.add(key)
+        
+        if len(targets) < BROADCAST_MIN_COMMANDS:
+            return
+        
+        # Command가 없는 장치는 이미 같은 State여야 전체 Command와 결과가 같음
+        for key, cur_state in DEVICE_STATE.items():
+            if match(key, None) and key not in targets and key not in running and cur_state != value:
+                return
+        
+        for key in targets:
+            CMD_QUEUE.discard(key)
+        CMD_QUEUE.put(bkey, {'sendcmd': checksum(broadcast['sendcmd']), 'recvcmd': 'NULL', 'statcmd': [bkey, 'NULL'], 'targets': targets})
+        
+        if debug:
+            log('[DEBUG] Broadcast ::: %s개 Command -> %s', len(targets), broadcast['sendcmd'])
   
                                                 
     # HA에서 전달된 명령을 EW11 패킷으로 전송
     async def send_to_ew11(send_data):
+        # Broadcast는 정해진 횟수만큼 연속 전송 후 개별 장치 State로 확인
+        if 'targets' in send_data:
+            await send_broadcast(send_data)
+            return
+        
+        # Ack나 State 업데이트가 불가한 경우 한번만 명령 전송 후 Return
+        if send_data['statcmd'][1] == 'NULL':
+            await write_to_ew11(send_data, 0)
+            TRACES.sent(send_data['statcmd'][0])
+            TRACES.finish(send_data['statcmd'][0], 'waived', 'sent')
+            return
+        
+        # 예상 ACK Header로 Future 등록, EW11_process에서 ACK나 목표 State 수신 시 완료됨
+        ack = bytes.fromhex(send_data['recvcmd'])
+        ack_future = loop.create_future()
+        ACK_WAITERS[ack] = [ack_future, send_data['statcmd']]
+        start = time.time()
+        
+        try:
+            for i in range(CMD_RETRY_COUNT):
+                if i > 0:
+                    COMMAND_RETRIES.inc()
+                await write_to_ew11(send_data, i)
+                TRACES.sent(send_data['statcmd'][0])
+                
+                # 첫 전송은 FIRST_WAITTIME초, 이후에는 정해진 간격 혹은 Random Backoff 시간 동안 ACK 대기
+                if i == 0:
+                    timeout = FIRST_WAITTIME
+                elif RANDOM_BACKOFF:
+                    timeout = random.randint(0, int(CMD_INTERVAL * 1000))/1000
+                else:
+                    timeout = CMD_INTERVAL
+                
+                try:
+                    await asyncio.wait_for(asyncio.shield(ack_future), timeout)
+                    ACK_LATENCY.observe(time.time() - start)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+                
+                if send_data['statcmd'][1] == DEVICE_STATE.get(send_data['statcmd'][0]):
+                    ACK_LATENCY.observe(time.time() - start)
+                    return
+                
+                # 재시도 중에 새 Command로 대체되었으면 중단
+                if send_data.get('superseded'):
+                    if debug:
+                        log('[DEBUG] 새 Command로 대체되어 재시도 중단: %s', send_data['sendcmd'])
+                    return
+        finally:
+            ACK_WAITERS.pop(ack, None)
+
+        COMMAND_FAILURES.inc()
+        TRACES.finish(send_data['statcmd'][0], 'failed', 'failed')
+        if ew11_log:
+            log('[SIGNAL] %s회 명령을 재전송하였으나 수행에 실패했습니다.. 다음의 Queue 삭제: %s', str(CMD_RETRY_COUNT), send_data)
+            return
+        
+        
+    # Broadcast Command 전송 및 확인
+    async def send_broadcast(send_data):
+        # 목표 State가 아닌 장치만 State 수신 대기 (ACK_WAITERS에 장치별 Key로 등록)
+        waiters = {}
+        for key, (value, item) in send_data['targets'].items():
+            if DEVICE_STATE.get(key) != value:
+                waiters[key] = ACK_WAITERS[('broadcast', key)] = [loop.create_future(), [key, value]]
+        
+        try:
+            for i in range(BROADCAST_REPEAT):
+                await write_to_ew11(send_data, i)
+                # Broadcast로 합쳐진 개별 Command도 전송한 것으로 기록
+                for key in send_data['targets']:
+                    TRACES.sent(key)
             
-        for i in range(CMD_RETRY_COUNT):
-            if ew11_log:
-                log('[SIGNAL] 신호 전송: {}'.format(send_data))
-                        
+            if waiters:
+                await asyncio.wait([waiter[0] for waiter in waiters.values()], timeout=BROADCAST_CONFIRM_TIME)
+        finally:
+            for key in waiters:
+                ACK_WAITERS.pop(('broadcast', key), None)
+        
+        # 확인되지 않은 장치는 개별 Command로 재시도 (그 사이 새 Command가 들어온 장치는 제외)
+        for key, (ack_future, statcmd) in waiters.items():
+            if not ack_future.done() and key not in CMD_QUEUE and DEVICE_STATE.get(key) != statcmd[1]:
+                log('[WARNING] Broadcast 결과 확인 실패, 개별 Command로 재시도: %s', key)
+                CMD_QUEUE.put(key, dict(send_data['targets'][key][1], fallback=True))
+        
+        
+    # Command 패킷 1회 전송
+    async def write_to_ew11(send_data, i):
+        nonlocal soc
+        
+        if ew11_log:
+            log('[SIGNAL] 신호 전송: %s', send_data)
+        
+        packet = bytes.fromhex(send_data['sendcmd'])
+        
+        async with EW11_WRITE_LOCK:
             if comm_mode == 'mqtt':
-                mqtt_client.publish(EW11_SEND_TOPIC, bytes.fromhex(send_data['sendcmd']))
+                mqtt_client.publish(EW11_SEND_TOPIC, packet)
             else:
-                nonlocal soc
                 try:
-                    soc.sendall(bytes.fromhex(send_data['sendcmd']))
+                    await loop.sock_sendall(soc, packet)
                 except OSError:
                     soc.close()
-                    soc = initiate_socket(soc)
-                    soc.sendall(bytes.fromhex(send_data['sendcmd']))
-            if debug:                     
-                log('[DEBUG] Iter. No.: ' + str(i + 1) + ', Target: ' + send_data['statcmd'][1] + ', Current: ' + DEVICE_STATE.get(send_data['statcmd'][0]))
-             
-            # Ack나 State 업데이트가 불가한 경우 한번만 명령 전송 후 Return
-            if send_data['statcmd'][1] == 'NULL':
-                return
-      
-            # FIRST_WAITTIME초는 ACK 처리를 기다림 (초당 30번 데이터가 들어오므로 ACK 못 받으면 후속 처리 시작)
-            if i == 0:
-                await asyncio.sleep(FIRST_WAITTIME)
-            # 이후에는 정해진 간격 혹은 Random Backoff 시간 간격을 주고 ACK 확인
-            else:
-                if RANDOM_BACKOFF:
-                    await asyncio.sleep(random.randint(0, int(CMD_INTERVAL * 1000))/1000)    
-                else:
-                    await asyncio.sleep(CMD_INTERVAL)
-              
-            if send_data['statcmd'][1] == DEVICE_STATE.get(send_data['statcmd'][0]):
-                return
-
-        if ew11_log:
-            log('[SIGNAL] {}회 명령을 재전송하였으나 수행에 실패했습니다.. 다음의 Queue 삭제: {}'.format(str(CMD_RETRY_COUNT),send_data))
-            return
+                    soc = initiate_socket()
+                    await loop.sock_sendall(soc, packet)
+            
+            COMMAND_SENDS.inc()
+            
+            # 다른 그룹의 Command가 RS485 상에서 이어 붙지 않도록 전송 시간만큼 Lock 유지
+            await asyncio.sleep(len(packet) * RS485_BYTE_TIME)
+            
+        if debug:                     
+            log('[DEBUG] Iter. No.: %s, Target: %s, Current: %s', i + 1, send_data['statcmd'][1], DEVICE_STATE.get(send_data['statcmd'][0]))
         
                                                 
     # EW11 동작 상태를 체크해서 필요시 리셋 실시
@@ -820,7 +1695,7 @@ def ezville_loop(config):
         
             # TIMEOUT 시간 동안 새로 받은 EW11 패킷이 없으면 재시작
             if timestamp - last_received_time > EW11_TIMEOUT:
-                log('[WARNING] {} {} {}초간 신호를 받지 못했습니다. ew11 기기를 재시작합니다.'.format(timestamp, last_received_time, EW11_TIMEOUT))
+                log('[WARNING] %s %s %s초간 신호를 받지 못했습니다. ew11 기기를 재시작합니다.', timestamp, last_received_time, EW11_TIMEOUT)
                 try:
                     await reset_EW11()
                     
@@ -864,9 +1739,11 @@ def ezville_loop(config):
                 soc = socket.socket()
                 soc.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
                 connect_socket(soc)
+                # 연결 후에는 asyncio loop에서 non-blocking으로 송수신
+                soc.setblocking(False)
                 return soc
             except ConnectionRefusedError as e:
-                log('[ERROR] Server에서 연결을 거부합니다. 재시도 예정 (' + str(retry_count) + '회 재시도)')
+                log('[ERROR] Server에서 연결을 거부합니다. 재시도 예정 (%s회 재시도)', retry_count)
                 time.sleep(1)
                 retry_count += 1
                 continue
@@ -878,66 +1755,216 @@ def ezville_loop(config):
 
     async def serial_recv_loop():
         nonlocal soc
-        nonlocal MSG_QUEUE
         
         class MSG:
-            topic = ''
-            payload = bytearray()
-        
-        msg = MSG()
+            topic = EW11_TOPIC + '/recv'
+            
+            def __init__(self, payload):
+                self.payload = payload
         
         while True:
             try:
-                # EW11 버퍼 크기만큼 데이터 받기
-                DATA = soc.recv(EW11_BUFFER_SIZE)
-                msg.topic = EW11_TOPIC + '/recv'
-                msg.payload = DATA   
+                # EW11 버퍼 크기만큼 데이터 받기 (데이터가 올 때까지 대기)
+                DATA = await loop.sock_recv(soc, EW11_BUFFER_SIZE)
+                # 빈 데이터는 EW11이 연결을 끊은 경우
+                if not DATA:
+                    raise ConnectionResetError('EW11 socket closed')
                 
-                MSG_QUEUE.put(msg)
+                MSG_QUEUE.put_nowait((MSG(DATA), time.monotonic()))
                 
             except OSError:
                 soc.close()
-                soc = initiate_socket(soc)
-         
-            await asyncio.sleep(SERIAL_RECV_DELAY) 
+                soc = initiate_socket()
         
         
     async def state_update_loop():
-        nonlocal force_target_time
-        nonlocal force_stop_time
-        nonlocal FORCE_UPDATE
-        
         while True:
-            await process_message()                    
+            # 새 메시지가 들어올 때까지 대기
+            msg, received = await MSG_QUEUE.get()
+            await process_message(msg, received)
             
-            timestamp = time.time()
             
-            # 정해진 시간이 지나면 FORCE 모드 발동
-            if timestamp > force_target_time and not FORCE_UPDATE and FORCE_MODE:
-                force_stop_time = timestamp + FORCE_DURATION
-                FORCE_UPDATE = True
-                log('[INFO] 상태 강제 업데이트 실시')
+    # 다시 Publish할 수 있는 State: 이번 실행에서 Bus로 받았고 장치 등록이 끝난 경우만 (Config보다 State가 먼저 가지 않도록)
+    def refreshable(key):
+        if not STATE_JSON and key not in SEEN_STATES:
+            return False
+        return not STATE_DEVICES.get(key, set()).isdisjoint(DISCOVERY_READY)
+            
+            
+    # 저장된 State 다시 Publish (Bus 패킷을 다시 해석하지 않고 State 저장소에서 바로)
+    def refresh_state(key):
+        if not refreshable(key):
+            return
+        if STATE_JSON:
+            doc = STATE_DOCS.get(key)
+            if doc is None:
+                return
+            topic = STATE_DOC_TOPIC.format(key)
+            payload = json.dumps(doc, sort_keys=True)
+            LAST_DOCS[key] = payload
+        else:
+            topic = STATE_TOPICS.get(key)
+            payload = DEVICE_STATE.get(key)
+            if topic is None or payload is None:
+                return
+            
+        mqtt_client.publish(topic, payload.encode())
+        
+        if mqtt_log:
+            log('[LOG] ->> HA : %s >> %s (강제 업데이트)', topic, payload)
+            
+            
+    async def force_update_loop():
+        # FORCE_SLICE초마다 조금씩 나눠서 보내고, FORCE_PERIOD마다 전체를 한번씩
+        credit = 0.0
+        
+        while True:
+            keys = [key for key in (STATE_DOCS if STATE_JSON else STATE_TOPICS) if refreshable(key)]
+            if not keys:
+                await asyncio.sleep(FORCE_SLICE)
+                continue
                 
-            # 정해진 시간이 지나면 FORCE 모드 종료    
-            if timestamp > force_stop_time and FORCE_UPDATE and FORCE_MODE:
-                force_target_time = timestamp + FORCE_PERIOD
-                FORCE_UPDATE = False
-                log('[INFO] 상태 강제 업데이트 종료')
+            rate = len(keys) / FORCE_PERIOD
+            if FORCE_RATE > 0:
+                rate = min(rate, FORCE_RATE)
+            log('[INFO] 상태 강제 업데이트: %s개, 초당 %.2f개 (%.0f초 주기)', len(keys), rate, len(keys) / rate)
+            
+            for key in keys:
+                while credit < 1:
+                    await asyncio.sleep(FORCE_SLICE)
+                    credit += rate * FORCE_SLICE
+                credit -= 1
+                refresh_state(key)
+            
+            
+    async def discovery_loop():
+        # Token Bucket: 처음 DISCOVERY_BURST개는 바로, 이후 평균 DISCOVERY_DELAY초마다 하나씩
+        tokens = DISCOVERY_BURST
+        last_time = time.time()
+        
+        while True:
+            discovery_name, configs, refresh = await DISCOVERY_QUEUE.get()
+            
+            for topic, config in configs:
+                if DISCOVERY_DELAY > 0:
+                    now = time.time()
+                    tokens = min(DISCOVERY_BURST, tokens + (now - last_time) / DISCOVERY_DELAY)
+                    last_time = now
+                    
+                    if tokens < 1:
+                        await asyncio.sleep((1 - tokens) * DISCOVERY_DELAY)
+                        tokens = 1
+                        last_time = time.time()
+                    tokens -= 1
+                    
+                await mqtt_discovery(topic, config)
+            
+            # HA가 등록을 처리할 시간을 준 후 State Publish (Parsing은 기다리지 않음)
+            if refresh:
+                loop.call_later(DISCOVERY_DELAY, refresh_device, discovery_name)
+            else:
+                loop.call_later(DISCOVERY_DELAY, discovery_ready, discovery_name, DISCOVERY_READY)
+            
+            # 등록할 장치가 더 없으면 등록 정보 저장
+            if DISCOVERY_QUEUE.empty():
+                REGISTRY.save()
+            
+            
+    # 스냅샷으로 저장할 State 복사본 (asyncio loop에서 복사하므로 저장 중에 바뀌지 않음)
+    def snapshot_state():
+        return {'device': dict(DEVICE_STATE)}
+            
+            
+    async def snapshot_loop():
+        # 바뀐 내용이 있으면 SNAPSHOT_INTERVAL초마다 저장, 파일 쓰기는 executor에서 (State 처리는 기다리지 않음)
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            data = SNAPSHOT.dumps(snapshot_state())
+            if data is not None:
+                await loop.run_in_executor(None, SNAPSHOT.write, data)
+            
+            
+    # 동작 지표 및 Counter의 지난 주기 동안의 초당 값 (_rate)
+    def diagnostics(last, elapsed):
+        values = METRICS.values()
+        doc = dict(values)
+        for name, value in values.items():
+            if name.endswith('_total'):
+                doc[name[:-len('_total')] + '_rate'] = round((value - last.get(name, 0)) / elapsed, 2)
+        return values, doc
+    
+    
+    # 동작 지표를 HA 진단 Sensor로 등록 (누적 값은 JSON과 /metrics에만)
+    # state_json 모드의 Topic 변환을 거치지 않도록 Config를 직접 만들어서 등록 Queue에 넣음
+    def queue_diagnostics_discovery(keys):
+        configs = []
+        for key in keys:
+            if key.endswith(('_total', '_count')):
+                continue
+            payload = {
+                '~': DIAGNOSTICS_TOPIC,
+                'name': 'ezville_diagnostics_{}'.format(key),
+                'stat_t': '~/state',
+                'val_tpl': '{{{{ value_json.{} }}}}'.format(key),
+                'ent_cat': 'diagnostic',
+                'stat_cla': 'measurement',
+                'device': DISCOVERY_DEVICE,
+                'uniq_id': 'ezville_diagnostics_{}'.format(key)
+            }
+            if key.endswith('_rate'):
+                payload['unit_of_meas'] = '/s'
+            elif key.endswith(('_seconds', '_seconds_avg')):
+                payload['unit_of_meas'] = 's'
+            
+            topic = 'homeassistant/sensor/ezville_wallpad/{}/config'.format(payload['name'])
+            config = json.dumps(payload)
+            REGISTRY.remember('diagnostics', topic, config)
+            if REGISTRY.changed(topic, config) or topic not in REGISTRY.announced:
+                configs.append((topic, config))
                 
-            # STATE_LOOP_DELAY 초 대기 후 루프 진행
-            await asyncio.sleep(STATE_LOOP_DELAY)
+        if configs:
+            DISCOVERY_QUEUE.put_nowait(('diagnostics', configs, False))
             
             
-    async def command_loop():
-        nonlocal CMD_QUEUE
+    async def diagnostics_loop():
+        last, last_time = {}, time.time()
+        queue_diagnostics_discovery(diagnostics(last, 1)[1])
         
         while True:
-            if not CMD_QUEUE.empty():
-                send_data = await CMD_QUEUE.get()
-                await send_to_ew11(send_data)               
+            await asyncio.sleep(DIAGNOSTICS_INTERVAL)
+            now = time.time()
+            last, doc = diagnostics(last, now - last_time)
+            last_time = now
+            mqtt_client.publish(DIAGNOSTICS_TOPIC + '/state', json.dumps(doc), retain=True)
+            
             
-            # COMMAND_LOOP_DELAY 초 대기 후 루프 진행
-            await asyncio.sleep(COMMAND_LOOP_DELAY)    
+    async def command_loop():
+        # 진행 중인 장치 그룹 및 Task
+        busy_groups = set()
+        tasks = set()
+        
+        async def run_command(key, send_data, group):
+            try:
+                await send_to_ew11(send_data)
+            finally:
+                busy_groups.discard(group)
+                CMD_QUEUE.task_done(key)
+        
+        try:
+            while True:
+                # 진행 중이 아닌 그룹의 새 명령이 들어올 때까지 대기
+                key, send_data = await CMD_QUEUE.get(lambda item: command_group(item) not in busy_groups)
+                
+                group = command_group(send_data)
+                busy_groups.add(group)
+                
+                task = loop.create_task(run_command(key, send_data, group))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            # 재시작 시 진행 중인 Command도 중단
+            for task in tasks:
+                task.cancel()               
  
 
     # EW11 재실행 시 리스타트 실시
@@ -982,16 +2009,17 @@ def ezville_loop(config):
     mqtt_client.on_connect = on_connect
     mqtt_client.on_disconnect = on_disconnect
     mqtt_client.on_message = on_message
+    mqtt_client.on_publish = on_publish
     mqtt_client.connect_async(config['mqtt_server'])
     
     # asyncio loop 획득 및 EW11 오류시 재시작 task 등록
     loop = asyncio.get_event_loop()
     loop.create_task(restart_control())
-        
-    # Discovery 및 강제 업데이트 시간 설정
-    force_target_time = time.time() + FORCE_PERIOD
-    force_stop_time = force_target_time + FORCE_DURATION
     
+    # 동작 지표 HTTP 제공 (재시작과 관계없이 계속 유지)
+    if METRICS_PORT > 0:
+        METRICS.serve(METRICS_PORT)
+        
 
     while True:
         # MQTT 통신 시작
@@ -1017,6 +2045,19 @@ def ezville_loop(config):
             tasklist.append(loop.create_task(serial_recv_loop()))
         # EW11 패킷 기반 state 업데이트 loop 실행
         tasklist.append(loop.create_task(state_update_loop()))
+        # MQTT Discovery 등록 loop 실행
+        tasklist.append(loop.create_task(discovery_loop()))
+        # State 스냅샷 저장 loop 실행
+        if SNAPSHOT_INTERVAL > 0:
+            tasklist.append(loop.create_task(snapshot_loop()))
+        # 동작 지표 Publish loop 실행
+        if DIAGNOSTICS_INTERVAL > 0:
+            tasklist.append(loop.create_task(diagnostics_loop()))
+        # 강제 업데이트 timer loop 실행
+        if FORCE_MODE and FORCE_PERIOD > 0:
+            tasklist.append(loop.create_task(force_update_loop()))
+        elif FORCE_MODE:
+            log('[WARNING] force_update_period가 0 이하라서 상태 강제 업데이트를 하지 않습니다.')
         # Home Assistant 명령 실행 loop 실행
         tasklist.append(loop.create_task(command_loop()))
         # EW11 상태 체크 loop 실행
@@ -1033,17 +2074,27 @@ def ezville_loop(config):
 
         ADDON_STARTED = False
         
+        # 재시작 전 State 저장 (재시작 후에는 저장한 State부터 시작)
+        SNAPSHOT.save(snapshot_state())
+        
         # 주요 변수 초기화    
-        MSG_QUEUE = Queue()
-        CMD_QUEUE = asyncio.Queue()
-        DEVICE_STATE = {}
+        MSG_QUEUE = asyncio.Queue()
+        CMD_QUEUE = CoalescingQueue()
+        ACK_WAITERS = {}
+        EW11_WRITE_LOCK = asyncio.Lock()
+        DEVICE_STATE = SNAPSHOT.get('device')
         MSG_CACHE = {}
-        DISCOVERY_LIST = []
-        RESIDUE = ''
+        DISCOVERY_QUEUE = asyncio.Queue()
+        DISCOVERY_READY = set()
+        HELD_STATES = {}
+        DIRTY_DOCS = set()
+        DISCOVERY_LIST = set()
+        RESIDUE = bytearray()
 
 
 if __name__ == '__main__':
     with open(config_dir + '/options.json') as file:
         CONFIG = json.load(file)
     
+    init_logger(CONFIG['log_rate_limit'])
     ezville_loop(CONFIG)
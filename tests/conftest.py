@@ -0,0 +1,42 @@
+import os
+import sys
+import json
+import logging
+import importlib.util
+
+import pytest
+
+# 애드온과 도구는 패키지가 아니므로 파일 경로로 불러옴
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOLS = os.path.join(ROOT, "tools")
+WALLPAD = os.path.join(ROOT, "ezville_wallpad")
+EZVILLE = os.path.join(ROOT, "simple_mqtt_ezville_control")
+sys.path[:0] = [TOOLS, WALLPAD]
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def wallpad():
+    # 테스트마다 새로 불러서 모듈 전역 상태 (scheduler, 마지막 상태 등) 를 공유하지 않음
+    pytest.importorskip("serial")
+    pytest.importorskip("paho.mqtt.client")
+    addon = load_module("ezville_wallpad", os.path.join(WALLPAD, "ezville_wallpad.py"))
+    addon.logger.setLevel(logging.CRITICAL)
+    with open(os.path.join(WALLPAD, "config.json")) as f:
+        addon.Options = json.load(f)["options"]
+    addon.Options["mqtt"]["_discovery"] = addon.Options["mqtt"]["discovery"]
+    return addon
+
+
+@pytest.fixture
+def ezville():
+    pytest.importorskip("paho.mqtt.client")
+    addon = load_module("ezville", os.path.join(EZVILLE, "ezville.py"))
+    addon.LOGGER.setLevel(logging.CRITICAL)
+    return addon
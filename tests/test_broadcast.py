@@ -0,0 +1,32 @@
+def light_off(idn):
+    # F7 0E 1x 41 03 id 00 00 XOR ADD, pos 6가 0 (끄기)
+    return bytes([0xF7, 0x0E, 0x11, 0x41, 0x03, idn, 0x00, 0x00, 0x00, 0x00])
+
+
+def test_merged_command_traces_finish_or_hand_over(wallpad):
+    now = 1000.0
+    keys = [("light", "1_1", "power"), ("light", "1_2", "power")]
+    for i, key in enumerate(keys, 1):
+        wallpad.command_trace.start(key, "OFF", 0.0)
+        wallpad.serial_queue.put(key, light_off(i), now=now)
+
+    wallpad.broadcast_planner.plan(now)
+    bkey = ("light", "all", "power")
+    assert bkey in wallpad.serial_queue and not any(key in wallpad.serial_queue for key in keys)
+
+    # broadcast 전송은 합친 명령의 기록에 남음
+    wallpad.broadcast_planner.sent(bkey)
+    assert all(wallpad.command_trace._active[key]["sends"] == 1 for key in keys)
+
+    # 상태가 확인된 장치는 완료
+    wallpad.serial_queue.pop(bkey, wallpad.serial_make_broadcast("light", "power", "1", 0))
+    wallpad.last_topic_list["ezville/light/1_1/power/state"] = "OFF"
+    wallpad.broadcast_planner.check(now + 1)
+    assert keys[0] not in wallpad.command_trace._active
+    assert wallpad.command_trace._done[-1]["result"] == "acked"
+
+    # 확인되지 않은 장치는 개별 명령으로 다시 보내고 기록도 이어감
+    wallpad.broadcast_planner.check(now + 1 + wallpad.BROADCAST_CONFIRM_TIME + 1)
+    assert keys[1] in wallpad.serial_queue
+    assert wallpad.command_trace._active[keys[1]]["sends"] == 1
+    assert not wallpad.broadcast_planner._confirm
@@ -0,0 +1,51 @@
+import asyncio
+
+
+def test_newer_command_replaces_pending_in_place(ezville):
+    async def run():
+        queue = ezville.CoalescingQueue()
+        queue.put("light_01_01", {"value": "ON"})
+        queue.put("light_01_02", {"value": "ON"})
+        queue.put("light_01_01", {"value": "OFF"})
+        return [await queue.get(), await queue.get()], queue.empty()
+
+    got, empty = asyncio.run(run())
+    # 먼저 들어온 순서는 유지하고 마지막 값만 보냄
+    assert got == [("light_01_01", {"value": "OFF"}), ("light_01_02", {"value": "ON"})]
+    assert empty
+
+
+def test_newer_command_supersedes_inflight(ezville):
+    async def run():
+        queue = ezville.CoalescingQueue()
+        queue.put("light_01_01", {"value": "ON"})
+        key, inflight = await queue.get()
+        queue.put("light_01_01", {"value": "OFF"})
+        assert inflight["superseded"]
+        assert "light_01_01" in queue
+
+        queue.task_done(key)
+        return await queue.get()
+
+    assert asyncio.run(run()) == ("light_01_01", {"value": "OFF"})
+
+
+def test_get_waits_for_ready_command(ezville):
+    async def run():
+        queue = ezville.CoalescingQueue()
+        queue.put("light_01_01", {"group": "light_01"})
+        queue.put("thermostat_01_01", {"group": "thermostat_01"})
+        busy = {"light_01"}
+        first = await queue.get(lambda item: item["group"] not in busy)
+
+        # 진행중인 그룹의 Command는 그룹이 끝나고 깨어날 때 꺼냄
+        waiter = asyncio.ensure_future(queue.get(lambda item: item["group"] not in busy))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        busy.clear()
+        queue.task_done(first[0])
+        return first, await asyncio.wait_for(waiter, 1)
+
+    first, second = asyncio.run(run())
+    assert first[0] == "thermostat_01_01"
+    assert second[0] == "light_01_01"
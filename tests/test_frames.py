@@ -0,0 +1,57 @@
+import pytest
+
+from test_simulator import replay
+import wallpad_simulator
+
+LIGHT = wallpad_simulator.checksum([0xF7, 0x0E, 0x11, 0x81, 0x03, 0x00, 0x01, 0x00])
+GAS = wallpad_simulator.checksum([0xF7, 0x12, 0x01, 0x81, 0x03, 0x00, 0x01, 0x00])
+
+
+def corrupt(frame):
+    return frame[:-1] + bytes([frame[-1] ^ 0x01])
+
+
+def frames(reader):
+    result = []
+    while True:
+        frame = reader.next_frame()
+        if frame is None:
+            return result
+        result.append(frame)
+
+
+def test_reader_skips_bad_checksum(wallpad):
+    reader = wallpad.EzVilleFrameReader()
+    reader.feed(corrupt(LIGHT) + b"\xAA\x55" + LIGHT + GAS[:4])
+    assert frames(reader) == [LIGHT]
+    # 잘린 패킷은 나머지를 받을 때까지 기다림
+    reader.feed(GAS[4:])
+    assert frames(reader) == [GAS]
+    assert reader.checksum_errors == 1
+
+
+def test_reader_resyncs_inside_bad_length(wallpad):
+    # 길이 Byte가 깨진 패킷은 그 길이만큼 받은 뒤 checksum 오류로 버리고, 그 안의 F7부터 다시 찾음
+    reader = wallpad.EzVilleFrameReader()
+    reader.feed(b"\xF7\x0E\x11\x81\x20" + LIGHT + GAS)
+    assert frames(reader) == []
+    reader.feed((LIGHT + GAS) * 3)
+    assert frames(reader) == [LIGHT, GAS] * 4
+    assert reader.checksum_errors == 1
+
+
+def test_both_addons_resync_after_bad_checksum(tmp_path):
+    pytest.importorskip("serial")
+    pytest.importorskip("paho.mqtt.client")
+
+    log = tmp_path / "corrupt.log"
+    with open(log, "w") as f:
+        for _ in range(3):
+            f.write("[SIGNAL] receved: {}\n".format((corrupt(LIGHT) + b"\xAA\x55" + LIGHT + GAS).hex().upper()))
+
+    ezville = replay("ezville", log, tmp_path / "ezville.jsonl")
+    wallpad = replay("wallpad", log, tmp_path / "wallpad.jsonl")
+    assert ezville["ezville/light_01_01/power/state"] == "ON"
+    assert ezville["ezville/light_01_02/power/state"] == "OFF"
+    assert wallpad["ezville/light/1_1_1/power/state"] == "ON"
+    assert wallpad["ezville/light/1_1_2/power/state"] == "OFF"
@@ -0,0 +1,55 @@
+import logging
+
+import pytest
+
+
+def record(message, created, level=logging.INFO):
+    return logging.makeLogRecord({"msg": message, "args": (), "levelno": level, "created": created})
+
+
+@pytest.fixture(params=["wallpad", "ezville"])
+def rate_limit(request):
+    return request.getfixturevalue(request.param).LogRateLimit()
+
+
+def test_log_token_bucket(rate_limit):
+    rate_limit.rate = 2
+    # 처음에는 rate개까지 바로, 이후 초당 rate개
+    assert [rate_limit.filter(record("recv %s", 100)) for _ in range(3)] == [True, True, False]
+    assert not rate_limit.filter(record("recv %s", 100.4))
+    passed = record("recv %s", 100.5)
+    assert rate_limit.filter(passed)
+    # 버린 개수는 같은 종류의 다음 로그에 붙음
+    assert passed.args == (2,)
+
+    # 다른 종류와 WARNING 이상은 따로
+    assert rate_limit.filter(record("send %s", 100.5))
+    assert rate_limit.filter(record("recv %s", 100.5, logging.WARNING))
+
+
+def test_log_rate_zero_is_unlimited(rate_limit):
+    assert all(rate_limit.filter(record("recv %s", 100)) for _ in range(100))
+
+
+def test_reannounce_rate(wallpad):
+    class Publisher:
+        def __init__(self):
+            self.count = 0
+
+        def publish(self, topic, payload, retain=False):
+            self.count += 1
+
+    wallpad.mqtt = Publisher()
+    wallpad.Options["mqtt"]["reannounce_rate"] = 2
+    for i in range(20):
+        wallpad.reannouncer.remember("homeassistant/light/ezville_wallpad/light_{}/config".format(i), "{}")
+    wallpad.reannouncer.request()
+
+    # 처음에 REANNOUNCE_BURST개, 이후 초당 reannounce_rate개, 오래 쉬어도 burst 이상은 한번에 보내지 않음
+    wallpad.reannouncer.step(100)
+    assert wallpad.mqtt.count == wallpad.REANNOUNCE_BURST
+    wallpad.reannouncer.step(101)
+    assert wallpad.mqtt.count == wallpad.REANNOUNCE_BURST + 2
+    wallpad.reannouncer.step(200)
+    assert wallpad.mqtt.count == 2 * wallpad.REANNOUNCE_BURST + 2
+    assert wallpad.reannouncer.pending() == 20 - wallpad.mqtt.count
@@ -0,0 +1,44 @@
+class Publisher:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload, retain=False):
+        self.messages.append((topic, payload, retain))
+
+    def subscribe(self, topic, qos):
+        pass
+
+
+class Message:
+    def __init__(self, topic, payload, retain):
+        self.topic = topic
+        self.payload = payload.encode()
+        self.retain = retain
+
+
+def test_reconnect_reannounces_without_resetting_bus_state(wallpad):
+    wallpad.mqtt = Publisher()
+    wallpad.Options["mqtt"]["_discovery"] = False
+    wallpad.RS485_DEVICE["light"]["last"] = {0x11: True}
+    config = '{"~": "ezville/light/1_1", "stat_t": "~/power/state"}'
+    wallpad.reannouncer.remember("homeassistant/light/ezville_wallpad/light_1_1/config", config)
+    wallpad.last_topic_list["ezville/light/1_1/power/state"] = "ON"
+    wallpad.state_seen.add("ezville/light/1_1/power/state")
+
+    wallpad.mqtt_on_connect(wallpad.mqtt, None, None, 0)
+    # subscribe할 때 오는 retain된 birth message는 연결시 요청과 합쳐짐
+    wallpad.mqtt_on_message(wallpad.mqtt, None, Message("homeassistant/status", "online", True))
+    for now in range(10):
+        wallpad.reannouncer.step(now)
+
+    assert [topic for topic, payload, retain in wallpad.mqtt.messages] == [
+        "homeassistant/light/ezville_wallpad/light_1_1/config",
+        "ezville/light/1_1/power/state",
+    ]
+    assert wallpad.RS485_DEVICE["light"]["last"] == {0x11: True}
+    assert not wallpad.Options["mqtt"]["_discovery"]
+
+    # 연결 중에 HA가 재시작되면 다시 보냄
+    wallpad.mqtt_on_message(wallpad.mqtt, None, Message("homeassistant/status", "online", False))
+    wallpad.reannouncer.step(20)
+    assert len(wallpad.mqtt.messages) == 4
@@ -0,0 +1,102 @@
+import time
+
+import pytest
+
+
+class Loop:
+    def __init__(self):
+        self.timers = []
+
+    def call_later(self, delay, callback, *args):
+        self.timers.append((delay, callback, args))
+
+
+class Conn:
+    checksum_errors = 0
+    recv_time = 0
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, packet):
+        self.sent.append(packet)
+
+    def check_pending_recv(self):
+        return False
+
+    def set_pending_recv(self):
+        pass
+
+    def buffered(self):
+        return 0
+
+
+def test_async_retry_runs_from_timer(wallpad):
+    wallpad.conn = Conn()
+    wallpad.serial_event_loop = Loop()
+    packet = bytes([0xF7, 0x0E, 0x11, 0x41, 0x03, 0x01, 0x01, 0x00, 0x00, 0x00])
+    wallpad.serial_queue.put(("light", "1_1", "power"), packet)
+
+    assert wallpad.serial_send_command()
+    (delay, callback, args), = wallpad.serial_event_loop.timers
+    assert delay == pytest.approx(wallpad.SERIAL_ACK_TIMEOUT)
+
+    # 재전송 시각에 bus가 비어 있으면 다음 패킷을 기다리지 않고 전송
+    time.sleep(delay)
+    wallpad.serial_last_frame = bytes([0xF7, 0x0E, 0x1F, 0x81, 0x00, 0x00, 0x00])
+    callback(*args)
+    assert wallpad.conn.sent == [packet, packet]
+    assert len(wallpad.serial_event_loop.timers) == 2
+
+
+def test_priority_then_arrival_order(wallpad):
+    queue = wallpad.SerialScheduler()
+    queue.put("a", b"a", 0, now=100)
+    queue.put("b", b"b", 1, now=100)
+    queue.put("c", b"c", 0, now=100)
+    order = []
+    for _ in range(3):
+        (key, packet, queued), expired = queue.take(100)
+        queue.pop(key, packet)
+        order.append(key)
+    assert order == ["b", "a", "c"]
+
+
+def test_retry_backoff_doubles_up_to_limit(wallpad):
+    queue = wallpad.SerialScheduler()
+    queue.put("a", b"a", now=100)
+    now = 100
+    delays = []
+    for _ in range(5):
+        (key, packet, queued), expired = queue.take(now)
+        due = queue.retry_later(key, packet, now)
+        delays.append(round(due - now, 3))
+        # 재전송 시각 전에는 보내지 않음
+        assert queue.take(due - 0.01) == (None, [])
+        now = due
+    assert delays == [0.3, 0.6, 1.2, 2.0, 2.0]
+    assert queue.retries == 4
+
+
+def test_other_commands_go_out_during_backoff(wallpad):
+    queue = wallpad.SerialScheduler()
+    queue.put("a", b"a", 1, now=100)
+    queue.take(100)
+    queue.retry_later("a", b"a", 100)
+    queue.put("b", b"b", 0, now=100.1)
+    assert queue.take(100.1)[0][0] == "b"
+    queue.pop("b", b"b")
+    # 우선순위가 높은 명령이 재전송 시각이 되면 먼저
+    queue.put("c", b"c", 0, now=100.2)
+    assert queue.take(100.4)[0][0] == "a"
+
+
+def test_expired_command_is_dropped(wallpad):
+    queue = wallpad.SerialScheduler()
+    queue.put("a", b"a", now=100)
+    queue.take(100)
+    queue.retry_later("a", b"a", 100)
+    command, expired = queue.take(101 + wallpad.Options["rs485"]["max_retry"])
+    assert command is None
+    assert expired == [("a", b"a")]
+    assert "a" not in queue and queue.expired == 1
@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+from conftest import ROOT, TOOLS
+import wallpad_simulator
+
+
+def replay(target, log, output):
+    # 두 애드온 모두 capture_replay로 실제 parser를 거쳐서 HA로 보내는 메시지를 받음
+    subprocess.run([sys.executable, os.path.join(TOOLS, "capture_replay.py"), target, str(log), "--output", str(output)],
+                   cwd=ROOT, check=True, capture_output=True, timeout=60)
+    with open(output) as f:
+        return {message["topic"]: message["payload"] for message in map(json.loads, f)}
+
+
+def test_checksum_round_trip():
+    frame = wallpad_simulator.checksum([0xF7, 0x36, 0x1F, 0x01, 0x00])
+    assert frame.hex() == "f7361f0100df2c"
+    assert wallpad_simulator.verify_checksum(frame)
+    assert not wallpad_simulator.verify_checksum(frame[:-1] + b"\x00")
+
+
+def test_thermostat_command_sets_only_that_room():
+    devices = wallpad_simulator.Devices([1], 4, [])
+    # 3번 방 외출
+    ack = devices.command(wallpad_simulator.checksum([0xF7, 0x36, 0x13, 0x45, 0x01, 0x01]), 0)
+    assert ack[3] == 0xC5
+    assert [(devices.heat >> room) & 1 for room in range(4)] == [1, 1, 0, 1]
+    assert [(devices.away >> room) & 1 for room in range(4)] == [0, 0, 1, 0]
+
+
+def test_thermostat_rooms_match_between_addons(tmp_path):
+    pytest.importorskip("serial")
+    pytest.importorskip("paho.mqtt.client")
+
+    # 방마다 다른 상태로 (bit 순서가 뒤집히면 다른 방의 상태로 보임)
+    devices = wallpad_simulator.Devices([1], 4, [])
+    for room in (1, 2, 3):
+        devices._set_heat(room, False)
+    log = tmp_path / "snapshot.log"
+    with open(log, "w") as f:
+        for _ in range(3):
+            for frame in devices.snapshot():
+                f.write("[SIGNAL] receved: {}\n".format(frame.hex().upper()))
+
+    ezville = replay("ezville", log, tmp_path / "ezville.jsonl")
+    wallpad = replay("wallpad", log, tmp_path / "wallpad.jsonl")
+
+    for room in range(1, 5):
+        heat = (devices.heat >> (room - 1)) & 1
+        away = (devices.away >> (room - 1)) & 1
+        assert ezville["ezville/thermostat_{:02d}_01/power/state".format(room)] == ("heat" if heat else "off")
+        assert wallpad["ezville/thermostat/1_{}/power/state".format(room)] == ("ON" if heat else "OFF")
+        assert wallpad["ezville/thermostat/1_{}/away/state".format(room)] == ("ON" if away else "OFF")
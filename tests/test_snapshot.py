@@ -0,0 +1,35 @@
+def test_wallpad_snapshot_round_trip(wallpad, tmp_path):
+    path = str(tmp_path / "state.pickle")
+    state = {"topics": {"ezville/light/1_1/power/state": "ON"}, "docs": {"ezville/light/1/state": '{"1": "ON"}'}}
+
+    snapshot = wallpad.StateSnapshot()
+    assert snapshot.load(path) == {"topics": {}, "docs": {}}
+    snapshot.save(state)
+    assert wallpad.StateSnapshot().load(path) == state
+
+
+def test_wallpad_snapshot_ignores_broken_file(wallpad, tmp_path):
+    path = tmp_path / "state.pickle"
+    path.write_bytes(b"not a pickle")
+    assert wallpad.StateSnapshot().load(str(path)) == {"topics": {}, "docs": {}}
+
+
+def test_ezville_snapshot_round_trip(ezville, tmp_path):
+    path = str(tmp_path / "state.pickle")
+    state = {"device": {"light_01_01": {"power": "ON"}, "thermostat_01_01": {"mode": "heat"}}}
+
+    snapshot = ezville.StateSnapshot(path)
+    snapshot.save(state)
+    # 같은 내용은 다시 쓰지 않음
+    assert snapshot.dumps(state) is None
+
+    restored = ezville.StateSnapshot(path).get("device")
+    assert restored == state["device"]
+    restored["light_01_01"]["power"] = "OFF"
+    assert state["device"]["light_01_01"]["power"] == "ON"
+
+
+def test_ezville_snapshot_ignores_broken_file(ezville, tmp_path):
+    path = tmp_path / "state.pickle"
+    path.write_bytes(b"\x80")
+    assert ezville.StateSnapshot(str(path)).get("device") == {}
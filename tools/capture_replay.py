@@ -0,0 +1,328 @@
+import sys
+import os
+import re
+import json
+import time
+import types
+import asyncio
+import logging
+import argparse
+import tempfile
+import importlib.util
+
+# 기록한 RS485 데이터를 애드온의 실제 parser에 넣어서, HA로 보내는 MQTT 메시지를 순서대로 출력
+#   wallpad: ezville_wallpad.py 의 serial_loop (EzVilleFrameReader) 에 받은 데이터로 전달, 시각도 기록한 시각을 사용
+#   ezville: ezville.py 의 ezville_loop 를 mqtt mode로 실행하고 EW11 수신 topic 메시지로 전달
+#   MQTT client는 보낸 메시지를 메모리에 기록하는 객체로 바꾸므로 broker나 월패드 없이 실행 가능
+# 입력: bus capture 파일/폴더 (capture_reader.py), dump_time 로그, EW11_LOG 로그 ([SIGNAL] receved: ...)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "ezville_wallpad"))
+import capture_reader
+
+ADDONS = {
+    "wallpad": os.path.join(ROOT, "ezville_wallpad", "ezville_wallpad.py"),
+    "ezville": os.path.join(ROOT, "simple_mqtt_ezville_control", "ezville.py"),
+}
+
+# 로그에는 Byte별 시각이 없으므로 9600 baud (8E1, 11 bit) 로 연속해서 받은 것으로 계산
+BYTE_TIME = 11 / 9600
+
+DUMP_LINE = re.compile(r"\s([0-9A-F]{2}(?:,\s+[0-9A-F]{2})*)\s*$")
+SIGNAL_LINE = re.compile(r"\[SIGNAL\] rece(?:i)?ved: ([0-9A-Fa-f]+)")
+
+# ezville은 마지막 데이터 뒤에 이 요청을 보내서 앞의 데이터 처리가 끝났는지 확인 (응답은 출력하지 않음)
+EZVILLE_DONE_REQUEST = "/debug/trace/command"
+EZVILLE_DONE_TOPIC = "/debug/trace/state"
+EZVILLE_DRAIN = 0.1
+
+
+def load_chunks(paths):
+    # (monotonic 시각, wall clock 시각, data) 목록
+    captures = [p for p in paths if os.path.isdir(p) or p.endswith(".ezcap")]
+    logs = [p for p in paths if p not in captures]
+
+    chunks = [(ts, wall, data) for ts, wall, kind, data in capture_reader.read_captures(captures, {capture_reader.CAPTURE_RX | capture_reader.CAPTURE_RAW})]
+    if captures and not chunks:
+        # raw 없이 frame만 남긴 capture
+        chunks = [(ts, wall, data) for ts, wall, kind, data in capture_reader.read_captures(captures, {capture_reader.CAPTURE_RX | capture_reader.CAPTURE_FRAME})]
+
+    ts = chunks[-1][0] if chunks else 0.0
+    wall = time.time()
+    for path in logs:
+        with open(path, errors="replace") as f:
+            for line in f:
+                match = SIGNAL_LINE.search(line)
+                if match:
+                    data = bytes.fromhex(match.group(1))
+                else:
+                    match = DUMP_LINE.search(line)
+                    if not match:
+                        continue
+                    data = bytes.fromhex(match.group(1).replace(",", ""))
+                ts += len(data) * BYTE_TIME
+                chunks.append((ts, wall + ts, data))
+    return chunks
+
+
+def load_addon(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def set_option(options, name, value):
+    # section.key=value, value는 JSON (아니면 문자열)
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    *sections, key = name.split(".")
+    for section in sections:
+        options = options[section]
+    if key not in options:
+        raise KeyError("unknown option: " + name)
+    options[key] = value
+
+
+class Pacer:
+    # speed배 속도로 기록한 시각에 맞춰 대기, 0이면 기다리지 않음
+    def __init__(self, speed, first):
+        self.speed = speed
+        self.first = first
+        self.start = time.perf_counter()
+
+    def delay(self, ts):
+        if self.speed <= 0:
+            return 0
+        return (ts - self.first) / self.speed - (time.perf_counter() - self.start)
+
+
+class RecorderClient:
+    # paho Client 대신 보낸 메시지를 기록
+    def __init__(self):
+        self.published = []
+        self.on_connect = self.on_disconnect = self.on_message = self.on_publish = None
+        self.on_done = None
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if isinstance(payload, (bytes, bytearray)):
+            payload = payload.decode(errors="replace")
+        if self.on_done is not None and self.on_done(topic):
+            return
+        self.published.append({"topic": topic, "payload": payload, "retain": retain})
+        if self.on_publish is not None:
+            self.on_publish(self, None, len(self.published))
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def connect(self, host, port=1883):
+        pass
+
+    def connect_async(self, host, port=1883):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+
+class ReplayMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.retain = False
+
+
+def replay_wallpad(path, chunks, speed, overrides, log):
+    addon = load_addon("ezville_wallpad", path)
+    if log:
+        addon.init_logger()
+    else:
+        addon.logger.setLevel(logging.CRITICAL)
+    with open(os.path.join(os.path.dirname(path), "config.json")) as f:
+        options = json.load(f)["options"]
+    for name, value in overrides:
+        set_option(options, name, value)
+    options["mqtt"]["_discovery"] = options["mqtt"]["discovery"]
+    addon.Options = options
+
+    client = RecorderClient()
+    client.on_publish = addon.mqtt_on_publish
+    addon.mqtt = client
+
+    # 애드온이 보는 시각은 기록한 시각 (재생 속도와 관계없이 결과가 같음)
+    clock = types.SimpleNamespace(time=0.0, monotonic=0.0)
+    addon.time = types.SimpleNamespace(time=lambda: clock.time, monotonic=lambda: clock.monotonic,
+        sleep=time.sleep, strftime=time.strftime, localtime=time.localtime)
+
+    pacer = Pacer(speed, chunks[0][0])
+    sent = []
+
+    class ReplayConn(addon.EzVilleFrameReader):
+        def __init__(self):
+            super().__init__()
+            self._chunks = iter(chunks)
+
+        def _recv_bulk(self):
+            try:
+                ts, wall, data = next(self._chunks)
+            except StopIteration:
+                raise EOFError("end of replay")
+            delay = pacer.delay(ts)
+            if delay > 0:
+                time.sleep(delay)
+            clock.time, clock.monotonic = wall, ts
+            return data
+
+        def send(self, a):
+            sent.append(a)
+
+    addon.conn = ReplayConn()
+    started, cpu = time.perf_counter(), time.process_time()
+    try:
+        addon.serial_loop()
+    except EOFError:
+        pass
+    elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu
+
+    return client.published, {
+        "frames": addon.metric_frames.value,
+        "checksum_errors": addon.metric_checksum_errors.value,
+        "sent": len(sent),
+        "elapsed": elapsed,
+        "cpu": cpu,
+    }
+
+
+def replay_ezville(path, chunks, speed, overrides, log, report):
+    addon = load_addon("ezville", path)
+    if log:
+        addon.init_logger(0)
+    else:
+        addon.LOGGER.setLevel(logging.CRITICAL)
+    with open(os.path.join(os.path.dirname(path), "config.json")) as f:
+        config = json.load(f)["options"]
+    # 저장된 상태 없이 시작하고, 시간에 따라 달라지는 동작은 끔
+    config.update({
+        "mode": "mqtt",
+        "discovery_delay": 0,
+        "force_update_mode": False,
+        "snapshot_interval": 0,
+        "metrics_port": 0,
+        "diagnostics_interval": 0,
+        "reboot_control": False,
+        "ew11_timeout": 86400,
+    })
+    for name, value in overrides:
+        set_option(config, name, value)
+    # 등록 정보, State 스냅샷은 임시 폴더에 (끝나면 지움)
+    config_dir = tempfile.TemporaryDirectory(prefix="ezville_replay_")
+    addon.config_dir = config_dir.name
+
+    client = RecorderClient()
+    addon.mqtt = types.SimpleNamespace(Client=lambda *args, **kwargs: client)
+    recv_topic = addon.EW11_TOPIC + "/recv"
+    done_topic = addon.HA_TOPIC + EZVILLE_DONE_TOPIC
+    done = []
+
+    def on_done(topic):
+        if topic != done_topic:
+            return False
+        done.append((time.perf_counter(), time.process_time()))
+        return True
+    client.on_done = on_done
+
+    async def feed():
+        # 한 데이터씩 넣고 양보하므로 as-fast-as-possible 에서도 처리 순서가 매번 같음
+        pacer = Pacer(speed, chunks[0][0])
+        started, cpu = time.perf_counter(), time.process_time()
+        for ts, wall, data in chunks:
+            delay = pacer.delay(ts)
+            await asyncio.sleep(max(delay, 0))
+            client.on_message(client, None, ReplayMessage(recv_topic, data))
+        client.on_message(client, None, ReplayMessage(addon.HA_TOPIC + EZVILLE_DONE_REQUEST, b"dump"))
+        while not done:
+            await asyncio.sleep(0)
+        await asyncio.sleep(EZVILLE_DRAIN)
+
+        report(client.published, {
+            "elapsed": done[0][0] - started,
+            "cpu": done[0][1] - cpu,
+        })
+        # ezville_loop는 loop를 멈추면 다시 시작하므로 결과 출력 후 바로 종료 (임시 폴더는 먼저 지움)
+        config_dir.cleanup()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+
+    def loop_start():
+        if not client.started:
+            client.started = True
+            client.on_connect(client, None, {}, 0)
+            asyncio.get_event_loop().create_task(feed())
+    client.started = False
+    client.loop_start = loop_start
+
+    try:
+        addon.ezville_loop(config)
+    finally:
+        config_dir.cleanup()
+
+
+def report(chunks, output):
+    size = sum(len(data) for ts, wall, data in chunks)
+    span = chunks[-1][0] - chunks[0][0] if len(chunks) > 1 else 0
+
+    def write(published, stats):
+        try:
+            for message in published:
+                output.write(json.dumps(message, ensure_ascii=False) + "\n")
+            output.flush()
+        except BrokenPipeError:
+            pass
+
+        elapsed = stats["elapsed"]
+        print("chunks {}, bytes {}, recorded {:.1f}s".format(len(chunks), size, span), file=sys.stderr)
+        if "frames" in stats:
+            print("frames {} ({} checksum errors), sent {}".format(stats["frames"], stats["checksum_errors"], stats["sent"]), file=sys.stderr)
+        print("publishes {}".format(len(published)), file=sys.stderr)
+        print("elapsed {:.3f}s, cpu {:.3f}s, {:.0f} bytes/s, {:.1f}x real time{}".format(
+            elapsed, stats["cpu"], size / elapsed if elapsed else 0, span / elapsed if elapsed else 0,
+            ", {:.0f} frames/s".format(stats["frames"] / elapsed) if "frames" in stats and elapsed else ""), file=sys.stderr)
+    return write
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay recorded RS485 data through the add-on parsers")
+    parser.add_argument("target", choices=sorted(ADDONS), help="add-on to drive")
+    parser.add_argument("inputs", nargs="+", help="capture files/folders or dump logs")
+    parser.add_argument("--speed", type=float, default=0, help="replay speed (1: real time, 10: 10x, 0: as fast as possible)")
+    parser.add_argument("--option", action="append", default=[], metavar="NAME=VALUE", help="override add-on option (mqtt.state_json=true)")
+    parser.add_argument("--addon", help="add-on source file (default: this repository)")
+    parser.add_argument("--output", help="write publishes (JSON lines) to this file instead of stdout")
+    parser.add_argument("--log", action="store_true", help="show add-on logs")
+    args = parser.parse_args()
+
+    chunks = load_chunks(args.inputs)
+    if not chunks:
+        parser.error("no data in inputs")
+    overrides = [option.split("=", 1) for option in args.option]
+    path = args.addon or ADDONS[args.target]
+    output = open(args.output, "w") if args.output else sys.stdout
+    # ezville 애드온의 log (--log) 는 stdout으로 나오므로 결과와 섞이지 않도록
+    sys.stdout = sys.stderr
+    write = report(chunks, output)
+
+    if args.target == "wallpad":
+        published, stats = replay_wallpad(path, chunks, args.speed, overrides, args.log)
+        write(published, stats)
+    else:
+        replay_ezville(path, chunks, args.speed, overrides, args.log, write)
@@ -0,0 +1,551 @@
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import asyncio
+import argparse
+from functools import reduce
+from operator import xor
+
+# EzVille 월패드 RS485 bus 시뮬레이터
+#   EW11 처럼 TCP (기본 8899) 로, 또는 pty serial 장치로 bus 데이터를 보내고 받은 명령에 응답
+#   월패드처럼 장치별로 상태 요구 (01) / 상태 응답 (81), 가끔 특성 요구 (0F) / 특성 응답 (8F) 를 반복하고
+#   명령 (41/42/43/44/45) 을 받으면 장치 상태를 바꾸고 ack (C1/C3/C4/C5) 로 응답
+#   ack 지연, 명령 무시, bus 충돌, checksum 오류를 넣을 수 있고, 명령 성공률과 지연 시간을 출력
+# 패킷 형식은 ezville_wallpad/DOCS_PACKETS.md 참고
+
+# 9600 baud, 8E1 (11 bit)
+BYTE_TIME = 11 / 9600
+
+# 상태 요구 후 장치가 응답하기까지, 특성 요구는 이 주기마다 한번씩
+RESPONSE_DELAY = 0.004
+CHARACTERISTIC_EVERY = 100
+
+# 난방중인 방의 현재 온도가 설정 온도를 향해 1도 바뀌는 주기
+TEMPERATURE_CYCLES = 20
+
+# 엘리베이터 호출 후 도착까지 (일괄 차단기의 호출 bit가 꺼짐)
+ELEVATOR_TIME = 5.0
+
+# 재시도가 이 시간 동안 없으면 실패로 계산 (월패드 애드온의 max_retry 기본값 20초보다 길게)
+GIVE_UP_TIME = 30.0
+
+
+def checksum(body):
+    body = bytes(body)
+    x = reduce(xor, body, 0)
+    return body + bytes([x, (sum(body) + x) & 0xFF])
+
+
+def verify_checksum(packet):
+    return checksum(packet[:-2]) == bytes(packet)
+
+
+class Devices:
+    # 장치 상태와 패킷 생성, 명령 처리
+    def __init__(self, lights, thermostats, plugs):
+        self.lights = {room: [0] * count for room, count in enumerate(lights, 1) if count}
+        self.rooms = thermostats
+        self.heat = (1 << thermostats) - 1
+        self.away = 0
+        self.target = [22] * thermostats
+        self.current = [20] * thermostats
+        self.plugs = {room: [[1, 1] for _ in range(count)] for room, count in enumerate(plugs, 1) if count}
+        self.gas_open = 1
+        self.batch = 0x00
+        self.elevator_time = None
+        self.cycles = 0
+
+    def groups(self):
+        # 월패드의 조회 순서
+        groups = [(0x0E, 0x10 | room) for room in self.lights]
+        if self.rooms:
+            groups.append((0x36, 0x1F))
+        groups += [(0x50, 0x10 | room) for room in self.plugs]
+        groups += [(0x12, 0x01), (0x33, 0x01)]
+        return groups
+
+    def state(self, dev_id, grp, cmd=0x81):
+        if dev_id == 0x0E:
+            lights = self.lights[grp & 0x0F]
+            return checksum([0xF7, dev_id, grp, cmd, len(lights) + 1, 0x00] + lights)
+        if dev_id == 0x36:
+            temps = []
+            for target, current in zip(self.target, self.current):
+                temps += [target, current]
+            return checksum([0xF7, dev_id, grp, cmd, 5 + 2 * self.rooms, 0x80, self.heat, self.away, 0x00, 0x00] + temps)
+        if dev_id == 0x50:
+            plugs = self.plugs[grp & 0x0F]
+            data = [len(plugs)]
+            for power, auto in plugs:
+                watt = 1234 if power else 0
+                data += [auto << 4 | power, watt >> 8, watt & 0xFF]
+            return checksum([0xF7, dev_id, grp, cmd, len(data)] + data)
+        if dev_id == 0x12:
+            return checksum([0xF7, dev_id, grp, cmd, 0x03, 0x00, self.gas_open, 0x00])
+        return checksum([0xF7, dev_id, grp, cmd, 0x03, 0x00, self.batch, 0x00])
+
+    def snapshot(self):
+        return [self.state(dev_id, grp) for dev_id, grp in self.groups()]
+
+    def characteristic(self, dev_id, grp):
+        if dev_id == 0x0E:
+            data = [0x00, len(self.lights[grp & 0x0F]), 0x00]
+        elif dev_id == 0x36:
+            # [Reserved] [제조사] [제어방식] [온도 상한] [온도 하한] [기능; 외출] [조절기 갯수]
+            data = [0x01, 0x87, 0x01, 40, 5, 0x02, self.rooms]
+        elif dev_id == 0x50:
+            data = [0x00, len(self.plugs[grp & 0x0F])]
+        else:
+            data = [0x00]
+        return checksum([0xF7, dev_id, grp, 0x8F, len(data)] + data)
+
+    def tick(self, now):
+        self.cycles += 1
+        if self.cycles % TEMPERATURE_CYCLES == 0:
+            for room in range(self.rooms):
+                if self.heat & self._bit(room) and self.current[room] != self.target[room]:
+                    self.current[room] += 1 if self.current[room] < self.target[room] else -1
+        if self.elevator_time is not None and now >= self.elevator_time:
+            self.batch &= ~0x30
+            self.elevator_time = None
+
+    def _bit(self, room):
+        # 난방/외출 상태는 1번 방이 bit 0 (room은 0부터)
+        return 1 << room
+
+    def _set_heat(self, room, heat):
+        # 각 방은 난방 혹은 외출 중 하나
+        bit = self._bit(room)
+        if heat:
+            self.heat |= bit
+            self.away &= ~bit
+        else:
+            self.heat &= ~bit
+            self.away |= bit
+
+    def command(self, packet, now):
+        # 처리했으면 (ack 패킷 혹은 None), 모르는 명령이면 False
+        dev_id, grp, cmd = packet[1], packet[2], packet[3]
+        data = packet[5:-2]
+        room = grp & 0x0F
+
+        if dev_id == 0x0E and cmd == 0x41 and room in self.lights and 1 <= data[0] <= len(self.lights[room]):
+            self.lights[room][data[0] - 1] = data[1] & 1
+            return self.state(dev_id, grp, 0xC1)
+        if dev_id == 0x0E and cmd == 0x42 and grp == 0xFF:
+            # 일괄 소등 (ack 없음)
+            for lights in self.lights.values():
+                lights[:] = [0] * len(lights)
+            return None
+        if dev_id == 0x36 and cmd in (0x43, 0x44, 0x45):
+            rooms = range(self.rooms) if room == 0x0F else [room - 1] if 1 <= room <= self.rooms else []
+            if not rooms:
+                return False
+            for r in rooms:
+                if cmd == 0x43:
+                    self._set_heat(r, data[0] & 1)
+                elif cmd == 0x44:
+                    self.target[r] = data[0] & 0x7F
+                else:
+                    self._set_heat(r, not data[0] & 1)
+            # 그룹 전체 외출 명령은 ack 없음
+            if room == 0x0F:
+                return None
+            return self.state(dev_id, grp, cmd | 0x80)
+        if dev_id == 0x50 and cmd == 0x43 and room in self.plugs and 1 <= data[0] <= len(self.plugs[room]):
+            self.plugs[room][data[0] - 1][0] = data[1] & 1
+            return checksum([0xF7, dev_id, grp, 0xC3, 0x02, data[0], data[1] & 1])
+        if dev_id == 0x12 and cmd == 0x41:
+            # 잠그기만 가능
+            self.gas_open = 0
+            return self.state(dev_id, grp, 0xC1)
+        if dev_id == 0x33 and cmd == 0x81:
+            # 일괄 차단기 상태를 바꿔서 보내면 월패드가 그대로 동작 (엘리베이터 호출 등, ack 없음)
+            self.batch = data[1]
+            if self.batch & 0x30:
+                self.elevator_time = now + ELEVATOR_TIME
+            return None
+        if dev_id == 0x33 and cmd == 0x41:
+            return self.state(dev_id, grp, 0xC1)
+        return False
+
+
+class CommandStats:
+    # 명령별 (같은 패킷의 재시도는 같은 명령) 첫 시도부터 적용까지 시간
+    def __init__(self):
+        self.pending = {}
+        self.done = {}
+        self.latency = []
+        self.attempts = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.unknown = 0
+        self.bad = 0
+        self.dropped = 0
+        self.collisions = 0
+        self.corrupted = 0
+        self.frames = 0
+
+    def attempt(self, packet, now):
+        # 첫 시각, 마지막 시각, 직전에 성공한 명령과 같은 패킷인지
+        key = bytes(packet[:-2])
+        self.attempts += 1
+        if key in self.pending:
+            self.pending[key][1] = now
+        else:
+            self.pending[key] = [now, now, key in self.done]
+
+    def applied(self, packet, changed):
+        # 성공한 명령과 같은 패킷인데 상태가 그대로면 ack를 못 받아서 다시 보낸 것
+        key = bytes(packet[:-2])
+        entry = self.pending.get(key)
+        if entry is not None and entry[2] and not changed:
+            del self.pending[key]
+            self.duplicates += 1
+            return False
+        return True
+
+    def success(self, packet, now):
+        key = bytes(packet[:-2])
+        entry = self.pending.pop(key, None)
+        if entry is not None:
+            self.latency.append(now - entry[0])
+            self.done[key] = now
+
+    def expire(self, now):
+        for key, (first, last, repeat) in list(self.pending.items()):
+            if now - last > GIVE_UP_TIME:
+                del self.pending[key]
+                self.failed += 1
+        for key, done in list(self.done.items()):
+            if now - done > GIVE_UP_TIME:
+                del self.done[key]
+
+    def summary(self):
+        succeeded = len(self.latency)
+        finished = succeeded + self.failed
+        result = {
+            "commands": finished + len(self.pending),
+            "attempts": self.attempts,
+            "succeeded": succeeded,
+            "failed": self.failed,
+            "pending": len(self.pending),
+            "success_rate": round(100 * succeeded / finished, 1) if finished else None,
+            "attempts_per_command": round(self.attempts / (finished + len(self.pending)), 2) if finished + len(self.pending) else None,
+            "duplicates": self.duplicates,
+            "dropped": self.dropped,
+            "collisions": self.collisions,
+            "corrupted_frames": self.corrupted,
+            "bad_commands": self.bad,
+            "unknown_commands": self.unknown,
+            "frames": self.frames,
+        }
+        if self.latency:
+            values = sorted(self.latency)
+            for p in (50, 95, 99):
+                result["latency_p{}_ms".format(p)] = round(values[min(len(values) * p // 100, len(values) - 1)] * 1000, 1)
+            result["latency_max_ms"] = round(values[-1] * 1000, 1)
+        return result
+
+
+class BusSimulator:
+    def __init__(self, devices, args):
+        self.devices = devices
+        self.gap = args.gap
+        self.idle_time = args.idle
+        self.latency = args.latency / 1000
+        self.jitter = args.jitter / 1000
+        self.drop = args.drop
+        self.collision = args.collision
+        self.corrupt = args.corrupt
+        self.random = random.Random(args.seed)
+        self.stats = CommandStats()
+
+        # bus에 연결된 쪽 (TCP client, pty): 이름 -> 쓰기 함수
+        self.outputs = {}
+        self._busy_until = 0
+        self._garble = False
+        # 보내는 중인 명령 (끝나는 시각, 패킷, 보낸 쪽), 보낼 ack (시각, 순서, 패킷)
+        self._incoming = []
+        self._acks = []
+        self._order = 0
+        self._wake = asyncio.Event()
+
+    def now(self):
+        return asyncio.get_running_loop().time()
+
+    def _send(self, packet, exclude=None):
+        for name, write in list(self.outputs.items()):
+            if name != exclude:
+                write(packet)
+
+    async def transmit(self, packet):
+        # 보내는 동안 들어온 명령은 충돌
+        for incoming in list(self._incoming):
+            if self.random.random() < self.collision:
+                self._incoming.remove(incoming)
+                self.stats.collisions += 1
+                self._garble = True
+
+        duration = len(packet) * BYTE_TIME
+        self._busy_until = self.now() + duration
+        await asyncio.sleep(duration)
+        self._busy_until = 0
+
+        if self._garble or self.random.random() < self.corrupt:
+            packet = bytearray(packet)
+            packet[self.random.randrange(1, len(packet))] ^= 1 << self.random.randrange(8)
+            packet = bytes(packet)
+            self.stats.corrupted += 1
+        self._garble = False
+        self.stats.frames += 1
+        self._send(packet)
+
+    async def idle(self, seconds):
+        # bus가 비어있는 동안 받은 명령 처리, 때가 된 ack 전송
+        end = self.now() + seconds
+        while True:
+            now = self.now()
+            while self._incoming and self._incoming[0][0] <= now:
+                self._process(*self._incoming.pop(0))
+            if self._acks and self._acks[0][0] <= now:
+                due, _, packet, command = heapq.heappop(self._acks)
+                await self.transmit(packet)
+                self.stats.success(command, self.now())
+                continue
+
+            wake = end
+            if self._incoming:
+                wake = min(wake, self._incoming[0][0])
+            if self._acks:
+                wake = min(wake, self._acks[0][0])
+            if wake <= now:
+                if now >= end:
+                    return
+                continue
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), wake - now)
+            except asyncio.TimeoutError:
+                pass
+
+    def _process(self, end, packet, source):
+        # 다른 쪽에서도 bus의 명령이 보임
+        self._send(packet, exclude=source)
+        if self.random.random() < self.drop:
+            self.stats.dropped += 1
+            return
+        before = self.devices.snapshot()
+        ack = self.devices.command(packet, end)
+        if ack is False:
+            self.stats.unknown += 1
+            return
+        if not self.stats.applied(packet, before != self.devices.snapshot()):
+            # 장치는 다시 ack를 보냄
+            self._order += 1
+            if ack is not None:
+                heapq.heappush(self._acks, (end + self.latency, self._order, ack, packet))
+            return
+        if ack is None:
+            self.stats.success(packet, end)
+            return
+        due = end + self.latency + self.random.uniform(0, self.jitter)
+        self._order += 1
+        heapq.heappush(self._acks, (due, self._order, ack, packet))
+
+    def receive(self, packet, source):
+        # client가 보낸 명령 (checksum 확인 끝난 패킷)
+        now = self.now()
+        self.stats.attempt(packet, now)
+        if now < self._busy_until and self.random.random() < self.collision:
+            self.stats.collisions += 1
+            self._garble = True
+            return
+        self._incoming.append((now + len(packet) * BYTE_TIME, packet, source))
+        self._wake.set()
+
+    async def poll_loop(self):
+        cycle = 0
+        while True:
+            for dev_id, grp in self.devices.groups():
+                if cycle % CHARACTERISTIC_EVERY == 0:
+                    await self.transmit(checksum([0xF7, dev_id, grp, 0x0F, 0x00]))
+                    await self.idle(RESPONSE_DELAY)
+                    await self.transmit(self.devices.characteristic(dev_id, grp))
+                    await self.idle(self.gap)
+                await self.transmit(checksum([0xF7, dev_id, grp, 0x01, 0x00]))
+                await self.idle(RESPONSE_DELAY)
+                await self.transmit(self.devices.state(dev_id, grp))
+                await self.idle(self.gap)
+            await self.idle(self.idle_time)
+            self.devices.tick(self.now())
+            self.stats.expire(self.now())
+            cycle += 1
+
+
+class FrameSplitter:
+    # client가 보낸 데이터를 패킷 단위로
+    def __init__(self, simulator, source):
+        self.simulator = simulator
+        self.source = source
+        self.buf = bytearray()
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        while True:
+            start = buf.find(0xF7)
+            if start < 0:
+                buf.clear()
+                return
+            del buf[:start]
+            if len(buf) < 5 or len(buf) < 5 + buf[4] + 2:
+                return
+            end = 5 + buf[4] + 2
+            packet = bytes(buf[:end])
+            if not verify_checksum(packet):
+                self.simulator.stats.bad += 1
+                del buf[:1]
+                continue
+            del buf[:end]
+            self.simulator.receive(packet, self.source)
+
+
+async def serve_tcp(simulator, host, port):
+    async def client(reader, writer):
+        name = "tcp:{}:{}".format(*writer.get_extra_info("peername")[:2])
+        print("connected:", name, flush=True)
+        simulator.outputs[name] = writer.write
+        splitter = FrameSplitter(simulator, name)
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                splitter.feed(data)
+        except (ConnectionError, asyncio.CancelledError):
+            # 종료할 때도 연결이 있으면 여기서 정리
+            pass
+        finally:
+            simulator.outputs.pop(name, None)
+            writer.close()
+            print("disconnected:", name, flush=True)
+
+    server = await asyncio.start_server(client, host, port)
+    print("listening on {}:{}".format(host, port), flush=True)
+    return server
+
+
+def open_pty(simulator, link):
+    import pty
+    import tty
+
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    os.set_blocking(master, False)
+    path = os.ttyname(slave)
+    if link:
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(path, link)
+        path = "{} -> {}".format(link, path)
+    print("serial device:", path, flush=True)
+
+    def write(packet):
+        # 읽는 쪽이 없어서 buffer가 차면 bus처럼 그냥 버림
+        try:
+            os.write(master, packet)
+        except (BlockingIOError, OSError):
+            pass
+
+    splitter = FrameSplitter(simulator, "pty")
+
+    def readable():
+        try:
+            splitter.feed(os.read(master, 4096))
+        except (BlockingIOError, OSError):
+            pass
+
+    simulator.outputs["pty"] = write
+    asyncio.get_running_loop().add_reader(master, readable)
+    return slave
+
+
+def print_report(stats, as_json):
+    summary = stats.summary()
+    if as_json:
+        print(json.dumps(summary), flush=True)
+        return
+    summary = {key: "-" if value is None else value for key, value in summary.items()}
+    line = "commands {commands} (attempts {attempts}, {attempts_per_command}/command), succeeded {succeeded}, failed {failed}, pending {pending}, success {success_rate}%".format(**summary)
+    if "latency_p50_ms" in summary:
+        line += ", latency ms p50 {latency_p50_ms} p95 {latency_p95_ms} p99 {latency_p99_ms} max {latency_max_ms}".format(**summary)
+    line += " | dropped {dropped}, collisions {collisions}, corrupted {corrupted_frames}, duplicates {duplicates}, frames {frames}".format(**summary)
+    print(time.strftime("%H:%M:%S"), line, flush=True)
+
+
+async def main(args):
+    devices = Devices(args.lights, args.thermostats, args.plugs)
+    simulator = BusSimulator(devices, args)
+
+    server = await serve_tcp(simulator, args.host, args.port) if args.port else None
+    if args.pty or args.pty_link:
+        open_pty(simulator, args.pty_link)
+
+    async def report_loop():
+        while True:
+            await asyncio.sleep(args.report)
+            print_report(simulator.stats, args.json)
+
+    tasks = [asyncio.ensure_future(simulator.poll_loop())]
+    if args.report > 0:
+        tasks.append(asyncio.ensure_future(report_loop()))
+    try:
+        if args.duration > 0:
+            await asyncio.sleep(args.duration)
+        else:
+            await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if server is not None:
+            server.close()
+        simulator.stats.expire(simulator.now())
+        print_report(simulator.stats, args.json)
+
+
+def count_list(value):
+    return [int(v) for v in value.split(",") if v != ""]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EzVille wallpad RS485 bus simulator (EW11 TCP / pty)")
+    parser.add_argument("--host", default="0.0.0.0", help="TCP listen address")
+    parser.add_argument("--port", type=int, default=8899, help="TCP port like EW11 (0: no TCP)")
+    parser.add_argument("--pty", action="store_true", help="also create a pty serial device")
+    parser.add_argument("--pty-link", help="symlink path for the pty (implies --pty)")
+    parser.add_argument("--lights", type=count_list, default=[3, 2, 2, 1], help="lights per room (3,2,2,1)")
+    parser.add_argument("--thermostats", type=int, default=4, help="thermostat rooms (0-5)")
+    parser.add_argument("--plugs", type=count_list, default=[2, 2], help="plugs per room (2,2)")
+    parser.add_argument("--gap", type=float, default=0.005, help="bus idle seconds after each response")
+    parser.add_argument("--idle", type=float, default=0.1, help="bus idle seconds at the end of each polling cycle")
+    parser.add_argument("--latency", type=float, default=5, help="device ack latency (ms)")
+    parser.add_argument("--jitter", type=float, default=0, help="extra random ack latency up to this (ms)")
+    parser.add_argument("--drop", type=float, default=0, help="probability a device ignores a command")
+    parser.add_argument("--collision", type=float, default=1, help="probability overlapping frames garble each other")
+    parser.add_argument("--corrupt", type=float, default=0, help="probability a bus frame has a checksum error")
+    parser.add_argument("--seed", type=int, help="random seed")
+    parser.add_argument("--report", type=float, default=30, help="report interval seconds (0: only at exit)")
+    parser.add_argument("--duration", type=float, default=0, help="stop after seconds (0: until Ctrl-C)")
+    parser.add_argument("--json", action="store_true", help="print reports as JSON")
+    args = parser.parse_args()
+
+    if not 0 <= args.thermostats <= 5:
+        parser.error("--thermostats must be 0-5")
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass